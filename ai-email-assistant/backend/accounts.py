@@ -0,0 +1,185 @@
+import threading
+import time
+
+from folders import MailboxDirectory
+from imap_pool import IMAPPool
+from smtp_pool import SMTPPool
+from sync_engine import SyncEngine
+from idle_watcher import IdleWatcher
+from event_stream import EventBroker
+
+
+class MailAccount:
+    """Everything the backend keeps open for one mailbox account.
+
+    Owns the account's IMAP and SMTP pools, folder directory, background
+    sync engine, IDLE watcher and the event broker that pushes sync deltas
+    to its SSE clients. Sessions of the same account share one MailAccount.
+    """
+
+    def __init__(self, email_address, password, sync_store, host="imap.gmail.com",
+                 pool_size=4, pool_idle_timeout=300, sync_interval=60, sync_window=500, indexes=(),
+                 smtp_host="smtp.gmail.com", smtp_port=465, smtp_pool_size=2, sync_listeners=(),
+                 port=None, ssl=True, smtp_ssl=True, sync_mailboxes=("inbox",), sync_workers=1):
+        self.email = email_address
+        self.password = password
+        self.last_used = time.monotonic()
+
+        self.pool = IMAPPool(host=host, port=port, ssl=ssl, max_size=pool_size, idle_timeout=pool_idle_timeout)
+        self.pool.configure(email_address, password)
+        self.smtp = SMTPPool(host=smtp_host, port=smtp_port, ssl=smtp_ssl, max_size=smtp_pool_size)
+        self.smtp.configure(email_address, password)
+        self.events = EventBroker()
+        self.folders = MailboxDirectory(self.pool)
+        self.sync = SyncEngine(self.pool, sync_store, mailboxes=sync_mailboxes, interval=sync_interval, window=sync_window,
+                               indexes=indexes, resolve=self.folders.resolve, workers=sync_workers)
+        self.sync.add_listener(self._publish_deltas)
+        for listener in sync_listeners:
+            self.sync.add_listener(listener)
+        # IDLE watches the inbox only; other folders are picked up by the periodic pass
+        self.idle = IdleWatcher(host=host, port=port, ssl=ssl, mailbox="inbox", on_change=lambda: self.sync.request_sync("inbox"))
+
+    def start(self):
+        self.sync.start(self.email)
+        self.idle.start(self.email, self.password)
+
+    def close(self):
+        self.idle.stop()
+        self.sync.stop()
+        self.pool.close_all()
+        self.smtp.close_all()
+
+    def _publish_deltas(self, account, mailbox, deltas):
+        if deltas["full_resync"]:
+            self.events.publish("resync", {"mailbox": mailbox})
+            return
+        if deltas["new"]:
+            newest_first = sorted(deltas["new"], key=lambda r: int(r["id"]), reverse=True)
+            self.events.publish("new", {"mailbox": mailbox, "emails": newest_first})
+        if deltas["flags"]:
+            self.events.publish("flags", {"mailbox": mailbox, "emails": deltas["flags"]})
+        if deltas["expunged"]:
+            self.events.publish("expunge", {"mailbox": mailbox, "ids": deltas["expunged"]})
+
+    def stats(self):
+        return {
+            "imap": self.pool.stats(),
+            "smtp": self.smtp.stats(),
+            "sync": self.sync.stats(),
+            "idle": self.idle.stats(),
+            "event_subscribers": self.events.subscriber_count,
+        }
+
+
+class AccountRegistry:
+    """Process-local MailAccounts keyed by email address.
+
+    Sessions only carry credentials, so any worker can rebuild an account
+    on first use. Accounts nobody has touched for `idle_timeout` seconds
+    (and with no SSE client attached) are closed by a reaper thread.
+    """
+
+    def __init__(self, factory, idle_timeout=1800):
+        self.factory = factory
+        self.idle_timeout = idle_timeout
+        self._accounts = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+        self._stats = {"opened": 0, "closed": 0, "reaped": 0}
+
+    def get(self, email_address, password, validate=False):
+        """Returns the running account, opening (and starting) it if needed.
+
+        With `validate`, a newly opened account must log in successfully
+        before it is registered; the error is raised otherwise. A different
+        password than the running account's is always validated first, and
+        the running account is only replaced (and closed) once it works.
+        """
+        with self._lock:
+            account = self._accounts.get(email_address)
+            if account is not None and account.password == password:
+                account.last_used = time.monotonic()
+                return account
+            replacing = account is not None
+
+        account = self.factory(email_address, password)
+        if validate or replacing:
+            try:
+                # The validated session stays in the pool for the first tool call
+                with account.pool.connection(mailbox=None):
+                    pass
+            except Exception:
+                account.close()
+                raise
+
+        with self._lock:
+            existing = self._accounts.get(email_address)
+            if existing is not None and existing.password == password:
+                # Another request opened it first
+                account, unused, replaced = existing, account, None
+            else:
+                # `existing`, if any, runs with a password that no longer works for new logins
+                unused, replaced = None, existing
+                self._accounts[email_address] = account
+                self._stats["opened"] += 1
+                if replaced is not None:
+                    self._stats["closed"] += 1
+        if unused is not None:
+            unused.close()
+        else:
+            account.start()
+        if replaced is not None:
+            replaced.close()
+        self._start_reaper()
+        return account
+
+    def find(self, email_address):
+        """Returns the account if it is open on this process, without opening it."""
+        with self._lock:
+            return self._accounts.get(email_address)
+
+    def close(self, email_address):
+        with self._lock:
+            account = self._accounts.pop(email_address, None)
+            if account is not None:
+                self._stats["closed"] += 1
+        if account is not None:
+            account.close()
+
+    def close_all(self):
+        with self._lock:
+            accounts, self._accounts = list(self._accounts.values()), {}
+            self._stats["closed"] += len(accounts)
+        for account in accounts:
+            account.close()
+
+    def _start_reaper(self):
+        if self._reaper is not None and self._reaper.is_alive():
+            return
+        self._reaper = threading.Thread(target=self._reap_forever, name="account-reaper", daemon=True)
+        self._reaper.start()
+
+    def _reap_forever(self):
+        interval = max(1.0, self.idle_timeout / 4)
+        while True:
+            time.sleep(interval)
+            self.reap_idle()
+
+    def reap_idle(self):
+        """Closes accounts unused for `idle_timeout` seconds that have no live SSE client."""
+        cutoff = time.monotonic() - self.idle_timeout
+        with self._lock:
+            expired = [
+                email for email, account in self._accounts.items()
+                if account.last_used < cutoff and account.events.subscriber_count == 0
+            ]
+            accounts = [self._accounts.pop(email) for email in expired]
+            self._stats["reaped"] += len(accounts)
+        for account in accounts:
+            account.close()
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["open"] = len(self._accounts)
+        return snapshot
@@ -0,0 +1,99 @@
+import asyncio
+import threading
+
+# A scripted stand-in for google.generativeai models: each user command maps
+# to a script of steps, a step being either a list of function calls
+# ({"name", "args"}) or the final text. The chat replays the steps in order,
+# whatever the tools return, so agent turns are repeatable and cost no API calls.
+
+
+class FunctionCall:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+
+class Part:
+    def __init__(self, text=None, function_call=None):
+        self.text = text
+        self.function_call = function_call
+
+
+class Content:
+    def __init__(self, parts):
+        self.parts = parts
+
+
+class Candidate:
+    def __init__(self, content):
+        self.content = content
+
+
+class Response:
+    """A (non-streamed or single-chunk streamed) response with the attributes the agent loop reads."""
+
+    def __init__(self, parts):
+        self.candidates = [Candidate(Content(parts))]
+
+    @property
+    def text(self):
+        return "".join(p.text for p in self.candidates[0].content.parts if p.text)
+
+    def __aiter__(self):
+        async def chunks():
+            yield self
+        return chunks()
+
+
+class ModelStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.request_chars = 0
+            self.history_messages = 0
+
+    def add(self, calls=0, request_chars=0, history_messages=0):
+        with self._lock:
+            self.calls += calls
+            self.request_chars += request_chars
+            self.history_messages += history_messages
+
+    def snapshot(self):
+        with self._lock:
+            return {"calls": self.calls, "request_chars": self.request_chars, "history_messages": self.history_messages}
+
+
+class FakeChat:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history or [])
+        self.steps = None
+        model.stats.add(history_messages=len(self.history))
+
+    async def send_message_async(self, content, stream=False):
+        self.model.stats.add(calls=1, request_chars=len(str(content)))
+        if self.model.latency:
+            await asyncio.sleep(self.model.latency)
+        if self.steps is None:
+            script = self.model.scripts.get(str(content))
+            self.steps = list(script["steps"]) if script else ["(no script for this command)"]
+        step = self.steps.pop(0) if self.steps else "(script finished)"
+        if isinstance(step, str):
+            return Response([Part(text=step)])
+        return Response([Part(function_call=FunctionCall(call["name"], dict(call.get("args", {})))) for call in step])
+
+
+class FakeGenerativeModel:
+    """Replays `scripts` ({command: {"steps": [...]}}); `latency` seconds per model call."""
+
+    def __init__(self, scripts, latency=0.0):
+        self.scripts = scripts
+        self.latency = latency
+        self.stats = ModelStats()
+
+    def start_chat(self, history=None):
+        return FakeChat(self, history)
@@ -0,0 +1,662 @@
+import bisect
+import datetime
+import re
+import select
+import socket
+import socketserver
+import threading
+import time
+from array import array
+from collections import Counter, OrderedDict
+from email import message_from_bytes
+
+from bench.synthetic_mail import SyntheticMailbox
+
+# A local IMAP4rev1 server over synthetic mailboxes, implementing what the
+# backend uses: LOGIN, SELECT/EXAMINE, STATUS, (UID) SEARCH/FETCH/STORE/COPY,
+# (UID) EXPUNGE (UIDPLUS), APPEND, LIST, NOOP and IDLE. CONDSTORE and Gmail
+# extensions are not offered, so the backend takes its generic code paths.
+
+FLAG_BITS = {"\\Seen": 1, "\\Flagged": 2, "\\Deleted": 4, "\\Answered": 8, "\\Draft": 16}
+_FETCH_ITEM = re.compile(r"(BODY(?:\.PEEK)?)\[([^\]]*)\](?:<(\d+)(?:\.(\d+))?>)?|([A-Z0-9.]+)", re.IGNORECASE)
+_TOKEN = re.compile(r'"((?:[^"\\]|\\.)*)"|(\()|(\))|([^\s()"]+)')
+_LITERAL = re.compile(rb"\{(\d+)\+?\}\r\n$")
+_SEARCH_DATE_FORMATS = ("%d-%b-%Y", "%Y-%m-%d", "%Y/%m/%d", "%d %b %Y")
+
+
+class Quoted(str):
+    """A quoted SEARCH argument (as opposed to an atom)."""
+
+
+class RawMessage:
+    """An APPENDed/copied message kept as bytes, with the same section API as synthetic ones."""
+
+    def __init__(self, uid, raw, date=None):
+        self.uid = uid
+        self.raw = raw
+        head, sep, self.text = raw.partition(b"\r\n\r\n")
+        self.header = head + sep
+        self.parsed = message_from_bytes(raw)
+        self.date = date or datetime.datetime.now(datetime.timezone.utc)
+
+    @property
+    def size(self):
+        return len(self.raw)
+
+    def section(self, name):
+        upper = name.upper()
+        if upper == "":
+            return self.raw
+        if upper == "HEADER":
+            return self.header
+        if upper in ("TEXT", "1"):
+            return self.text
+        if upper.startswith("HEADER.FIELDS"):
+            wanted = {f.upper() for f in upper[upper.index("(") + 1:upper.rindex(")")].split()}
+            lines = [f"{k}: {v}" for k, v in self.parsed.items() if k.upper() in wanted]
+            return ("\r\n".join(lines) + "\r\n\r\n").encode("utf-8", errors="replace")
+        return b""
+
+    def bodystructure(self):
+        lines = self.text.count(b"\n")
+        return f'("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "8BIT" {len(self.text)} {lines} NIL NIL NIL)'
+
+
+class MailboxState:
+    """Messages present in one mailbox: synthetic UIDs plus appended raw messages, and their flags."""
+
+    def __init__(self, name, synthetic=None, uidvalidity=1):
+        self.name = name
+        self.synthetic = synthetic
+        self.uidvalidity = uidvalidity
+        count = synthetic.count if synthetic else 0
+        self.uids = array("L", range(1, count + 1))
+        self.uidnext = count + 1
+        self.flag_bits = bytearray(count + 1)
+        if synthetic:
+            for uid in range(1, count + 1):
+                if synthetic.initially_seen(uid):
+                    self.flag_bits[uid] = 1
+        self.raw = {}
+        self.lock = threading.RLock()
+        self.changes = 0
+        self._built = OrderedDict()
+
+    # --- Contents ---
+
+    def message(self, uid):
+        if uid in self.raw:
+            return self.raw[uid]
+        built = self._built.get(uid)
+        if built is None:
+            built = self.synthetic.message(uid)
+            self._built[uid] = built
+            while len(self._built) > 256:
+                self._built.popitem(last=False)
+        else:
+            self._built.move_to_end(uid)
+        return built
+
+    def date(self, uid):
+        return self.raw[uid].date if uid in self.raw else self.synthetic.date(uid)
+
+    def flags(self, uid):
+        bits = self.flag_bits[uid]
+        return [flag for flag, bit in FLAG_BITS.items() if bits & bit]
+
+    def seq(self, uid):
+        return bisect.bisect_left(self.uids, uid) + 1
+
+    def deliver(self, count=1):
+        """Adds `count` new synthetic messages (new mail arriving); returns their UIDs."""
+        with self.lock:
+            new = []
+            for _ in range(count):
+                uid = self.uidnext
+                self.synthetic.count = max(self.synthetic.count, uid)
+                self.uids.append(uid)
+                self.flag_bits.append(0)
+                self.uidnext += 1
+                new.append(uid)
+            self.changes += 1
+            return new
+
+    def append(self, raw, flags=()):
+        with self.lock:
+            uid = self.uidnext
+            self.raw[uid] = RawMessage(uid, raw)
+            self.uids.append(uid)
+            self.flag_bits.append(sum(FLAG_BITS.get(f, 0) for f in flags))
+            self.uidnext += 1
+            self.changes += 1
+            return uid
+
+    def expunge(self, uids=None):
+        """Removes \\Deleted messages (only those in `uids` if given); returns their sequence numbers, highest first."""
+        with self.lock:
+            doomed = [u for u in self.uids if self.flag_bits[u] & 4 and (uids is None or u in uids)]
+            seqs = sorted((self.seq(u) for u in doomed), reverse=True)
+            for seq in seqs:
+                del self.uids[seq - 1]
+            for uid in doomed:
+                self.raw.pop(uid, None)
+            if doomed:
+                self.changes += 1
+            return seqs
+
+    # --- Search ---
+
+    def sender_text(self, uid):
+        if uid in self.raw:
+            return self.raw[uid].parsed.get("From", "")
+        name, address = self.synthetic.sender(uid)
+        return f"{name} <{address}>"
+
+    def subject_text(self, uid):
+        if uid in self.raw:
+            return self.raw[uid].parsed.get("Subject", "")
+        return self.synthetic.subject(uid)
+
+    def body_text(self, uid):
+        if uid in self.raw:
+            return self.raw[uid].text.decode("utf-8", errors="replace")
+        return self.synthetic.body_text(uid)
+
+
+class MailStore:
+    """All mailboxes of the fake server (shared by every account that logs in)."""
+
+    def __init__(self, messages=1000, seed=1, attachment_ratio=0.2, max_attachment_bytes=256 * 1024):
+        inbox = SyntheticMailbox(messages, seed=seed, attachment_ratio=attachment_ratio,
+                                 max_attachment_bytes=max_attachment_bytes)
+        # Sent mail is a smaller synthetic folder of its own, so cross-folder reads have two sides
+        sent = SyntheticMailbox(max(1, messages // 10), seed=seed + 1, attachment_ratio=attachment_ratio,
+                                max_attachment_bytes=max_attachment_bytes, unread_ratio=0.0)
+        self.mailboxes = {"INBOX": MailboxState("INBOX", inbox), "[Gmail]/Sent Mail": MailboxState("[Gmail]/Sent Mail", sent)}
+        for name in ("[Gmail]/Drafts", "Archive"):
+            self.mailboxes[name] = MailboxState(name)
+        # SPECIAL-USE attributes reported by LIST
+        self.special_use = {"[Gmail]/Sent Mail": "\\Sent", "[Gmail]/Drafts": "\\Drafts", "Archive": "\\Archive"}
+        self.lock = threading.Lock()
+
+    def get(self, name, create=False):
+        name = _mailbox_name(name)
+        with self.lock:
+            box = self.mailboxes.get(name)
+            if box is None and create:
+                box = self.mailboxes[name] = MailboxState(name)
+            return box
+
+
+class ServerStats:
+    """Wire counters: connections, commands (round trips) by name, bytes each way."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connections = 0
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.commands = Counter()
+
+    def add(self, command=None, bytes_in=0, bytes_out=0, connection=False):
+        with self._lock:
+            if command:
+                self.commands[command] += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.connections += connection
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "connections": self.connections,
+                "round_trips": sum(self.commands.values()),
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "commands": dict(self.commands),
+            }
+
+
+def _mailbox_name(name):
+    name = name.strip('"')
+    return "INBOX" if name.upper() == "INBOX" else name
+
+
+def _parse_set(text, highest):
+    """An IMAP sequence/UID set as a list of (low, high) ranges ("*" is `highest`)."""
+    ranges = []
+    for piece in text.split(","):
+        low, _, high = piece.partition(":")
+        low = highest if low == "*" else int(low)
+        high = low if not high else (highest if high == "*" else int(high))
+        ranges.append((min(low, high), max(low, high)))
+    return ranges
+
+
+def _in_ranges(value, ranges):
+    return any(low <= value <= high for low, high in ranges)
+
+
+def _search_date(text):
+    for fmt in _SEARCH_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, fmt).date()
+        except ValueError:
+            continue
+    raise ValueError(f"bad date {text!r}")
+
+
+def _tokens(text):
+    tokens = []
+    for quoted, opening, closing, atom in _TOKEN.findall(text):
+        if opening:
+            tokens.append("(")
+        elif closing:
+            tokens.append(")")
+        elif atom:
+            tokens.append(atom)
+        else:
+            tokens.append(Quoted(quoted.replace('\\"', '"')))
+    return tokens
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    """One client connection."""
+
+    def setup(self):
+        super().setup()
+        # Responses go out in several writes; don't let Nagle hold them back
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.selected = None
+        self.readonly = False
+        self.user = None
+
+    # --- Wire ---
+
+    def send(self, data):
+        self.server.stats.add(bytes_out=len(data))
+        self.wfile.write(data)
+
+    def read_line(self):
+        line = self.rfile.readline()
+        self.server.stats.add(bytes_in=len(line))
+        return line
+
+    def read_command(self):
+        """A full command line with any literals inlined (as {n}\\r\\n<data> like on the wire)."""
+        line = self.read_line()
+        if not line:
+            return None
+        while True:
+            literal = _LITERAL.search(line)
+            if not literal:
+                return line
+            if not literal.group(0).startswith(b"{" + literal.group(1) + b"+"):
+                self.send(b"+ Ready for literal\r\n")
+            data = self.rfile.read(int(literal.group(1)))
+            self.server.stats.add(bytes_in=len(data))
+            line += data
+            line += self.read_line()
+
+    def handle(self):
+        self.server.stats.add(connection=True)
+        try:
+            self.serve_commands()
+        except (ConnectionError, BrokenPipeError):
+            pass
+
+    def serve_commands(self):
+        self.send(b"* OK Fake IMAP server ready\r\n")
+        while True:
+            line = self.read_command()
+            if not line:
+                return
+            tag, _, rest = line.decode("utf-8", errors="replace").rstrip("\r\n").partition(" ")
+            command, _, args = rest.partition(" ")
+            command = command.upper()
+            use_uid = command == "UID"
+            if use_uid:
+                command, _, args = args.partition(" ")
+                command = command.upper()
+            self.server.stats.add(command=("UID " if use_uid else "") + command)
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            try:
+                done = self.dispatch(tag, command, args, use_uid, line)
+            except Exception as e:
+                self.send(f"{tag} BAD {type(e).__name__}: {e}\r\n".encode())
+                continue
+            if done:
+                return
+
+    def dispatch(self, tag, command, args, use_uid, line):
+        handler = getattr(self, f"cmd_{command.lower()}", None)
+        if handler is None:
+            self.send(f"{tag} BAD Unknown command {command}\r\n".encode())
+            return False
+        if command not in ("CAPABILITY", "LOGIN", "LOGOUT", "NOOP") and self.user is None:
+            self.send(f"{tag} NO Not authenticated\r\n".encode())
+            return False
+        if command in ("FETCH", "SEARCH", "STORE", "EXPUNGE", "COPY", "MOVE", "CLOSE") and self.selected is None:
+            self.send(f"{tag} BAD No mailbox selected\r\n".encode())
+            return False
+        if command == "APPEND":
+            return handler(tag, line)
+        return handler(tag, args, use_uid) if command in ("FETCH", "SEARCH", "STORE", "EXPUNGE", "COPY", "MOVE") \
+            else handler(tag, args)
+
+    # --- Session ---
+
+    def cmd_capability(self, tag, args):
+        self.send(f"* CAPABILITY {self.server.capabilities}\r\n{tag} OK CAPABILITY completed\r\n".encode())
+
+    def cmd_login(self, tag, args):
+        tokens = _tokens(args)
+        if len(tokens) != 2 or (self.server.password is not None and tokens[1] != self.server.password):
+            self.send(f"{tag} NO [AUTHENTICATIONFAILED] Invalid credentials\r\n".encode())
+            return
+        self.user = tokens[0]
+        self.send(f"{tag} OK [CAPABILITY {self.server.capabilities}] Logged in\r\n".encode())
+
+    def cmd_logout(self, tag, args):
+        self.send(f"* BYE Logging out\r\n{tag} OK LOGOUT completed\r\n".encode())
+        return True
+
+    def cmd_noop(self, tag, args):
+        self.send(f"{tag} OK NOOP completed\r\n".encode())
+
+    def cmd_list(self, tag, args):
+        store = self.server.store
+        out = "".join(
+            f'* LIST (\\HasNoChildren{" " + store.special_use[name] if name in store.special_use else ""}) "/" "{name}"\r\n'
+            for name in store.mailboxes
+        )
+        self.send(f"{out}{tag} OK LIST completed\r\n".encode())
+
+    def cmd_select(self, tag, args, readonly=False):
+        box = self.server.store.get(_tokens(args)[0])
+        if box is None:
+            self.send(f"{tag} NO [NONEXISTENT] No such mailbox\r\n".encode())
+            return
+        self.selected, self.readonly = box, readonly
+        with box.lock:
+            out = (
+                f"* FLAGS ({' '.join(FLAG_BITS)})\r\n"
+                f"* {len(box.uids)} EXISTS\r\n* 0 RECENT\r\n"
+                f"* OK [UIDVALIDITY {box.uidvalidity}] UIDs valid\r\n"
+                f"* OK [UIDNEXT {box.uidnext}] Predicted next UID\r\n"
+                f"{tag} OK [{'READ-ONLY' if readonly else 'READ-WRITE'}] {'EXAMINE' if readonly else 'SELECT'} completed\r\n"
+            )
+        self.send(out.encode())
+
+    def cmd_examine(self, tag, args):
+        self.cmd_select(tag, args, readonly=True)
+
+    def cmd_close(self, tag, args):
+        if not self.readonly:
+            self.selected.expunge()
+        self.selected = None
+        self.send(f"{tag} OK CLOSE completed\r\n".encode())
+
+    def cmd_status(self, tag, args):
+        tokens = _tokens(args)
+        box = self.server.store.get(tokens[0])
+        if box is None:
+            self.send(f"{tag} NO [NONEXISTENT] No such mailbox\r\n".encode())
+            return
+        values = {
+            "MESSAGES": lambda: len(box.uids),
+            "UIDNEXT": lambda: box.uidnext,
+            "UIDVALIDITY": lambda: box.uidvalidity,
+            "UNSEEN": lambda: sum(1 for u in box.uids if not box.flag_bits[u] & 1),
+            "RECENT": lambda: 0,
+        }
+        with box.lock:
+            items = " ".join(f"{item.upper()} {values[item.upper()]()}" for item in tokens[1:] if item.upper() in values)
+        self.send(f'* STATUS "{box.name}" ({items})\r\n{tag} OK STATUS completed\r\n'.encode())
+
+    def cmd_idle(self, tag, args):
+        box = self.selected
+        self.send(b"+ idling\r\n")
+        seen = box.changes if box else 0
+        while True:
+            if box is not None and box.changes != seen:
+                seen = box.changes
+                self.send(f"* {len(box.uids)} EXISTS\r\n".encode())
+            # Nothing else is buffered while idling, so waiting on the socket is safe
+            readable, _, _ = select.select([self.connection], [], [], 0.2)
+            if not readable:
+                continue
+            line = self.read_line()
+            if not line or line.strip().upper() == b"DONE":
+                break
+        self.send(f"{tag} OK IDLE terminated\r\n".encode())
+
+    def cmd_append(self, tag, line):
+        match = re.match(rb"\S+ APPEND (\"[^\"]*\"|\S+)(?: \(([^)]*)\))?(?: \"[^\"]*\")? \{(\d+)\+?\}\r\n", line, re.IGNORECASE)
+        if not match:
+            self.send(f"{tag} BAD Malformed APPEND\r\n".encode())
+            return
+        box = self.server.store.get(match.group(1).decode(), create=True)
+        flags = match.group(2).decode().split() if match.group(2) else []
+        raw = line[match.end():match.end() + int(match.group(3))]
+        uid = box.append(raw, flags)
+        self.send(f"{tag} OK [APPENDUID {box.uidvalidity} {uid}] APPEND completed\r\n".encode())
+
+    # --- Selected state ---
+
+    def _resolve(self, set_text, use_uid):
+        """Messages (uids) named by a UID or sequence set."""
+        box = self.selected
+        if use_uid:
+            highest = box.uids[-1] if box.uids else 0
+            uids = []
+            for low, high in _parse_set(set_text, highest):
+                start = bisect.bisect_left(box.uids, low)
+                end = bisect.bisect_right(box.uids, high)
+                uids.extend(box.uids[start:end])
+            return sorted(set(uids))
+        ranges = _parse_set(set_text, len(box.uids))
+        return sorted({box.uids[s - 1] for low, high in ranges for s in range(max(1, low), min(high, len(box.uids)) + 1)})
+
+    def cmd_search(self, tag, args, use_uid):
+        box = self.selected
+        tokens = _tokens(args)
+        if tokens and tokens[0].upper() == "CHARSET":
+            tokens = tokens[2:]
+        with box.lock:
+            candidates = box.uids
+            # Narrow by top-level UID sets first so "UID 500:*" doesn't scan the whole mailbox
+            depth = 0
+            for i, token in enumerate(tokens[:-1]):
+                depth += (token == "(") - (token == ")")
+                if depth == 0 and token.upper() == "UID" and (i == 0 or tokens[i - 1].upper() not in ("NOT", "OR")):
+                    candidates = self._resolve(tokens[i + 1], True)
+            position = [0]
+            matcher = self._criteria(tokens, position, box)
+            found = [u for u in candidates if matcher(u)]
+            result = found if use_uid else [box.seq(u) for u in found]
+        self.send(f"* SEARCH{''.join(f' {n}' for n in result)}\r\n{tag} OK SEARCH completed\r\n".encode())
+
+    def _criteria(self, tokens, position, box):
+        tests = []
+        while position[0] < len(tokens) and tokens[position[0]] != ")":
+            tests.append(self._criterion(tokens, position, box))
+        return lambda uid: all(test(uid) for test in tests)
+
+    def _criterion(self, tokens, position, box):
+        token = tokens[position[0]]
+        position[0] += 1
+        key = token.upper() if not isinstance(token, Quoted) else token
+
+        def argument():
+            value = tokens[position[0]]
+            position[0] += 1
+            return value
+
+        if key == "(":
+            test = self._criteria(tokens, position, box)
+            position[0] += 1
+            return test
+        if key == "ALL":
+            return lambda uid: True
+        if key == "NOT":
+            inner = self._criterion(tokens, position, box)
+            return lambda uid: not inner(uid)
+        if key == "OR":
+            left, right = self._criterion(tokens, position, box), self._criterion(tokens, position, box)
+            return lambda uid: left(uid) or right(uid)
+        flag_tests = {"SEEN": 1, "FLAGGED": 2, "DELETED": 4, "ANSWERED": 8, "DRAFT": 16}
+        if key in flag_tests:
+            return lambda uid, bit=flag_tests[key]: bool(box.flag_bits[uid] & bit)
+        if key.startswith("UN") and key[2:] in flag_tests:
+            return lambda uid, bit=flag_tests[key[2:]]: not box.flag_bits[uid] & bit
+        if key in ("FROM", "SUBJECT", "TEXT", "BODY", "TO"):
+            needle = argument().lower()
+            fields = {
+                "FROM": (box.sender_text,),
+                "SUBJECT": (box.subject_text,),
+                "BODY": (box.body_text,),
+                "TEXT": (box.subject_text, box.sender_text, box.body_text),
+                "TO": (lambda uid: "Benchmark User <bench@example.com>",),
+            }[key]
+            return lambda uid: any(needle in field(uid).lower() for field in fields)
+        if key in ("SINCE", "BEFORE", "ON", "SENTSINCE", "SENTBEFORE", "SENTON"):
+            day = _search_date(argument())
+            compare = {"SINCE": day.__le__, "BEFORE": day.__gt__, "ON": day.__eq__}[key.replace("SENT", "")]
+            return lambda uid: compare(box.date(uid).date())
+        if key == "UID":
+            ranges = _parse_set(argument(), box.uids[-1] if box.uids else 0)
+            return lambda uid: _in_ranges(uid, ranges)
+        if re.match(r"^[\d*:,]+$", key):
+            ranges = _parse_set(key, len(box.uids))
+            return lambda uid: _in_ranges(box.seq(uid), ranges)
+        raise ValueError(f"unsupported search key {token}")
+
+    def cmd_fetch(self, tag, args, use_uid):
+        set_text, _, items = args.partition(" ")
+        if "CHANGEDSINCE" in items.upper():
+            raise ValueError("CHANGEDSINCE needs CONDSTORE, which is not offered")
+        items = items.strip()
+        if items.startswith("(") and items.endswith(")"):
+            items = items[1:-1]
+        requested = _FETCH_ITEM.findall(items)
+        box = self.selected
+        for uid in self._resolve(set_text, use_uid):
+            self.send(self._fetch_one(box, uid, requested, use_uid))
+        self.send(f"{tag} OK FETCH completed\r\n".encode())
+
+    def _fetch_one(self, box, uid, requested, use_uid):
+        with box.lock:
+            seq = box.seq(uid)
+            parts = [f"UID {uid}".encode()] if use_uid else []
+            for body, section, offset, length, atom in requested:
+                atom = atom.upper()
+                if body:
+                    data = box.message(uid).section(section)
+                    if offset:
+                        data = data[int(offset):int(offset) + int(length)] if length else data[int(offset):]
+                    origin = f"<{offset}>" if offset else ""
+                    if body.upper() == "BODY":
+                        box.flag_bits[uid] |= 1
+                    parts.append(f"BODY[{section}]{origin} {{{len(data)}}}\r\n".encode() + data)
+                elif atom == "UID":
+                    if not use_uid:
+                        parts.append(f"UID {uid}".encode())
+                elif atom == "FLAGS":
+                    parts.append(f"FLAGS ({' '.join(box.flags(uid))})".encode())
+                elif atom == "BODYSTRUCTURE":
+                    parts.append(f"BODYSTRUCTURE {box.message(uid).root.bodystructure() if uid not in box.raw else box.raw[uid].bodystructure()}".encode())
+                elif atom == "RFC822.SIZE":
+                    parts.append(f"RFC822.SIZE {box.message(uid).size}".encode())
+                elif atom == "INTERNALDATE":
+                    parts.append(f'INTERNALDATE "{box.date(uid).strftime("%d-%b-%Y %H:%M:%S %z")}"'.encode())
+                elif atom in ("RFC822", "RFC822.HEADER", "RFC822.TEXT"):
+                    section = {"RFC822": "", "RFC822.HEADER": "HEADER", "RFC822.TEXT": "TEXT"}[atom]
+                    data = box.message(uid).section(section)
+                    parts.append(f"{atom} {{{len(data)}}}\r\n".encode() + data)
+            return f"* {seq} FETCH (".encode() + b" ".join(parts) + b")\r\n"
+
+    def cmd_store(self, tag, args, use_uid):
+        set_text, operation, flags = args.split(" ", 2)
+        operation = operation.upper()
+        if "X-GM-" in operation:
+            # What non-Gmail servers answer to Gmail label operations
+            self.send(f"{tag} BAD Invalid STORE item {operation}\r\n".encode())
+            return
+        bits = sum(FLAG_BITS.get(f, 0) for f in flags.strip("()").split())
+        box = self.selected
+        out = []
+        with box.lock:
+            for uid in self._resolve(set_text, use_uid):
+                if operation.startswith("+"):
+                    box.flag_bits[uid] |= bits
+                elif operation.startswith("-"):
+                    box.flag_bits[uid] &= ~bits & 0xFF
+                else:
+                    box.flag_bits[uid] = bits
+                if not operation.endswith(".SILENT"):
+                    uid_item = f"UID {uid} " if use_uid else ""
+                    out.append(f"* {box.seq(uid)} FETCH ({uid_item}FLAGS ({' '.join(box.flags(uid))}))\r\n")
+            box.changes += 1
+        self.send(("".join(out) + f"{tag} OK STORE completed\r\n").encode())
+
+    def cmd_expunge(self, tag, args, use_uid):
+        uids = set(self._resolve(args.strip(), True)) if use_uid else None
+        seqs = self.selected.expunge(uids)
+        self.send(("".join(f"* {s} EXPUNGE\r\n" for s in seqs) + f"{tag} OK EXPUNGE completed\r\n").encode())
+
+    def cmd_copy(self, tag, args, use_uid, move=False):
+        set_text, _, target = args.partition(" ")
+        destination = self.server.store.get(target, create=True)
+        source = self.selected
+        uids = self._resolve(set_text, use_uid)
+        for uid in uids:
+            destination.append(source.message(uid).raw, source.flags(uid))
+        if move:
+            with source.lock:
+                for uid in uids:
+                    source.flag_bits[uid] |= 4
+            seqs = source.expunge(set(uids))
+            self.send("".join(f"* {s} EXPUNGE\r\n" for s in seqs).encode())
+        self.send(f"{tag} OK {'MOVE' if move else 'COPY'} completed\r\n".encode())
+
+    def cmd_move(self, tag, args, use_uid):
+        self.cmd_copy(tag, args, use_uid, move=True)
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    """Serves a MailStore on localhost; `port=0` picks a free port (see `.port`).
+
+    `latency` (seconds) is added to every command to simulate a network
+    round trip; `password=None` accepts any credentials.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, store, host="127.0.0.1", port=0, latency=0.0, password=None, idle=True):
+        super().__init__((host, port), IMAPHandler)
+        self.store = store
+        self.latency = latency
+        self.password = password
+        self.stats = ServerStats()
+        self.capabilities = "IMAP4rev1 UIDPLUS MOVE LITERAL+" + (" IDLE" if idle else "")
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-imap", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,163 @@
+import random
+import re
+import socket
+import socketserver
+import threading
+import time
+from email import message_from_bytes
+
+from bench.fake_imap import ServerStats
+
+_PATH = re.compile(r"<([^>]*)>")
+
+# A local SMTP sink: accepts AUTH PLAIN/LOGIN and any envelope, records
+# every message it receives and never relays anything.
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send(self, line):
+        data = line.encode() + b"\r\n"
+        self.server.stats.add(bytes_out=len(data))
+        self.wfile.write(data)
+
+    def read_line(self):
+        line = self.rfile.readline()
+        self.server.stats.add(bytes_in=len(line))
+        return line
+
+    def handle(self):
+        self.server.stats.add(connection=True)
+        try:
+            self.serve_commands()
+        except (ConnectionError, BrokenPipeError):
+            pass
+
+    def serve_commands(self):
+        self.send("220 fake-smtp ESMTP ready")
+        sender, recipients = None, []
+        while True:
+            line = self.read_line()
+            if not line:
+                return
+            text = line.decode("utf-8", errors="replace").rstrip("\r\n")
+            verb, _, argument = text.partition(" ")
+            verb = verb.upper()
+            self.server.stats.add(command=verb)
+            if self.server.latency:
+                time.sleep(self.server.latency)
+
+            if verb in ("EHLO", "HELO"):
+                if verb == "EHLO":
+                    self.send("250-fake-smtp")
+                    self.send("250-8BITMIME")
+                    self.send("250-SIZE 52428800")
+                    self.send("250 AUTH PLAIN LOGIN")
+                else:
+                    self.send("250 fake-smtp")
+            elif verb == "AUTH":
+                mechanism, _, initial = argument.partition(" ")
+                if mechanism.upper() == "LOGIN":
+                    if not initial:
+                        self.send("334 VXNlcm5hbWU6")
+                        self.read_line()
+                    self.send("334 UGFzc3dvcmQ6")
+                    self.read_line()
+                elif not initial:
+                    self.send("334 ")
+                    self.read_line()
+                self.send("235 2.7.0 Authentication successful")
+            elif verb == "MAIL":
+                path = _PATH.search(argument)
+                sender, recipients = path.group(1) if path else "", []
+                self.send("250 2.1.0 OK")
+            elif verb == "RCPT":
+                path = _PATH.search(argument)
+                recipients.append(path.group(1) if path else argument[3:])
+                self.send("250 2.1.5 OK")
+            elif verb == "DATA":
+                self.send("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                while True:
+                    line = self.read_line()
+                    if not line or line == b".\r\n":
+                        break
+                    lines.append(line[1:] if line.startswith(b"..") else line)
+                if self.server.reject_ratio and random.random() < self.server.reject_ratio:
+                    self.send("451 4.3.0 Try again later")
+                else:
+                    self.server.record(sender, recipients, b"".join(lines))
+                    self.send("250 2.0.0 OK queued")
+                sender, recipients = None, []
+            elif verb == "RSET":
+                sender, recipients = None, []
+                self.send("250 2.0.0 OK")
+            elif verb == "NOOP":
+                self.send("250 2.0.0 OK")
+            elif verb == "QUIT":
+                self.send("221 2.0.0 Bye")
+                return
+            else:
+                self.send("502 5.5.2 Command not recognized")
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """Records delivered messages instead of relaying them.
+
+    `reject_ratio` answers that share of messages with a transient 451, to
+    exercise the outbox retry path; `latency` (seconds) is added per command.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, reject_ratio=0.0):
+        super().__init__((host, port), SMTPHandler)
+        self.latency = latency
+        self.reject_ratio = reject_ratio
+        self.stats = ServerStats()
+        self.received = []
+        self._received_lock = threading.Condition()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def record(self, sender, recipients, data):
+        msg = message_from_bytes(data)
+        with self._received_lock:
+            self.received.append({
+                "sender": sender,
+                "recipients": recipients,
+                "subject": msg.get("Subject", ""),
+                "message_id": msg.get("Message-ID", ""),
+                "size": len(data),
+                "at": time.monotonic(),
+            })
+            self._received_lock.notify_all()
+
+    def wait_for(self, subject, timeout=30):
+        """Waits for a message with `subject`; returns its record or None on timeout."""
+        deadline = time.monotonic() + timeout
+        with self._received_lock:
+            while True:
+                for item in self.received:
+                    if item["subject"] == subject:
+                        return item
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._received_lock.wait(remaining)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-smtp", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,371 @@
+"""Offline benchmark: runs the backend against a local IMAP server, SMTP sink and scripted model.
+
+    cd ai-email-assistant/backend
+    python -m bench --messages 10000 --iterations 20 --json bench.json
+    python -m bench --messages 10000 --baseline bench.json   # exits 1 on regressions
+    python -m bench --messages 100000 --json run.json --output run.txt   # large-mailbox run, both reports kept
+
+Reports per-endpoint and per-tool latency percentiles, IMAP/SMTP round
+trips and bytes per call, and model calls per agent turn.
+"""
+import argparse
+import contextvars
+import json
+import math
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from bench.fake_gemini import FakeGenerativeModel
+from bench.fake_imap import FakeIMAPServer, MailStore
+from bench.fake_smtp import FakeSMTPServer
+from bench.scenarios import AGENT_SCRIPTS, ENDPOINT_CASES, TOOL_CASES
+
+ACCOUNT = ("bench@example.com", "bench-password")
+# Newest messages per folder the backend keeps locally; older pages come from the server
+SYNC_WINDOW = 500
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Recorder:
+    """Latency samples and wire counters per benchmark case."""
+
+    def __init__(self, imap, smtp, model):
+        self.counters = {"imap": imap.stats, "smtp": smtp.stats, "model": model.stats}
+        self.cases = {}
+
+    def _snapshot(self):
+        return {name: stats.snapshot() for name, stats in self.counters.items()}
+
+    def settle(self, quiet=0.05, timeout=2.0):
+        """Waits until background work (sync passes after a change, outbox delivery) stops touching the servers.
+
+        Keeps that traffic out of the next case's counters.
+        """
+        deadline = time.monotonic() + timeout
+        last = self._snapshot()
+        while time.monotonic() < deadline:
+            time.sleep(quiet)
+            current = self._snapshot()
+            if current == last:
+                return
+            last = current
+
+    def measure(self, name, function, is_error=None):
+        """Runs `function()` once, recording its latency and the traffic it caused; returns its result.
+
+        Exceptions, and results `is_error(result)` flags, count as errors.
+        """
+        self.settle()
+        before = self._snapshot()
+        started = time.perf_counter()
+        error = None
+        try:
+            result = function()
+        except Exception as e:
+            result, error = None, e
+        elapsed = (time.perf_counter() - started) * 1000
+        after = self._snapshot()
+
+        case = self.cases.setdefault(name, {"ms": [], "imap_round_trips": [], "imap_bytes_down": [], "imap_bytes_up": [],
+                                            "smtp_round_trips": [], "model_calls": [], "response_bytes": [], "errors": 0})
+        case["ms"].append(elapsed)
+        case["imap_round_trips"].append(after["imap"]["round_trips"] - before["imap"]["round_trips"])
+        case["imap_bytes_down"].append(after["imap"]["bytes_out"] - before["imap"]["bytes_out"])
+        case["imap_bytes_up"].append(after["imap"]["bytes_in"] - before["imap"]["bytes_in"])
+        case["smtp_round_trips"].append(after["smtp"]["round_trips"] - before["smtp"]["round_trips"])
+        case["model_calls"].append(after["model"]["calls"] - before["model"]["calls"])
+        if error is None and is_error is not None and is_error(result):
+            error = RuntimeError(str(result)[:200])
+        if error is not None:
+            case["errors"] += 1
+            case["last_error"] = f"{type(error).__name__}: {error}"
+        elif isinstance(result, (bytes, str)):
+            case["response_bytes"].append(len(result))
+        return result
+
+    def summary(self):
+        out = {}
+        for name, case in self.cases.items():
+            n = len(case["ms"])
+            if not n:
+                out[name] = {"n": 0, "errors": case["errors"]}
+                continue
+            mean = lambda key: sum(case[key]) / len(case[key]) if case[key] else 0
+            out[name] = {
+                "n": n,
+                "p50_ms": percentile(case["ms"], 0.50),
+                "p90_ms": percentile(case["ms"], 0.90),
+                "p99_ms": percentile(case["ms"], 0.99),
+                "max_ms": max(case["ms"]),
+                "mean_ms": sum(case["ms"]) / n,
+                "imap_round_trips": mean("imap_round_trips"),
+                "imap_bytes_down": mean("imap_bytes_down"),
+                "imap_bytes_up": mean("imap_bytes_up"),
+                "smtp_round_trips": mean("smtp_round_trips"),
+                "model_calls": mean("model_calls"),
+                "response_bytes": mean("response_bytes"),
+                "errors": case["errors"],
+            }
+            if "last_error" in case:
+                out[name]["last_error"] = case["last_error"]
+        return out
+
+
+def mailbox_facts(store, iterations):
+    """UIDs the scenarios refer to: the newest message, one with an attachment, Alice's newest, a long thread's,
+    and a page cursor older than the synced window."""
+    inbox = store.get("INBOX")
+    latest = inbox.uids[-1]
+    facts = {"latest": latest, "iterations": iterations, "deep_before": max(2, latest - 2 * SYNC_WINDOW)}
+    for uid in range(latest, 0, -1):
+        message = inbox.message(uid)
+        attachments = [p for p in _leaves(message.root) if p[1].disposition == "attachment"]
+        if attachments:
+            facts["attachment_uid"], facts["attachment_part"] = uid, attachments[0][0]
+            break
+    for uid in range(latest, 0, -1):
+        if inbox.synthetic.sender(uid)[0] == "Alice":
+            facts["alice_latest"] = uid
+            break
+    facts["thread_uid"] = next(
+        (uid for uid in range(latest, 0, -1) if len(inbox.synthetic.references(uid)) >= 2), latest
+    )
+    return facts
+
+
+def _leaves(part, number=""):
+    if not part.children:
+        return [(number or "1", part)]
+    leaves = []
+    for index, child in enumerate(part.children, start=1):
+        leaves.extend(_leaves(child, f"{number}.{index}" if number else str(index)))
+    return leaves
+
+
+def fill(value, facts, iteration=0):
+    """Resolves "{placeholders}" and per-iteration callables in scenario arguments."""
+    if callable(value):
+        return value(iteration, facts)
+    if isinstance(value, str):
+        return value.format(**facts)
+    if isinstance(value, dict):
+        return {k: fill(v, facts, iteration) for k, v in value.items()}
+    if isinstance(value, list):
+        return [fill(v, facts, iteration) for v in value]
+    return value
+
+
+def configure_environment(args, imap, smtp, workdir):
+    os.environ.update({
+        "IMAP_HOST": "127.0.0.1", "IMAP_PORT": str(imap.port), "IMAP_SSL": "0",
+        "SMTP_HOST": "127.0.0.1", "SMTP_PORT": str(smtp.port), "SMTP_SSL": "0",
+        "MAIL_CACHE_PATH": os.path.join(workdir, "mail_cache.db"),
+        "OUTBOX_PATH": os.path.join(workdir, "outbox.db"),
+        "SESSION_BACKEND": "memory",
+        "SYNC_INTERVAL": "3600",
+        "SYNC_MAILBOXES": "inbox,sent",
+        "SYNC_WINDOW": str(SYNC_WINDOW),
+        "SEMANTIC_EMBEDDER": "hashing",
+        "MEMORY_SUMMARIZER": "extractive",
+        "GEMINI_CONTEXT_CACHE": "0",
+    })
+    if args.no_tool_cache:
+        os.environ["TOOL_CACHE_TTL"] = "0"
+
+
+def start_api(app):
+    import uvicorn
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", access_log=False))
+    thread = threading.Thread(target=server.run, name="bench-api", daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 30
+    while not server.started:
+        if time.monotonic() > deadline:
+            raise RuntimeError("API server did not start")
+        time.sleep(0.05)
+    return server, f"http://127.0.0.1:{port}"
+
+
+def bench_endpoints(recorder, http, base, headers, facts, iterations):
+    for label, method, path in ENDPOINT_CASES:
+        url = base + fill(path, facts)
+        for _ in range(iterations):
+            recorder.measure(label, lambda: _checked(http.request(method, url, headers=headers)).content)
+
+
+def bench_agent(recorder, http, base, headers, iterations):
+    for script in AGENT_SCRIPTS:
+        body = {"command": script["command"], "gemini_key": "bench", "model": "bench-model"}
+        for _ in range(iterations):
+            recorder.measure(f"POST /api/agent [{script['name']}]",
+                             lambda: _checked(http.post(base + "/api/agent", json=body, headers=headers)).content)
+        http.post(base + "/api/clear-history", headers=headers)
+
+    # Streaming adds SSE framing and per-event flushes; measure time to the final "done" event
+    script = AGENT_SCRIPTS[0]
+    body = {"command": script["command"], "gemini_key": "bench", "model": "bench-model"}
+    for _ in range(iterations):
+        recorder.measure(f"POST /api/agent/stream [{script['name']}]",
+                         lambda: _checked(http.post(base + "/api/agent/stream", json=body, headers=headers)).content)
+    http.post(base + "/api/clear-history", headers=headers)
+
+
+def bench_tools(recorder, main, session, facts, iterations, smtp):
+    main.current_session.set(session)
+    for label, tool_name, args in TOOL_CASES:
+        function = main.FUNCTION_MAP[tool_name]
+        for i in range(iterations):
+            call_args = fill(args, facts, i)
+            # Each call in a fresh copy of the context, as the agent's tool pool runs them
+            context = contextvars.copy_context()
+            recorder.measure(label, lambda: context.run(function, **call_args), is_error=main.is_error_result)
+            if tool_name == "send_email":
+                queued = time.monotonic()
+                delivered = smtp.wait_for(call_args["subject"], timeout=30)
+                case = recorder.cases.setdefault("send_email -> delivered", {"ms": [], "imap_round_trips": [], "imap_bytes_down": [],
+                                                                             "imap_bytes_up": [], "smtp_round_trips": [], "model_calls": [],
+                                                                             "response_bytes": [], "errors": 0})
+                if delivered is None:
+                    case["errors"] += 1
+                else:
+                    case["ms"].append((delivered["at"] - queued) * 1000)
+
+
+def _checked(response):
+    response.raise_for_status()
+    return response
+
+
+def format_report(summary, header):
+    columns = ["n", "p50_ms", "p90_ms", "p99_ms", "max_ms", "imap_round_trips", "imap_bytes_down", "smtp_round_trips", "model_calls", "errors"]
+    width = max(len(name) for name in summary) + 2
+    lines = [header, "", "case".ljust(width) + "".join(c.rjust(17) for c in columns)]
+    for name, row in summary.items():
+        cells = []
+        for column in columns:
+            value = row.get(column, 0)
+            cells.append((f"{value:.1f}" if isinstance(value, float) else str(value)).rjust(17))
+        lines.append(name.ljust(width) + "".join(cells))
+        if row.get("last_error"):
+            lines.append(f"{'':{width}}last error: {row['last_error']}")
+    return "\n".join(lines)
+
+
+def compare(summary, baseline, tolerance, min_delta_ms=2.0):
+    """Cases whose p50 latency grew by more than `tolerance`, or that make more round trips, than in `baseline`."""
+    regressions = []
+    for name, row in summary.items():
+        before = baseline.get(name)
+        if not before or not row["n"] or not before["n"]:
+            continue
+        if row["p50_ms"] > before["p50_ms"] * (1 + tolerance) and row["p50_ms"] - before["p50_ms"] > min_delta_ms:
+            regressions.append(f"{name}: p50 {before['p50_ms']:.1f} -> {row['p50_ms']:.1f} ms")
+        for key in ("imap_round_trips", "smtp_round_trips", "model_calls"):
+            if row[key] > before[key] + 0.5:
+                regressions.append(f"{name}: {key} {before[key]:.1f} -> {row[key]:.1f}")
+        if row["imap_bytes_down"] > before["imap_bytes_down"] * (1 + tolerance) + 1024:
+            regressions.append(f"{name}: imap_bytes_down {before['imap_bytes_down']:.0f} -> {row['imap_bytes_down']:.0f}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000, help="messages in the synthetic inbox (1k-1M)")
+    parser.add_argument("--iterations", type=int, default=20, help="samples per case")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--attachment-ratio", type=float, default=0.2)
+    parser.add_argument("--imap-latency-ms", type=float, default=0.0, help="added to every IMAP command (simulated RTT)")
+    parser.add_argument("--smtp-latency-ms", type=float, default=0.0, help="added to every SMTP command")
+    parser.add_argument("--model-latency-ms", type=float, default=0.0, help="added to every model call")
+    parser.add_argument("--only", choices=["tools", "endpoints", "agent"], action="append", help="run only these groups")
+    parser.add_argument("--no-tool-cache", action="store_true", help="disable the tool result cache")
+    parser.add_argument("--json", help="write the summary as JSON to this file")
+    parser.add_argument("--output", help="also write the text report to this file")
+    parser.add_argument("--baseline", help="JSON summary of an earlier run; exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p50/bytes growth against the baseline")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    groups = set(args.only or ["tools", "endpoints", "agent"])
+
+    started = time.perf_counter()
+    store = MailStore(args.messages, seed=args.seed, attachment_ratio=args.attachment_ratio)
+    imap = FakeIMAPServer(store, latency=args.imap_latency_ms / 1000).start()
+    smtp = FakeSMTPServer(latency=args.smtp_latency_ms / 1000).start()
+    model = FakeGenerativeModel({}, latency=args.model_latency_ms / 1000)
+    print(f"Seeded {args.messages} messages in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    workdir = tempfile.mkdtemp(prefix="email-assistant-bench-")
+    configure_environment(args, imap, smtp, workdir)
+    import main as backend
+    import requests
+
+    facts = mailbox_facts(store, args.iterations)
+    model.scripts = {s["command"]: {"steps": fill(s["steps"], facts)} for s in AGENT_SCRIPTS}
+    backend.get_agent_model = lambda api_key, model_name: model
+
+    api, base = start_api(backend.app)
+    http = requests.Session()
+    recorder = Recorder(imap, smtp, model)
+    try:
+        login = recorder.measure("POST /auth/login", lambda: _checked(http.post(base + "/auth/login", json={
+            "email": ACCOUNT[0], "password": ACCOUNT[1]})).json())
+        headers = {"Authorization": f"Bearer {login['token']}"}
+        # First sync pass, so every case starts from a synced mailbox
+        recorder.measure("initial sync", lambda: _checked(http.get(base + "/api/emails?refresh=true", headers=headers)).content)
+
+        if "endpoints" in groups:
+            bench_endpoints(recorder, http, base, headers, facts, args.iterations)
+        if "agent" in groups:
+            bench_agent(recorder, http, base, headers, args.iterations)
+        if "tools" in groups:
+            session = backend.session_store.get(login["token"])
+            bench_tools(recorder, backend, session, facts, args.iterations, smtp)
+    finally:
+        api.should_exit = True
+        backend.outbox.stop()
+        backend.mail_accounts.close_all()
+        imap.stop()
+        smtp.stop()
+
+    summary = recorder.summary()
+    report = format_report(summary, (
+        f"{args.messages} messages, {args.iterations} iterations, IMAP latency {args.imap_latency_ms} ms, "
+        f"model latency {args.model_latency_ms} ms, tool cache {'off' if args.no_tool_cache else 'on'}"
+    ))
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(summary, json.load(f), args.tolerance)
+        if regressions:
+            print("\nRegressions against the baseline:\n" + "\n".join(f"  {r}" for r in regressions))
+            return 1
+        print("\nNo regressions against the baseline.")
+    return 0
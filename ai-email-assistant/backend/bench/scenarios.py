@@ -0,0 +1,91 @@
+# What the benchmark runs. "{latest}", "{attachment_uid}" etc. are filled in
+# from the seeded mailbox before the run (see run.mailbox_facts).
+
+# Scripted agent turns: the fake model asks for these tool calls, step by step
+AGENT_SCRIPTS = [
+    {
+        "name": "summarize_inbox",
+        "command": "Summarize my latest emails",
+        "steps": [
+            [{"name": "fetch_emails", "args": {"limit": 10}}],
+            "Here is a summary of your 10 latest emails.",
+        ],
+    },
+    {
+        "name": "triage_unread",
+        "command": "How many unread emails do I have and what is the newest one about?",
+        "steps": [
+            [{"name": "count_unread", "args": {}}, {"name": "fetch_emails", "args": {"limit": 5}}],
+            [{"name": "get_email_details", "args": {"email_id": "{latest}"}}],
+            "You have some unread emails; the newest one is about a delivery.",
+        ],
+    },
+    {
+        "name": "search_and_read",
+        "command": "Find invoices from Alice and open the most recent",
+        "steps": [
+            [{"name": "search_emails", "args": {"sender": "alice", "query": "invoice"}}],
+            [{"name": "get_email_details", "args": {"email_id": "{alice_latest}"}}],
+            "The most recent invoice from Alice is due Friday.",
+        ],
+    },
+    {
+        "name": "read_attachment",
+        "command": "What's in the attachment of that email?",
+        "steps": [
+            [{"name": "get_email_details", "args": {"email_id": "{attachment_uid}"}}],
+            [{"name": "get_attachment", "args": {"email_id": "{attachment_uid}", "part": "{attachment_part}"}}],
+            "The attachment is a spreadsheet export.",
+        ],
+    },
+    {
+        "name": "reply",
+        "command": "Reply to the latest email saying thanks",
+        "steps": [
+            [{"name": "fetch_emails", "args": {"limit": 1}}],
+            [{"name": "reply_to_email", "args": {"email_id": "{latest}", "reply_body": "Thanks!"}}],
+            "Reply queued.",
+        ],
+    },
+]
+
+# Direct tool calls: (label, tool name, args). An argument may be a callable of
+# (iteration, facts), for tools that must not hit the same message twice.
+TOOL_CASES = [
+    ("fetch_emails limit=10", "fetch_emails", {"limit": 10}),
+    ("fetch_emails limit=50", "fetch_emails", {"limit": 50}),
+    ("fetch_emails all folders", "fetch_emails", {"limit": 20, "mailbox": "*"}),
+    ("fetch_emails page beyond sync window", "fetch_emails", {"limit": 20, "before": "{deep_before}"}),
+    ("count_unread", "count_unread", {}),
+    ("search_emails sender", "search_emails", {"sender": "alice"}),
+    ("search_emails text", "search_emails", {"query": "invoice"}),
+    ("search_emails all folders", "search_emails", {"query": "invoice", "mailbox": "*"}),
+    ("semantic_search", "semantic_search", {"query": "quarterly budget numbers"}),
+    ("get_email_details cold", "get_email_details", {"email_id": lambda i, f: str(f["latest"] - 1 - i)}),
+    ("get_email_details cached", "get_email_details", {"email_id": "{latest}"}),
+    ("get_thread", "get_thread", {"email_id": "{thread_uid}"}),
+    ("get_attachment", "get_attachment", {"email_id": "{attachment_uid}", "part": "{attachment_part}"}),
+    ("extract_contacts", "extract_contacts", {"limit": 20}),
+    ("mark_as_read", "mark_as_read", {"email_id": "{latest}"}),
+    ("mark_as_unread", "mark_as_unread", {"email_id": "{latest}"}),
+    ("star_email", "star_email", {"email_id": "{latest}"}),
+    ("bulk_email_action mark_read x100", "bulk_email_action",
+     {"action": "mark_read", "email_ids": lambda i, f: [str(u) for u in range(f["latest"] - 100, f["latest"])]}),
+    ("delete_email", "delete_email", {"email_id": lambda i, f: str(1 + i)}),
+    ("archive_email", "archive_email", {"email_id": lambda i, f: str(1 + f["iterations"] + i)}),
+    ("create_draft", "create_draft", {"to_email": "someone@example.com", "subject": "Draft", "body": "Hello"}),
+    ("send_email", "send_email", {"to_email": "someone@example.com", "subject": lambda i, f: f"bench-send-{i}", "body": "Hello"}),
+]
+
+# HTTP endpoints: (label, method, path template)
+ENDPOINT_CASES = [
+    ("GET /api/status", "GET", "/api/status"),
+    ("GET /api/emails", "GET", "/api/emails"),
+    ("GET /api/emails?refresh=true", "GET", "/api/emails?refresh=true"),
+    ("GET /api/emails?mailbox=*", "GET", "/api/emails?mailbox=*"),
+    ("GET /api/emails?before= (beyond sync window)", "GET", "/api/emails?before={deep_before}"),
+    ("GET /api/mailboxes", "GET", "/api/mailboxes"),
+    ("GET thread", "GET", "/api/emails/{thread_uid}/thread"),
+    ("GET attachment download", "GET", "/api/emails/{attachment_uid}/attachments/{attachment_part}"),
+    ("GET /api/outbox", "GET", "/api/outbox"),
+]
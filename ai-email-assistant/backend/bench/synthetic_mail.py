@@ -0,0 +1,278 @@
+import base64
+import datetime
+import quopri
+import random
+import unicodedata
+from email.header import Header
+from email.utils import format_datetime
+
+# Deterministic synthetic mailboxes: message `uid` of a mailbox is always the
+# same bytes for the same seed, so nothing but flags has to be stored and a
+# million-message mailbox costs no memory until a message is fetched.
+
+FIRST_NAMES = ["Alice", "Bob", "Carla", "Dmitri", "Elena", "Farid", "Grace", "Hiro", "Ingrid", "José",
+               "Kenji", "Lucía", "Marek", "Nadia", "Oskar", "Priya", "Quentin", "Rosa", "Søren", "Tomás"]
+DOMAINS = ["example.com", "corp.example", "mail.test", "shop.example", "news.example", "bank.example"]
+TOPICS = ["invoice", "meeting", "report", "delivery", "newsletter", "password reset", "offer",
+          "travel plans", "contract", "feedback", "release notes", "dinner", "budget", "interview"]
+WORDS = ("the quarterly numbers look good please review attached draft before friday call schedule "
+         "shipment tracking account statement agenda notes follow up thanks regards project deadline "
+         "update customer support ticket order confirmation weekly summary team offsite").split()
+
+# (charset, transfer encoding, sample non-ASCII text)
+CHARSETS = [
+    ("us-ascii", "7bit", ""),
+    ("utf-8", "quoted-printable", "Grüße aus München — café"),
+    ("utf-8", "base64", "你好，会议改到周五"),
+    ("iso-8859-1", "quoted-printable", "Réunion à Genève"),
+    ("windows-1252", "8bit", "Naïve “quotes” déjà vu"),
+    ("koi8-r", "base64", "Привет, отчёт готов"),
+    ("shift_jis", "base64", "お世話になっております"),
+]
+ATTACHMENTS = [
+    ("application", "pdf", "report.pdf"),
+    ("image", "png", "photo.png"),
+    ("text", "csv", "export.csv"),
+    ("application", "vnd.openxmlformats-officedocument.spreadsheetml.sheet", "budget.xlsx"),
+    ("application", "zip", "archive.zip"),
+]
+NEWLINE = b"\n"
+BASE_DATE = datetime.datetime(2025, 12, 20, 15, 30, tzinfo=datetime.timezone.utc)
+
+
+class Part:
+    """One MIME entity: headers, encoded body (leaf) or children (multipart)."""
+
+    def __init__(self, maintype, subtype, params=None, encoding="7bit", body=b"", children=None,
+                 disposition=None, filename=None):
+        self.maintype = maintype
+        self.subtype = subtype
+        self.params = params or {}
+        self.encoding = encoding
+        self.body = body
+        self.children = children or []
+        self.disposition = disposition
+        self.filename = filename
+
+    def header_bytes(self):
+        params = "".join(f'; {k}="{v}"' for k, v in self.params.items())
+        lines = [f"Content-Type: {self.maintype}/{self.subtype}{params}"]
+        if not self.children:
+            lines.append(f"Content-Transfer-Encoding: {self.encoding}")
+        if self.disposition:
+            lines.append(f'Content-Disposition: {self.disposition}; filename="{self.filename}"')
+        return ("\r\n".join(lines) + "\r\n").encode()
+
+    def content_bytes(self):
+        """The entity's body without its own headers (what BODY[n] returns)."""
+        if not self.children:
+            return self.body
+        boundary = self.params["boundary"].encode()
+        out = b""
+        for child in self.children:
+            out += b"--" + boundary + b"\r\n" + child.header_bytes() + b"\r\n" + child.content_bytes() + b"\r\n"
+        return out + b"--" + boundary + b"--\r\n"
+
+    def bodystructure(self):
+        if self.children:
+            children = "".join(child.bodystructure() for child in self.children)
+            return f'({children} "{self.subtype.upper()}" ("BOUNDARY" "{self.params["boundary"]}") NIL NIL)'
+        params = " ".join(f'"{k.upper()}" "{v}"' for k, v in self.params.items())
+        params = f"({params})" if params else "NIL"
+        fields = f'"{self.maintype.upper()}" "{self.subtype.upper()}" {params} NIL NIL "{self.encoding.upper()}" {len(self.body)}'
+        if self.maintype == "text":
+            fields += f" {self.body.count(NEWLINE)}"
+        disposition = f'("{self.disposition.upper()}" ("FILENAME" "{self.filename}"))' if self.disposition else "NIL"
+        return f"({fields} NIL {disposition} NIL)"
+
+    def find(self, section):
+        """The entity at IMAP part number `section` ("1", "2.1", ...)."""
+        part = self
+        for number in section.split("."):
+            if not part.children:
+                # A non-multipart message has its body as part 1
+                if number != "1":
+                    return None
+                continue
+            index = int(number) - 1
+            if index >= len(part.children):
+                return None
+            part = part.children[index]
+        return part
+
+
+class Message:
+    def __init__(self, uid, header, root):
+        self.uid = uid
+        self.header = header
+        self.root = root
+        self.text = root.content_bytes()
+        self.raw = header + self.text
+
+    @property
+    def size(self):
+        return len(self.raw)
+
+    def section(self, name):
+        """Bytes of a FETCH BODY[name] section (HEADER, HEADER.FIELDS (...), TEXT, "", part numbers)."""
+        upper = name.upper()
+        if upper == "":
+            return self.raw
+        if upper == "HEADER":
+            return self.header
+        if upper == "TEXT":
+            return self.text
+        if upper.startswith("HEADER.FIELDS"):
+            wanted = {f.upper() for f in upper[upper.index("(") + 1:upper.rindex(")")].split()}
+            lines, keep = [], False
+            for line in self.header.decode("latin-1").split("\r\n"):
+                if line[:1] in (" ", "\t"):
+                    # Folded continuation of the previous field
+                    if keep:
+                        lines.append(line)
+                    continue
+                keep = bool(line) and line.split(":", 1)[0].upper() in wanted
+                if keep:
+                    lines.append(line)
+            return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+        part = self.root.find(name.split(".MIME")[0])
+        if part is None:
+            return b""
+        return part.header_bytes() if upper.endswith(".MIME") else part.content_bytes()
+
+
+def _encode(text, charset, encoding):
+    raw = text.encode(charset, errors="replace")
+    if encoding == "base64":
+        return base64.encodebytes(raw).replace(b"\n", b"\r\n")
+    if encoding == "quoted-printable":
+        return quopri.encodestring(raw).replace(b"\n", b"\r\n") + b"\r\n"
+    return raw.replace(b"\n", b"\r\n") + b"\r\n"
+
+
+def _header_text(text):
+    """RFC 2047 encoded-words for non-ASCII header text."""
+    try:
+        text.encode("ascii")
+        return text
+    except UnicodeEncodeError:
+        return Header(text, "utf-8").encode(linesep="\r\n")
+
+
+class SyntheticMailbox:
+    """A mailbox of `count` generated messages with UIDs 1..count.
+
+    About `attachment_ratio` of the messages carry one to three attachments
+    (up to `max_attachment_bytes` each); bodies use a mix of charsets and
+    transfer encodings, some are HTML-only or multipart/alternative.
+    """
+
+    def __init__(self, count, seed=1, attachment_ratio=0.2, max_attachment_bytes=256 * 1024, unread_ratio=0.3):
+        self.count = count
+        self.seed = seed
+        self.attachment_ratio = attachment_ratio
+        self.max_attachment_bytes = max_attachment_bytes
+        self.unread_ratio = unread_ratio
+        # Dates count back from the initial newest message; later deliveries are newer
+        self.anchor = count
+
+    def _rng(self, uid):
+        return random.Random(self.seed * 1_000_003 + uid)
+
+    def _mix(self, uid, salt):
+        # Cheap per-uid pseudo-random integer for metadata that SEARCH scans in bulk
+        x = (uid * 2654435761 + self.seed * 40503 + salt * 97) & 0xFFFFFFFF
+        x ^= x >> 15
+        x = (x * 2246822519) & 0xFFFFFFFF
+        return x ^ (x >> 13)
+
+    # --- Cheap metadata (used by SEARCH without building messages) ---
+
+    def sender(self, uid):
+        name = FIRST_NAMES[self._mix(uid, 1) % len(FIRST_NAMES)]
+        local = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode().lower()
+        return name, f"{local}@{DOMAINS[self._mix(uid, 2) % len(DOMAINS)]}"
+
+    def subject(self, uid):
+        sample = CHARSETS[uid % len(CHARSETS)][2]
+        extra = f" {sample}" if sample and self._mix(uid, 3) % 2 else ""
+        return f"{TOPICS[self._mix(uid, 4) % len(TOPICS)].capitalize()} #{uid}{extra}"
+
+    def date(self, uid):
+        return BASE_DATE - datetime.timedelta(minutes=10 * (self.anchor - uid))
+
+    def body_text(self, uid):
+        rng = self._rng(uid + 13)
+        words = [rng.choice(WORDS) for _ in range(rng.randint(30, 400))]
+        lines = [" ".join(words[i:i + 12]) for i in range(0, len(words), 12)]
+        charset = CHARSETS[uid % len(CHARSETS)]
+        if charset[2]:
+            lines.insert(1, charset[2])
+        return "\n".join(lines)
+
+    def parent(self, uid):
+        """The earlier message this one replies to (about a quarter of them do), or None."""
+        if uid <= 1 or self._mix(uid, 6) % 4:
+            return None
+        return max(1, uid - 1 - self._mix(uid, 7) % 10)
+
+    def message_id(self, uid):
+        return f"<{uid}.{self.seed}@bench.example>"
+
+    def references(self, uid, depth=10):
+        """The Message-IDs of the chain above `uid`, root first."""
+        chain = []
+        parent = self.parent(uid)
+        while parent and len(chain) < depth:
+            chain.insert(0, self.message_id(parent))
+            parent = self.parent(parent)
+        return chain
+
+    def initially_seen(self, uid):
+        return self._mix(uid, 5) % 1000 >= self.unread_ratio * 1000
+
+    # --- Full messages ---
+
+    def message(self, uid):
+        rng = self._rng(uid + 23)
+        name, address = self.sender(uid)
+        charset, encoding, _ = CHARSETS[uid % len(CHARSETS)]
+        text = self.body_text(uid)
+
+        plain = Part("text", "plain", {"charset": charset}, encoding, _encode(text, charset, encoding))
+        style = rng.random()
+        if style < 0.15:
+            html = f"<html><body><p>{text.replace(chr(10), '</p><p>')}</p></body></html>"
+            body = Part("text", "html", {"charset": charset}, encoding, _encode(html, charset, encoding))
+        elif style < 0.45:
+            html = f"<html><body><div>{text}</div></body></html>"
+            body = Part("multipart", "alternative", {"boundary": f"alt-{uid}"}, children=[
+                plain, Part("text", "html", {"charset": charset}, encoding, _encode(html, charset, encoding)),
+            ])
+        else:
+            body = plain
+
+        if rng.random() < self.attachment_ratio:
+            children = [body]
+            for index in range(rng.randint(1, 3)):
+                maintype, subtype, filename = rng.choice(ATTACHMENTS)
+                size = int(self.max_attachment_bytes * rng.random() ** 3) + 512
+                data = rng.randbytes(size) if maintype != "text" else (("a,b,c\n" * (size // 6)).encode())
+                children.append(Part(maintype, subtype, {"name": f"{index}-{filename}"}, "base64",
+                                     base64.encodebytes(data).replace(b"\n", b"\r\n"),
+                                     disposition="attachment", filename=f"{index}-{filename}"))
+            root = Part("multipart", "mixed", {"boundary": f"mix-{uid}"}, children=children)
+        else:
+            root = body
+
+        references = self.references(uid)
+        header = (
+            f"From: {_header_text(name)} <{address}>\r\n"
+            f"To: Benchmark User <bench@example.com>\r\n"
+            f"Subject: {_header_text(self.subject(uid))}\r\n"
+            f"Date: {format_datetime(self.date(uid))}\r\n"
+            f"Message-ID: {self.message_id(uid)}\r\n"
+            + (f"In-Reply-To: {references[-1]}\r\nReferences: {' '.join(references)}\r\n" if references else "")
+            + f"MIME-Version: 1.0\r\n"
+        ).encode() + root.header_bytes() + b"\r\n"
+        return Message(uid, header, root)
@@ -0,0 +1,307 @@
+import binascii
+import re
+from urllib.parse import unquote
+
+from imap_fetch import parse_fetch_response
+from mime_parser import decode_header_value, message_text, parse_message
+
+_LITERAL = re.compile(rb"\{(\d+)\}\r\n")
+_ATOM_END = b" ()\r\n"
+
+
+# --- FETCH response tokenizer ---
+
+def _join_response(data):
+    """Rebuilds the wire form of an imaplib FETCH response (literals back in place)."""
+    pieces = []
+    for item in data:
+        if isinstance(item, tuple):
+            pieces.append(item[0] + b"\r\n" + item[1])
+        elif isinstance(item, bytes):
+            pieces.append(item + b" ")
+    return b"".join(pieces)
+
+
+def _parse_value(buf, pos):
+    while pos < len(buf) and buf[pos:pos + 1] in (b" ", b"\r", b"\n"):
+        pos += 1
+    char = buf[pos:pos + 1]
+
+    if char == b"(":
+        items, pos = [], pos + 1
+        while True:
+            while buf[pos:pos + 1] in (b" ", b"\r", b"\n"):
+                pos += 1
+            if buf[pos:pos + 1] in (b")", b""):
+                return items, pos + 1
+            value, pos = _parse_value(buf, pos)
+            items.append(value)
+
+    if char == b'"':
+        out, pos = bytearray(), pos + 1
+        while pos < len(buf) and buf[pos:pos + 1] != b'"':
+            if buf[pos:pos + 1] == b"\\":
+                pos += 1
+            out += buf[pos:pos + 1]
+            pos += 1
+        return out.decode("utf-8", errors="replace"), pos + 1
+
+    literal = _LITERAL.match(buf, pos)
+    if literal:
+        start = literal.end()
+        end = start + int(literal.group(1))
+        return buf[start:end], end
+
+    start = pos
+    while pos < len(buf) and buf[pos:pos + 1] not in _ATOM_END:
+        if buf[pos:pos + 1] == b"[":
+            # Section specs like BODY[HEADER.FIELDS (FROM TO)] contain spaces and parens
+            pos = buf.index(b"]", pos)
+        pos += 1
+    atom = buf[start:pos].decode("ascii", errors="replace")
+    return (None if atom.upper() == "NIL" else atom), pos
+
+
+def parse_fetch_items(data):
+    """Parses a FETCH response into {uid: {ITEM: value}} with nested lists for BODYSTRUCTURE.
+
+    Quoted strings and atoms become str, literals bytes and NIL None.
+    """
+    buf = _join_response(data)
+    messages = {}
+    pos = 0
+    while pos < len(buf):
+        while pos < len(buf) and buf[pos:pos + 1] in (b" ", b"\r", b"\n"):
+            pos += 1
+        if pos >= len(buf):
+            break
+        _, pos = _parse_value(buf, pos)  # sequence number
+        items, pos = _parse_value(buf, pos)
+        if not isinstance(items, list):
+            continue
+        fields = {str(items[i]).upper(): items[i + 1] for i in range(0, len(items) - 1, 2)}
+        if "UID" in fields:
+            messages[str(fields["UID"])] = fields
+    return messages
+
+
+# --- BODYSTRUCTURE ---
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return value
+
+
+def _rfc2231_value(value):
+    """Decodes charset'language'percent-encoded values (RFC 2231)."""
+    pieces = value.split("'", 2)
+    if len(pieces) != 3:
+        return unquote(value)
+    charset = pieces[0] or "us-ascii"
+    try:
+        return unquote(pieces[2], encoding=charset, errors="replace")
+    except LookupError:
+        return unquote(pieces[2], errors="replace")
+
+
+def _params(values):
+    """Turns a ("KEY" "value" ...) parameter list into a dict, resolving RFC 2231 name*= values."""
+    params = {}
+    if not isinstance(values, list):
+        return params
+    for i in range(0, len(values) - 1, 2):
+        key, value = _text(values[i]).lower(), _text(values[i + 1]) or ""
+        if key.endswith("*"):
+            key = key[:-1]
+            value = _rfc2231_value(value)
+        params[key] = decode_header_value(value)
+    return params
+
+
+def body_parts(structure, number=""):
+    """Flattens a BODYSTRUCTURE into leaf parts with their IMAP part numbers ("1", "2.1", ...).
+
+    Each part: {"part", "content_type", "charset", "encoding", "size",
+    "filename", "disposition", "content_id"}; "size" is the encoded size.
+    Attached messages (message/rfc822) are kept as one part.
+    """
+    if not isinstance(structure, list) or not structure:
+        return []
+
+    if isinstance(structure[0], list):
+        parts = []
+        # Child parts come first, then the multipart subtype and extension data
+        children = structure[:_subtype_index(structure)]
+        for index, child in enumerate(children, start=1):
+            parts.extend(body_parts(child, f"{number}.{index}" if number else str(index)))
+        return parts
+
+    content_type = f"{_text(structure[0])}/{_text(structure[1])}".lower()
+    params = _params(structure[2])
+    size = int(structure[6]) if len(structure) > 6 and str(structure[6]).isdigit() else 0
+    if content_type.startswith("text/"):
+        extension = 8
+    elif content_type == "message/rfc822":
+        extension = 10
+    else:
+        extension = 7
+
+    disposition, disposition_params = None, {}
+    if len(structure) > extension + 1 and isinstance(structure[extension + 1], list):
+        disposition = (_text(structure[extension + 1][0]) or "").lower() or None
+        if len(structure[extension + 1]) > 1:
+            disposition_params = _params(structure[extension + 1][1])
+
+    return [{
+        "part": number or "1",
+        "content_type": content_type,
+        "charset": params.get("charset"),
+        "encoding": (_text(structure[5]) or "7bit").lower(),
+        "size": size,
+        "filename": disposition_params.get("filename") or params.get("name"),
+        "disposition": disposition,
+        "content_id": _text(structure[3]),
+    }]
+
+
+def _subtype_index(structure):
+    for index, item in enumerate(structure):
+        if not isinstance(item, list):
+            return index
+    return len(structure)
+
+
+def is_attachment_part(part):
+    if part["disposition"] == "attachment" or part["content_type"] == "message/rfc822":
+        return True
+    return part["disposition"] is None and bool(part["filename"]) \
+        and part["content_type"] not in ("text/plain", "text/html")
+
+
+def decoded_size(part):
+    if part["encoding"] == "base64":
+        # 76-character lines plus CRLF carry 57 bytes each
+        return part["size"] * 57 // 78
+    return part["size"]
+
+
+def attachment_parts(parts):
+    """Attachment metadata ({"part", "filename", "content_type", "size"}) from body_parts()."""
+    return [
+        {
+            "part": p["part"],
+            "filename": p["filename"] or f"part-{p['part']}",
+            "content_type": p["content_type"],
+            "size": decoded_size(p),
+        }
+        for p in parts if is_attachment_part(p)
+    ]
+
+
+def text_part(parts):
+    """The part holding the readable body: first text/plain, else first text/html (not attachments)."""
+    candidates = [p for p in parts if not is_attachment_part(p)]
+    for content_type in ("text/plain", "text/html"):
+        for part in candidates:
+            if part["content_type"] == content_type:
+                return part
+    return None
+
+
+# --- Fetching parts ---
+
+def fetch_structure(mail, uid, with_header=True):
+    """Returns (parts, header_message) for one message without downloading its body."""
+    items = "(UID BODYSTRUCTURE BODY.PEEK[HEADER])" if with_header else "(UID BODYSTRUCTURE)"
+    status, data = mail.uid("FETCH", str(uid), items)
+    if status != "OK":
+        return None, None
+    fields = parse_fetch_items(data).get(str(int(uid)))
+    if not fields or "BODYSTRUCTURE" not in fields:
+        return None, None
+    header = None
+    if with_header:
+        raw_header = fields.get("BODY[HEADER]")
+        header = parse_message(raw_header if isinstance(raw_header, bytes) else b"")
+    return body_parts(fields["BODYSTRUCTURE"]), header
+
+
+def fetch_text(mail, uid, part):
+    """Downloads and decodes just the body text part (declared charset, HTML converted to text)."""
+    status, data = mail.uid("FETCH", str(uid), f"(BODY.PEEK[{part['part']}])")
+    if status != "OK":
+        return ""
+    payload = b""
+    for entry in parse_fetch_response(data).values():
+        payload = entry["sections"].get(part["part"], b"")
+    charset = f'; charset="{part["charset"]}"' if part["charset"] else ""
+    mini = (
+        f"Content-Type: {part['content_type']}{charset}\r\n"
+        f"Content-Transfer-Encoding: {part['encoding']}\r\n\r\n"
+    ).encode() + payload
+    return message_text(parse_message(mini))
+
+
+class _Base64Decoder:
+    def __init__(self):
+        self.pending = b""
+
+    def decode(self, chunk):
+        data = self.pending + chunk.translate(None, b" \t\r\n")
+        usable = len(data) - len(data) % 4
+        self.pending = data[usable:]
+        return binascii.a2b_base64(data[:usable]) if usable else b""
+
+    def flush(self):
+        return binascii.a2b_base64(self.pending + b"=" * (-len(self.pending) % 4)) if self.pending else b""
+
+
+class _QuotedPrintableDecoder:
+    def __init__(self):
+        self.pending = b""
+
+    def decode(self, chunk):
+        data = self.pending + chunk
+        cut = data.rfind(b"\n") + 1
+        self.pending = data[cut:]
+        return binascii.a2b_qp(data[:cut]) if cut else b""
+
+    def flush(self):
+        return binascii.a2b_qp(self.pending) if self.pending else b""
+
+
+class _IdentityDecoder:
+    def decode(self, chunk):
+        return chunk
+
+    def flush(self):
+        return b""
+
+
+def iter_part(mail, uid, part, chunk_size=512 * 1024, max_bytes=None):
+    """Yields the decoded bytes of one body part, fetched in BODY.PEEK[n]<offset.size> slices.
+
+    Only one slice is held in memory at a time. `max_bytes` stops after
+    roughly that many encoded bytes.
+    """
+    decoder = {"base64": _Base64Decoder, "quoted-printable": _QuotedPrintableDecoder}.get(part["encoding"], _IdentityDecoder)()
+    offset = 0
+    while max_bytes is None or offset < max_bytes:
+        status, data = mail.uid("FETCH", str(uid), f"(BODY.PEEK[{part['part']}]<{offset}.{chunk_size}>)")
+        if status != "OK":
+            raise RuntimeError(f"FETCH of part {part['part']} failed")
+        chunk = b""
+        for entry in parse_fetch_response(data).values():
+            chunk = entry["sections"].get(part["part"], b"")
+        if not chunk:
+            break
+        offset += len(chunk)
+        decoded = decoder.decode(chunk)
+        if decoded:
+            yield decoded
+        if len(chunk) < chunk_size:
+            break
+    tail = decoder.flush()
+    if tail:
+        yield tail
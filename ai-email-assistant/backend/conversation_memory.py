@@ -0,0 +1,221 @@
+import json
+import threading
+
+# Rough Gemini tokenisation for English text: ~4 characters per token
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text):
+    return len(text or "") // CHARS_PER_TOKEN + MESSAGE_OVERHEAD_TOKENS
+
+
+def _clip(text, max_tokens, marker=" … [truncated]"):
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return text[:max(0, max_chars - len(marker))] + marker
+
+
+def _walk(value):
+    if isinstance(value, dict):
+        yield value
+        for child in value.values():
+            yield from _walk(child)
+    elif isinstance(value, list):
+        for child in value:
+            yield from _walk(child)
+
+
+def extract_references(tool_name, args, result):
+    """Emails a tool call touched, as [{"id", "mailbox", "sender", "subject", "tool"}] (most relevant first).
+
+    Listing tools return JSON with "id"/"sender"/"subject" objects; action
+    tools only name the email in their arguments. IDs are UIDs, so they
+    only mean something together with the folder: an item's own "mailbox"
+    (cross-folder results), else the one the tool was called on.
+    """
+    references = []
+    args = args if isinstance(args, dict) else {}
+    mailbox = args.get("mailbox") or "inbox"
+    if "*" in mailbox or "," in mailbox:
+        # Several folders; only items that carry their own can be placed
+        mailbox = None
+    email_id = args.get("email_id")
+    if email_id:
+        references.append({"id": str(email_id), "mailbox": mailbox, "tool": tool_name})
+    email_ids = args.get("email_ids")
+    if email_ids and not isinstance(email_ids, str):
+        references.extend({"id": str(i), "mailbox": mailbox, "tool": tool_name} for i in email_ids)
+
+    try:
+        data = json.loads(result) if isinstance(result, str) else result
+    except ValueError:
+        return references
+    for item in _walk(data):
+        if "id" in item and ("sender" in item or "from" in item or "subject" in item):
+            references.append({
+                "id": str(item["id"]),
+                "mailbox": item.get("mailbox") or mailbox,
+                "sender": item.get("sender") or item.get("from"),
+                "subject": item.get("subject"),
+                "tool": tool_name,
+            })
+    return references
+
+
+class ConversationMemory:
+    """Bounded per-session chat memory: a recent window, a running summary and email references.
+
+    The recent messages in session["chat_history"] are kept under
+    `window_tokens`. When a turn pushes the window over it, the oldest
+    exchanges are folded into session["memory"]["summary"] until the
+    window is back to half the budget, so summaries are made every few
+    turns rather than every turn. Folding uses
+    `summarizer(previous_summary, messages, max_tokens)` if one is given,
+    and clips the turns extractively otherwise. Email IDs, senders and
+    subjects the tools returned are kept as compact references, most recent
+    first, which is what "reply to that last email" needs.
+    """
+
+    def __init__(self, window_tokens=4000, summary_tokens=600, message_tokens=1500, max_references=20):
+        self.window_tokens = window_tokens
+        self.summary_tokens = summary_tokens
+        self.message_tokens = message_tokens
+        self.max_references = max_references
+        self._lock = threading.Lock()
+        self._stats = {"turns": 0, "compactions": 0, "evicted_messages": 0, "summarizer_calls": 0, "summarizer_failures": 0}
+
+    @staticmethod
+    def state(session):
+        memory = session.setdefault("memory", {})
+        memory.setdefault("summary", "")
+        memory.setdefault("references", [])
+        session.setdefault("chat_history", [])
+        return memory
+
+    # --- Building the model context ---
+
+    def context_text(self, session):
+        """The summary and references as one text block ("" when there are none)."""
+        memory = self.state(session)
+        sections = []
+        if memory["summary"]:
+            sections.append(f"Summary of the earlier conversation:\n{memory['summary']}")
+        if memory["references"]:
+            lines = []
+            for ref in memory["references"]:
+                details = " | ".join(filter(None, [ref.get("sender"), ref.get("subject")]))
+                place = f" in {ref['mailbox']}" if ref.get("mailbox") else ""
+                lines.append(f"- id {ref['id']}{place}" + (f": {details}" if details else "") + f" (via {ref['tool']})")
+            sections.append("Emails referenced so far, most recent first:\n" + "\n".join(lines))
+        return "\n\n".join(sections)
+
+    def history(self, session):
+        """Gemini start_chat history: a memory preamble (if any) and the recent window."""
+        self.state(session)
+        contents = []
+        context = self.context_text(session)
+        if context:
+            contents.append({"role": "user", "parts": [{"text": f"[Conversation memory]\n{context}"}]})
+            contents.append({"role": "model", "parts": [{"text": "Noted."}]})
+        for msg in session["chat_history"]:
+            if msg.get("role") in ("user", "model"):
+                contents.append({"role": msg["role"], "parts": [{"text": msg.get("content", "")}]})
+        return contents
+
+    # --- Updating ---
+
+    def remember(self, session, command, reply, tool_calls=(), summarizer=None):
+        """Adds a finished exchange, updates the references and compacts the window.
+
+        `tool_calls` is [(name, args, result)] from the turn.
+        """
+        memory = self.state(session)
+        for text, role in ((command, "user"), (reply, "model")):
+            text = _clip(text or "", self.message_tokens)
+            session["chat_history"].append({"role": role, "content": text, "tokens": estimate_tokens(text)})
+
+        references = []
+        for name, args, result in tool_calls:
+            references = extract_references(name, args, result) + references
+        merged = {}
+        for ref in references + memory["references"]:
+            # The same UID in two folders is two different emails
+            key = (ref.get("mailbox"), ref["id"])
+            if key in merged:
+                # Keep the newest position, fill in sender/subject from older mentions
+                for field, value in ref.items():
+                    if value and not merged[key].get(field):
+                        merged[key][field] = value
+            else:
+                merged[key] = dict(ref)
+        memory["references"] = list(merged.values())[:self.max_references]
+
+        self._bump("turns")
+        self._compact(session, summarizer)
+
+    def _window_tokens(self, messages):
+        return sum(m.get("tokens") or estimate_tokens(m.get("content")) for m in messages)
+
+    def _compact(self, session, summarizer):
+        messages = session["chat_history"]
+        if self._window_tokens(messages) <= self.window_tokens:
+            return
+
+        target = self.window_tokens // 2
+        evicted = []
+        # Evict whole exchanges, always keeping the latest one
+        while len(messages) > 2 and self._window_tokens(messages) > target:
+            evicted.extend(messages[:2])
+            del messages[:2]
+        if not evicted:
+            return
+
+        memory = session["memory"]
+        summary = None
+        if summarizer is not None:
+            self._bump("summarizer_calls")
+            try:
+                summary = summarizer(memory["summary"], evicted, self.summary_tokens)
+            except Exception as e:
+                self._bump("summarizer_failures")
+                print(f"Conversation summarizer failed, using extractive summary: {e}")
+        if not summary:
+            summary = self._extractive_summary(memory["summary"], evicted)
+        memory["summary"] = self._fit_summary(summary.strip())
+
+        self._bump("compactions")
+        self._bump("evicted_messages", len(evicted))
+
+    def _extractive_summary(self, previous, messages):
+        lines = [previous] if previous else []
+        for msg in messages:
+            speaker = "User" if msg["role"] == "user" else "Assistant"
+            text = " ".join((msg.get("content") or "").split())
+            lines.append(f"- {speaker}: {_clip(text, 50, '…')}")
+        return "\n".join(lines)
+
+    def _fit_summary(self, summary):
+        # Drop the oldest lines first; the most recent context matters most
+        lines = summary.splitlines()
+        while len(lines) > 1 and estimate_tokens("\n".join(lines)) > self.summary_tokens:
+            lines.pop(0)
+        return _clip("\n".join(lines), self.summary_tokens)
+
+    def clear(self, session):
+        session["chat_history"] = []
+        session["memory"] = {"summary": "", "references": []}
+
+    # --- Metrics ---
+
+    def _bump(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+        snapshot["window_tokens_budget"] = self.window_tokens
+        snapshot["summary_tokens_budget"] = self.summary_tokens
+        return snapshot
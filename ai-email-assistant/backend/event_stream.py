@@ -0,0 +1,76 @@
+import asyncio
+import json
+import threading
+
+
+class EventBroker:
+    """Fans server-side events out to connected SSE clients.
+
+    `publish` may be called from any thread (sync worker, IDLE watcher);
+    each subscriber gets its own bounded asyncio.Queue on its event loop.
+    A subscriber that falls behind has its queue replaced by a single
+    "resync" event so it can reload instead of replaying stale deltas.
+    """
+
+    def __init__(self, max_queue=100):
+        self.max_queue = max_queue
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=self.max_queue)
+        entry = (asyncio.get_running_loop(), queue)
+        with self._lock:
+            self._subscribers.add(entry)
+        return entry
+
+    def unsubscribe(self, entry):
+        with self._lock:
+            self._subscribers.discard(entry)
+
+    def publish(self, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._deliver, queue, event, data)
+            except RuntimeError:
+                # Loop already closed; the subscriber is going away
+                self.unsubscribe((loop, queue))
+
+    @property
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    @staticmethod
+    def _deliver(queue, event, data):
+        try:
+            queue.put_nowait((event, data))
+        except asyncio.QueueFull:
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(("resync", {}))
+
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def sse_stream(broker, request, keepalive=15):
+    """Async generator of SSE frames for one client, with keep-alive comments."""
+    entry = broker.subscribe()
+    _, queue = entry
+    try:
+        yield format_sse("ready", {})
+        while True:
+            if await request.is_disconnected():
+                break
+            try:
+                event, data = await asyncio.wait_for(queue.get(), timeout=keepalive)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            yield format_sse(event, data)
+    finally:
+        broker.unsubscribe(entry)
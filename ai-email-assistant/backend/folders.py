@@ -0,0 +1,170 @@
+import base64
+import re
+import threading
+import time
+
+# SPECIAL-USE (RFC 6154) attributes, plus Gmail's \Important, and the role each gives a folder
+SPECIAL_USE_ROLES = {
+    "\\sent": "sent",
+    "\\all": "all",
+    "\\drafts": "drafts",
+    "\\trash": "trash",
+    "\\junk": "spam",
+    "\\flagged": "starred",
+    "\\important": "important",
+    "\\archive": "archive",
+}
+# What users (and the model) call those roles
+ROLE_ALIASES = {
+    "sent": "sent", "sent mail": "sent", "sent items": "sent", "outbox": "sent",
+    "all": "all", "all mail": "all",
+    "drafts": "drafts", "draft": "drafts",
+    "trash": "trash", "bin": "trash", "deleted": "trash", "deleted items": "trash",
+    "spam": "spam", "junk": "spam",
+    "starred": "starred", "flagged": "starred",
+    "important": "important",
+    "archive": "archive", "archived": "archive",
+}
+# Where servers without SPECIAL-USE usually keep them
+FALLBACK_NAMES = {
+    "sent": ("[Gmail]/Sent Mail", "Sent", "Sent Items", "Sent Messages", "INBOX.Sent"),
+    "all": ("[Gmail]/All Mail", "All Mail", "Archive"),
+    "drafts": ("[Gmail]/Drafts", "Drafts", "INBOX.Drafts"),
+    "trash": ("[Gmail]/Trash", "[Gmail]/Bin", "Trash", "Deleted Items", "INBOX.Trash"),
+    "spam": ("[Gmail]/Spam", "Spam", "Junk", "Junk E-mail", "INBOX.Junk"),
+    "starred": ("[Gmail]/Starred",),
+    "important": ("[Gmail]/Important",),
+    "archive": ("Archive", "[Gmail]/All Mail"),
+}
+
+_LIST_LINE = re.compile(r'^\((?P<flags>[^)]*)\) (?:"(?P<delimiter>(?:[^"\\]|\\.)*)"|NIL) (?P<name>.*)$', re.IGNORECASE)
+_MUTF7_RUN = re.compile(r"&([A-Za-z0-9+,]*)-")
+
+
+def decode_mailbox_name(name):
+    """IMAP modified UTF-7 (RFC 3501 5.1.3), as LIST returns non-ASCII names, to text."""
+    def decode(match):
+        run = match.group(1)
+        if not run:
+            return "&"
+        run = run.replace(",", "/")
+        return base64.b64decode(run + "=" * (-len(run) % 4)).decode("utf-16-be", errors="replace")
+    return _MUTF7_RUN.sub(decode, name)
+
+
+def quote_mailbox(name):
+    """A mailbox name as an IMAP quoted string (imaplib sends SELECT/STATUS/APPEND arguments as-is)."""
+    if len(name) > 1 and name.startswith('"') and name.endswith('"'):
+        return name
+    return '"' + name.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _unquote(text):
+    text = text.strip()
+    if len(text) > 1 and text.startswith('"') and text.endswith('"'):
+        return re.sub(r"\\(.)", r"\1", text[1:-1])
+    return text
+
+
+def parse_list_response(data):
+    """Folders from a LIST response: [{"name", "display", "delimiter", "flags", "role", "selectable"}]."""
+    folders = []
+    for item in data or ():
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            # Name sent as a literal: (b'(\\HasNoChildren) "/" {12}', b'Projects/2024')
+            line, name = item[0].decode("utf-8", errors="replace"), item[1].decode("utf-8", errors="replace")
+            line = re.sub(r"\{\d+\}$", "", line) + '""'
+        else:
+            line, name = item.decode("utf-8", errors="replace"), None
+        match = _LIST_LINE.match(line)
+        if not match:
+            continue
+        flags = match.group("flags").split()
+        lowered = {f.lower() for f in flags}
+        if name is None:
+            name = _unquote(match.group("name"))
+        role = "inbox" if name.upper() == "INBOX" else next(
+            (SPECIAL_USE_ROLES[f] for f in lowered if f in SPECIAL_USE_ROLES), None
+        )
+        folders.append({
+            "name": name,
+            "display": decode_mailbox_name(name),
+            "delimiter": match.group("delimiter"),
+            "flags": flags,
+            "role": role,
+            "selectable": "\\noselect" not in lowered and "\\nonexistent" not in lowered,
+        })
+    return folders
+
+
+class MailboxDirectory:
+    """The account's folders (and Gmail labels, which IMAP shows as folders).
+
+    Resolves what a user or the model calls a mailbox ("inbox", "sent",
+    "All Mail", "Receipts", "Projects/2024"...) to the server's name, from
+    one LIST kept for `ttl` seconds; an unknown name triggers one re-LIST
+    in case the label was just created. The inbox is always "inbox", the
+    key the sync state and caches already use.
+    """
+
+    def __init__(self, pool, ttl=300):
+        self.pool = pool
+        self.ttl = ttl
+        self._folders = None
+        self._listed_at = 0.0
+        self._lock = threading.Lock()
+
+    def folders(self, refresh=False):
+        with self._lock:
+            if refresh or self._folders is None or time.monotonic() - self._listed_at > self.ttl:
+                with self.pool.connection(mailbox=None) as mail:
+                    status, data = mail.list()
+                if status != "OK":
+                    raise RuntimeError(f"LIST failed: {data}")
+                self._folders = [f for f in parse_list_response(data) if f["selectable"]]
+                self._listed_at = time.monotonic()
+            return list(self._folders)
+
+    def resolve(self, name):
+        """The server name for `name` (a folder, label or role); raises ValueError if there is none."""
+        name = (name or "inbox").strip()
+        if name.lower() == "inbox":
+            return "inbox"
+        found = self._find(name, self.folders())
+        if found is None:
+            found = self._find(name, self.folders(refresh=True))
+        if found is None:
+            known = ", ".join(f["display"] for f in self._folders or [])
+            raise ValueError(f"Unknown mailbox '{name}'. Available: {known}")
+        return "inbox" if found.upper() == "INBOX" else found
+
+    @staticmethod
+    def _find(name, folders):
+        lowered = name.lower()
+        for folder in folders:
+            if lowered in (folder["name"].lower(), folder["display"].lower()):
+                return folder["name"]
+        role = ROLE_ALIASES.get(lowered)
+        if role:
+            for folder in folders:
+                if folder["role"] == role:
+                    return folder["name"]
+            names = {f["name"].lower(): f["name"] for f in folders}
+            for candidate in FALLBACK_NAMES.get(role, ()):
+                if candidate.lower() in names:
+                    return names[candidate.lower()]
+        # A nested label by its last component ("2024" for "Projects/2024"), if that is unambiguous
+        leaves = [
+            f["name"] for f in folders
+            if f["delimiter"] and f["display"].rsplit(f["delimiter"], 1)[-1].lower() == lowered
+        ]
+        return leaves[0] if len(leaves) == 1 else None
+
+    def describe(self):
+        """Folders for display: name, display name and role."""
+        return [
+            {"name": "inbox" if f["role"] == "inbox" else f["name"], "display": f["display"], "role": f["role"]}
+            for f in self.folders()
+        ]
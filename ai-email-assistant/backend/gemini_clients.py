@@ -0,0 +1,72 @@
+import threading
+from collections import OrderedDict
+
+import google.generativeai as genai
+from google.generativeai import caching
+from google.generativeai import client as genai_client
+
+
+class KeyedGenerativeModel(genai.GenerativeModel):
+    """A GenerativeModel that calls Gemini through its own API key's clients.
+
+    The SDK's models pick up the process-wide clients of genai.configure()
+    lazily, on their first call, so with several users' keys in one process
+    a model could run (and bill) under whichever key was configured last.
+    """
+
+    _key_clients = None
+
+    @property
+    def _client(self):
+        return self._key_clients.get_default_client("generative")
+
+    @_client.setter
+    def _client(self, value):
+        # GenerativeModel.__init__ resets it; the key's client manager owns it
+        pass
+
+    @property
+    def _async_client(self):
+        # Created on first use, on the event loop that awaits it
+        return self._key_clients.get_default_client("generative_async")
+
+    @_async_client.setter
+    def _async_client(self, value):
+        pass
+
+
+class GeminiClients:
+    """Gemini client managers per API key (the newest `max_keys` are kept)."""
+
+    def __init__(self, max_keys=32):
+        self.max_keys = max_keys
+        self._managers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _manager(self, api_key):
+        with self._lock:
+            manager = self._managers.get(api_key)
+            if manager is None:
+                manager = genai_client._ClientManager()
+                manager.configure(api_key=api_key)
+                self._managers[api_key] = manager
+            self._managers.move_to_end(api_key)
+            while len(self._managers) > self.max_keys:
+                self._managers.popitem(last=False)
+            return manager
+
+    def model(self, api_key, model_name, **kwargs):
+        model = KeyedGenerativeModel(model_name=model_name, **kwargs)
+        model._key_clients = self._manager(api_key)
+        return model
+
+    def create_cached_content(self, api_key, model, **kwargs):
+        """CachedContent.create, under `api_key` (a blocking network call)."""
+        request = caching.CachedContent._prepare_create_request(model=model, **kwargs)
+        response = self._manager(api_key).get_default_client("cache").create_cached_content(request)
+        return caching.CachedContent._from_obj(response)
+
+    def model_from_cached_content(self, api_key, cached_content):
+        model = KeyedGenerativeModel.from_cached_content(cached_content)
+        model._key_clients = self._manager(api_key)
+        return model
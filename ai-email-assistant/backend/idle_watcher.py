@@ -0,0 +1,145 @@
+import imaplib
+import re
+import socket
+import threading
+import time
+
+from imap_pool import open_imap
+
+_CHANGE = re.compile(rb"^\* \d+ (EXISTS|EXPUNGE|FETCH)\b", re.IGNORECASE)
+
+
+class IdleWatcher:
+    """Holds a dedicated IMAP connection in IDLE and calls `on_change` when the mailbox changes.
+
+    The connection is separate from the pool because a session in IDLE
+    can't run other commands. IDLE is re-issued every `renew_after`
+    seconds (servers drop IDLE after ~29 minutes) and the connection is
+    re-established with backoff when it fails.
+    """
+
+    def __init__(self, host="imap.gmail.com", mailbox="inbox", on_change=None, renew_after=25 * 60, poll=1.0, port=None, ssl=True):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.mailbox = mailbox
+        self.on_change = on_change
+        self.renew_after = renew_after
+        self.poll = poll
+
+        self._credentials = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {"connects": 0, "idle_cycles": 0, "wakeups": 0, "errors": 0, "supported": None}
+
+    def start(self, email_address, password):
+        self.stop()
+        self._credentials = (email_address, password)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="imap-idle", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.poll * 3)
+        self._thread = None
+        self._credentials = None
+
+    def stats(self):
+        return dict(self._stats)
+
+    def _run(self):
+        failures = 0
+        while not self._stop.is_set():
+            mail = None
+            try:
+                mail = open_imap(self.host, self.port, self.ssl)
+                mail.login(*self._credentials)
+                self._stats["connects"] += 1
+                if "IDLE" not in mail.capabilities:
+                    # The sync engine's periodic pass still picks changes up
+                    self._stats["supported"] = False
+                    print("IMAP server does not support IDLE; relying on periodic sync")
+                    return
+                self._stats["supported"] = True
+                mail.select(self.mailbox, readonly=True)
+                failures = 0
+
+                while not self._stop.is_set():
+                    if self._idle_cycle(mail):
+                        self._stats["wakeups"] += 1
+                        if self.on_change:
+                            self.on_change()
+            except Exception as e:
+                if self._stop.is_set():
+                    break
+                self._stats["errors"] += 1
+                failures += 1
+                print(f"IMAP IDLE error: {e}")
+                self._stop.wait(min(60, 2 ** failures))
+            finally:
+                if mail is not None:
+                    try:
+                        mail.sock.settimeout(None)
+                        mail.logout()
+                    except Exception:
+                        pass
+
+    def _idle_cycle(self, mail):
+        """Runs one IDLE ... DONE exchange; returns True if the server reported a change.
+
+        The exchange reads the raw socket with a short timeout instead of
+        imaplib's buffered file, which can't be read again after a timeout.
+        """
+        self._stats["idle_cycles"] += 1
+        tag = mail._new_tag()
+        sock = mail.sock
+        buffer = b""
+
+        def read_line(deadline):
+            nonlocal buffer
+            while b"\r\n" not in buffer:
+                if self._stop.is_set() or time.monotonic() >= deadline:
+                    return None
+                try:
+                    chunk = sock.recv(4096)
+                except (socket.timeout, TimeoutError):
+                    continue
+                if not chunk:
+                    raise imaplib.IMAP4.abort("connection closed during IDLE")
+                buffer += chunk
+            line, buffer = buffer.split(b"\r\n", 1)
+            return line
+
+        sock.settimeout(self.poll)
+        try:
+            mail.send(tag + b" IDLE\r\n")
+            line = read_line(time.monotonic() + 30)
+            if line is None or not line.startswith(b"+"):
+                raise imaplib.IMAP4.abort(f"IDLE not accepted: {line!r}")
+
+            changed = False
+            deadline = time.monotonic() + self.renew_after
+            while True:
+                line = read_line(deadline)
+                if line is None:
+                    break
+                if _CHANGE.match(line):
+                    changed = True
+                    break
+
+            mail.send(b"DONE\r\n")
+            done_deadline = time.monotonic() + 30
+            while True:
+                line = read_line(done_deadline)
+                if line is None:
+                    if self._stop.is_set():
+                        return changed
+                    raise imaplib.IMAP4.abort("no response to IDLE DONE")
+                if _CHANGE.match(line):
+                    changed = True
+                if line.startswith(tag):
+                    return changed
+        finally:
+            sock.settimeout(None)
@@ -0,0 +1,172 @@
+import re
+
+from mime_parser import decode_header_value, message_text, parse_message
+
+# Headers needed to render a listing row, thread it and make sense of a partial body
+LISTING_HEADER_FIELDS = (
+    "FROM", "TO", "CC", "SUBJECT", "DATE", "MESSAGE-ID", "IN-REPLY-TO", "REFERENCES",
+    "CONTENT-TYPE", "CONTENT-TRANSFER-ENCODING",
+)
+
+_MESSAGE_START = re.compile(rb"^(\d+) \(")
+_UID = re.compile(rb"\bUID (\d+)")
+_FLAGS = re.compile(rb"\bFLAGS \(([^)]*)\)")
+_THRID = re.compile(rb"\bX-GM-THRID (\d+)")
+_SECTION = re.compile(rb"BODY\[([^\]]*)\](?:<\d+>)? \{\d+\}$")
+
+
+def compress_id_set(ids):
+    """Turns [1, 2, 3, 7, 9, 10] into the IMAP sequence/UID set "1:3,7,9:10"."""
+    numbers = sorted({int(i) for i in ids})
+    if not numbers:
+        return ""
+
+    ranges = []
+    start = prev = numbers[0]
+    for n in numbers[1:]:
+        if n == prev + 1:
+            prev = n
+            continue
+        ranges.append(f"{start}:{prev}" if start != prev else str(start))
+        start = prev = n
+    ranges.append(f"{start}:{prev}" if start != prev else str(start))
+    return ",".join(ranges)
+
+
+def parse_fetch_response(data):
+    """Groups a multi-message imaplib FETCH response by sequence number.
+
+    Returns {seq: {"uid": str|None, "flags": [..], "thread_id": str|None, "sections": {name: bytes}}},
+    with any HEADER.FIELDS (...) section stored under "HEADER.FIELDS" and
+    "thread_id" set from Gmail's X-GM-THRID when it was fetched.
+    """
+    messages = {}
+    current = None
+
+    for item in data:
+        if isinstance(item, tuple):
+            envelope, literal = item[0], item[1]
+        elif isinstance(item, bytes):
+            envelope, literal = item, None
+        else:
+            continue
+
+        start = _MESSAGE_START.match(envelope)
+        if start:
+            current = messages.setdefault(start.group(1).decode(), {"uid": None, "flags": [], "thread_id": None, "sections": {}})
+        if current is None:
+            continue
+
+        uid = _UID.search(envelope)
+        if uid:
+            current["uid"] = uid.group(1).decode()
+        flags = _FLAGS.search(envelope)
+        if flags:
+            current["flags"] = flags.group(1).decode().split()
+        thrid = _THRID.search(envelope)
+        if thrid:
+            current["thread_id"] = thrid.group(1).decode()
+
+        section = _SECTION.search(envelope)
+        if section and literal is not None:
+            name = section.group(1).decode().upper()
+            if name.startswith("HEADER.FIELDS"):
+                # Servers echo the field list back; callers only need to know it is the header block
+                name = "HEADER.FIELDS"
+            current["sections"][name] = literal
+
+    return messages
+
+
+def fetch_message_summaries(mail, uids, header_fields=LISTING_HEADER_FIELDS, snippet_bytes=2048):
+    """Fetches headers (and optionally the first bytes of the body) for many messages at once.
+
+    Uses a single UID FETCH over a compressed UID set with BODY.PEEK, so the
+    messages are not downloaded in full and are not marked \\Seen. Returns a
+    list of {"id", "flags", "thread_id", "message"} in the order `uids` was
+    given, where "id" is the message UID, "thread_id" Gmail's X-GM-THRID
+    (None on other servers) and "message" is an email.message.Message built
+    from the partial data.
+    """
+    uids = [u.decode() if isinstance(u, bytes) else str(u) for u in uids]
+    if not uids:
+        return []
+
+    items = ["UID", "FLAGS", f"BODY.PEEK[HEADER.FIELDS ({' '.join(header_fields)})]"]
+    if snippet_bytes:
+        items.append(f"BODY.PEEK[TEXT]<0.{int(snippet_bytes)}>")
+    if "X-GM-EXT-1" in getattr(mail, "capabilities", ()):
+        items.insert(2, "X-GM-THRID")
+
+    status, data = mail.uid("FETCH", compress_id_set(uids), f"({' '.join(items)})")
+    if status != "OK":
+        return []
+
+    fetched = {entry["uid"]: entry for entry in parse_fetch_response(data).values() if entry["uid"]}
+    summaries = []
+    for uid in uids:
+        entry = fetched.get(str(int(uid)))
+        if not entry:
+            continue
+        header_bytes = entry["sections"].get("HEADER.FIELDS", b"")
+        text_bytes = entry["sections"].get("TEXT", b"")
+        summaries.append({
+            "id": entry["uid"],
+            "flags": entry["flags"],
+            "thread_id": entry["thread_id"],
+            "message": parse_message(header_bytes.rstrip(b"\r\n") + b"\r\n\r\n" + text_bytes),
+        })
+    return summaries
+
+
+def decode_subject(msg):
+    """Decodes RFC 2047 encoded-words in the Subject header."""
+    return decode_header_value(msg.get("Subject"), "No Subject")
+
+
+def summary_body_text(msg):
+    """Best-effort text of a fetch_message_summaries() message.
+
+    Only the first bytes of the body were fetched, so decoding may be partial.
+    """
+    try:
+        return message_text(msg)
+    except Exception:
+        return "Could not decode email body"
+
+
+def summary_to_listing(summary, snippet_chars=200):
+    """Turns a fetch_message_summaries() entry into an inbox listing row."""
+    msg = summary["message"]
+    body = summary_body_text(msg)
+
+    return {
+        "id": summary["id"],
+        "sender": decode_header_value(msg.get("From"), "Unknown Sender"),
+        "subject": decode_subject(msg),
+        "date": msg.get("Date", ""),
+        "is_unread": "\\Seen" not in summary["flags"],
+        "flags": summary["flags"],
+        "body_snippet": body[:snippet_chars] if body else "No content",
+    }
+
+
+def summary_to_search_document(summary):
+    """Turns a fetch_message_summaries() entry into a (partial) search index document."""
+    msg = summary["message"]
+    return {
+        "uid": summary["id"],
+        "sender": decode_header_value(msg.get("From")),
+        "recipients": " ".join(filter(None, [decode_header_value(msg.get("To")), decode_header_value(msg.get("Cc"))])),
+        "subject": decode_subject(msg),
+        "body": summary_body_text(msg),
+        "date": msg.get("Date", ""),
+        "partial": True,
+        # For the thread index; raw From/Subject so replies can reuse them as-is
+        "message_id": msg.get("Message-ID", ""),
+        "in_reply_to": msg.get("In-Reply-To", ""),
+        "references": msg.get("References", ""),
+        "thread_id": summary.get("thread_id"),
+        "from_header": msg.get("From", ""),
+        "subject_header": msg.get("Subject", ""),
+    }
@@ -0,0 +1,304 @@
+import imaplib
+import threading
+import time
+from contextlib import contextmanager
+
+from folders import quote_mailbox
+from tracing import tracer
+
+
+def response_bytes(data):
+    """Size of an imaplib response payload (lines and literals)."""
+    total = 0
+    for item in data or ():
+        if isinstance(item, tuple):
+            total += sum(len(x) for x in item if isinstance(x, bytes))
+        elif isinstance(item, bytes):
+            total += len(item)
+    return total
+
+
+def open_imap(host, port=None, ssl=True):
+    """Connects to an IMAP server (implicit TLS unless `ssl` is False, e.g. a local test server)."""
+    if ssl:
+        return imaplib.IMAP4_SSL(host, port or imaplib.IMAP4_SSL_PORT)
+    return imaplib.IMAP4(host, port or imaplib.IMAP4_PORT)
+
+
+class PooledIMAPConnection:
+    """An authenticated IMAP session plus the bookkeeping the pool needs.
+
+    Tools receive this wrapper instead of the raw imaplib object; unknown
+    attributes are delegated, so `mail.uid(...)`, `mail.search(...)` etc.
+    work as before, while SELECT state (including UIDVALIDITY) is tracked.
+    """
+
+    def __init__(self, imap, generation):
+        self.imap = imap
+        self.generation = generation
+        self.selected = None
+        self.uidvalidity = None
+        self.last_used = time.monotonic()
+        self.last_checked = self.last_used
+
+    def __getattr__(self, name):
+        return getattr(self.imap, name)
+
+    def uid(self, command, *args):
+        with tracer.span(f"imap.{command.lower()}") as span:
+            status, data = self.imap.uid(command, *args)
+            span.set(status=status, response_bytes=response_bytes(data))
+            return status, data
+
+    def select(self, mailbox="INBOX", readonly=False):
+        with tracer.span("imap.select", mailbox=mailbox):
+            status, data = self.imap.select(quote_mailbox(mailbox), readonly)
+        if status != "OK":
+            self.selected = None
+            self.uidvalidity = None
+            raise imaplib.IMAP4.error(f"SELECT {mailbox} failed: {data}")
+        self.selected = mailbox
+        _, uidvalidity = self.imap.response("UIDVALIDITY")
+        self.uidvalidity = int(uidvalidity[0]) if uidvalidity and uidvalidity[0] else None
+        return status, data
+
+    def ensure_selected(self, mailbox):
+        """SELECT `mailbox` unless it is already the selected one."""
+        if mailbox is None or self.selected == mailbox:
+            return
+        self.select(mailbox)
+
+    def close(self):
+        self.selected = None
+        self.uidvalidity = None
+        return self.imap.close()
+
+    def is_alive(self):
+        try:
+            status, _ = self.imap.noop()
+            return status == "OK"
+        except Exception:
+            return False
+
+    def shutdown(self):
+        try:
+            if self.selected:
+                self.imap.close()
+        except Exception:
+            pass
+        try:
+            self.imap.logout()
+        except Exception:
+            pass
+        self.selected = None
+
+
+class IMAPPool:
+    """Keeps authenticated IMAP sessions alive and hands them out per call.
+
+    Sessions are checked with NOOP when they have been idle for longer than
+    `health_check_after` seconds, replaced transparently when they are dead,
+    and logged out by a reaper thread after `idle_timeout` seconds unused.
+    """
+
+    def __init__(self, host="imap.gmail.com", max_size=4, idle_timeout=300, health_check_after=30, port=None, ssl=True):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+
+        self._email = None
+        self._password = None
+        self._generation = 0
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._reaper = None
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "reconnects": 0,
+            "discarded": 0,
+            "reaped": 0,
+            "handshakes": 0,
+            "handshake_seconds_total": 0.0,
+            "handshake_seconds_max": 0.0,
+            "handshake_seconds_last": 0.0,
+        }
+
+    # --- Configuration ---
+
+    def configure(self, email_address, password):
+        """Point the pool at a new account, dropping sessions of the old one."""
+        with self._lock:
+            self._email = email_address
+            self._password = password
+            self._generation += 1
+            stale, self._idle = self._idle, []
+        for conn in stale:
+            conn.shutdown()
+        self._start_reaper()
+
+    def close_all(self):
+        """Log out every idle session and forget the credentials."""
+        with self._lock:
+            self._email = None
+            self._password = None
+            self._generation += 1
+            stale, self._idle = self._idle, []
+        for conn in stale:
+            conn.shutdown()
+
+    @property
+    def configured(self):
+        return self._email is not None
+
+    # --- Checkout / return ---
+
+    @contextmanager
+    def connection(self, mailbox="inbox"):
+        """Borrow a session with `mailbox` selected; it is returned on exit.
+
+        Pass mailbox=None to skip SELECT (e.g. for APPEND or LIST).
+        """
+        if not self.configured:
+            raise imaplib.IMAP4.error("IMAP pool is not configured")
+
+        self._slots.acquire()
+        conn = None
+        try:
+            conn = self._acquire(mailbox)
+            try:
+                conn.ensure_selected(mailbox)
+            except (imaplib.IMAP4.abort, OSError):
+                # The session died between the health check and SELECT.
+                self._discard(conn)
+                conn = None
+                self._bump("reconnects")
+                conn = self._connect()
+                conn.ensure_selected(mailbox)
+
+            try:
+                yield conn
+            except (imaplib.IMAP4.abort, OSError):
+                self._discard(conn)
+                conn = None
+                raise
+            except Exception:
+                # Command-level errors leave the session usable, but the
+                # selected mailbox state is no longer trustworthy.
+                conn.selected = None
+                conn.uidvalidity = None
+                raise
+        finally:
+            if conn is not None:
+                self._release(conn)
+            self._slots.release()
+
+    def _acquire(self, mailbox=None):
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                # Prefer a session that already has the mailbox selected (saves a SELECT)
+                match = next((i for i in range(len(self._idle) - 1, -1, -1) if self._idle[i].selected == mailbox), -1)
+                conn = self._idle.pop(match) if self._idle else None
+            if conn is None:
+                self._bump("misses")
+                return self._connect()
+
+            if conn.generation != self._generation:
+                self._discard(conn)
+                continue
+            if now - conn.last_checked > self.health_check_after:
+                if not conn.is_alive():
+                    self._discard(conn)
+                    self._bump("reconnects")
+                    continue
+                conn.last_checked = now
+            self._bump("hits")
+            return conn
+
+    def _release(self, conn):
+        conn.last_used = time.monotonic()
+        # Nobody reads unsolicited responses between checkouts; don't let them pile up
+        conn.imap.untagged_responses.clear()
+        with self._lock:
+            if conn.generation == self._generation and len(self._idle) < self.max_size:
+                self._idle.append(conn)
+                return
+        self._discard(conn)
+
+    def _discard(self, conn):
+        self._bump("discarded")
+        conn.shutdown()
+
+    def _connect(self):
+        with self._lock:
+            email_address, password, generation = self._email, self._password, self._generation
+        if email_address is None:
+            raise imaplib.IMAP4.error("IMAP pool is not configured")
+
+        started = time.perf_counter()
+        with tracer.span("imap.login", host=self.host):
+            imap = open_imap(self.host, self.port, self.ssl)
+            try:
+                imap.login(email_address, password)
+            except Exception:
+                try:
+                    imap.logout()
+                except Exception:
+                    pass
+                raise
+        elapsed = time.perf_counter() - started
+
+        with self._lock:
+            self._stats["handshakes"] += 1
+            self._stats["handshake_seconds_total"] += elapsed
+            self._stats["handshake_seconds_last"] = elapsed
+            self._stats["handshake_seconds_max"] = max(self._stats["handshake_seconds_max"], elapsed)
+        return PooledIMAPConnection(imap, generation)
+
+    # --- Idle reaping ---
+
+    def _start_reaper(self):
+        if self._reaper is not None and self._reaper.is_alive():
+            return
+        self._reaper = threading.Thread(target=self._reap_forever, name="imap-pool-reaper", daemon=True)
+        self._reaper.start()
+
+    def _reap_forever(self):
+        interval = max(1.0, min(self.idle_timeout, self.health_check_after) / 2)
+        # Exits once the pool is closed; configure() starts a new reaper
+        while self.configured:
+            time.sleep(interval)
+            self.reap_idle()
+
+    def reap_idle(self):
+        """Log out sessions that have not been used for `idle_timeout` seconds."""
+        cutoff = time.monotonic() - self.idle_timeout
+        with self._lock:
+            expired = [c for c in self._idle if c.last_used < cutoff]
+            self._idle = [c for c in self._idle if c.last_used >= cutoff]
+            self._stats["reaped"] += len(expired)
+        for conn in expired:
+            conn.shutdown()
+
+    # --- Metrics ---
+
+    def _bump(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["idle_connections"] = len(self._idle)
+        handshakes = snapshot["handshakes"]
+        snapshot["handshake_seconds_avg"] = (
+            snapshot["handshake_seconds_total"] / handshakes if handshakes else 0.0
+        )
+        lookups = snapshot["hits"] + snapshot["misses"]
+        snapshot["hit_ratio"] = snapshot["hits"] / lookups if lookups else 0.0
+        return snapshot
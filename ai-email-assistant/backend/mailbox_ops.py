@@ -0,0 +1,141 @@
+import imaplib
+
+from imap_fetch import compress_id_set
+
+# UIDs per STORE/MOVE/EXPUNGE command, keeps scattered UID sets well under
+# server command-line limits
+BATCH_SIZE = 500
+
+# UIDs covered by the first SEARCH of search_uid_window(); doubles on each further one
+UID_WINDOW = 256
+
+# action -> (STORE operation, flag)
+FLAG_ACTIONS = {
+    "mark_read": ("+FLAGS", "\\Seen"),
+    "mark_unread": ("-FLAGS", "\\Seen"),
+    "star": ("+FLAGS", "\\Flagged"),
+    "unstar": ("-FLAGS", "\\Flagged"),
+}
+# Actions after which the messages are no longer in the mailbox
+REMOVING_ACTIONS = {"delete", "archive"}
+BULK_ACTIONS = sorted(FLAG_ACTIONS) + sorted(REMOVING_ACTIONS)
+
+
+def _batches(uids, size=BATCH_SIZE):
+    for i in range(0, len(uids), size):
+        yield uids[i:i + size]
+
+
+def has_capability(mail, name):
+    return name.upper() in (c.upper() for c in getattr(mail, "capabilities", ()))
+
+
+def existing_uids(mail, uids):
+    """The subset of `uids` still present in the selected mailbox (one UID SEARCH per batch)."""
+    found = set()
+    for batch in _batches(sorted({int(u) for u in uids})):
+        status, data = mail.uid("SEARCH", None, "UID", compress_id_set(batch))
+        if status == "OK" and data and data[0]:
+            found.update(int(u) for u in data[0].split())
+    return found
+
+
+def search_uid_window(mail, low, high, count, newest=True, criteria=None):
+    """Up to `count` UIDs from low..high in the selected mailbox, the highest first (lowest first if not `newest`).
+
+    Searches a UID window at that end of the range and doubles it until
+    `count` UIDs turn up or the range is used up, instead of one SEARCH
+    over everything (SEARCH ALL returns every UID of the mailbox), so the
+    cost follows the page size rather than the mailbox size. `criteria`
+    (e.g. 'SUBJECT "invoice"') narrows each search further.
+    """
+    found = []
+    span = max(UID_WINDOW, count * 2)
+    while low <= high and len(found) < count:
+        lo, hi = (max(low, high - span + 1), high) if newest else (low, min(high, low + span - 1))
+        status, data = mail.uid("SEARCH", None, f"UID {lo}:{hi}" + (f" {criteria}" if criteria else ""))
+        if status != "OK":
+            raise imaplib.IMAP4.error(f"SEARCH failed: {data}")
+        uids = sorted((int(u) for u in (data[0] or b"").split() if lo <= int(u) <= hi), reverse=newest)
+        found.extend(uids)
+        if newest:
+            high = lo - 1
+        else:
+            low = hi + 1
+        span *= 2
+    return found[:count]
+
+
+def uid_expunge(mail, uids):
+    """Expunges just `uids` with UID EXPUNGE (UIDPLUS).
+
+    Without UIDPLUS this falls back to a plain EXPUNGE, which also removes
+    any other message already marked \\Deleted in the mailbox.
+    """
+    if not uids:
+        return
+    if has_capability(mail, "UIDPLUS"):
+        for batch in _batches(sorted(int(u) for u in uids)):
+            mail.uid("EXPUNGE", compress_id_set(batch))
+    else:
+        mail.expunge()
+
+
+def _store(mail, uids, operation, flags):
+    status, data = mail.uid("STORE", compress_id_set(uids), operation, flags)
+    if status != "OK":
+        raise imaplib.IMAP4.error(f"STORE {operation} {flags} failed: {data}")
+
+
+def _archive(mail, uids):
+    try:
+        # Gmail: archiving is removing the Inbox label
+        _store(mail, uids, "-X-GM-LABELS", "\\Inbox")
+        return False
+    except imaplib.IMAP4.error:
+        # Fallback: just remove from inbox
+        _store(mail, uids, "+FLAGS", "\\Deleted")
+        return True
+
+
+def apply_bulk_action(mail, action, uids):
+    """Applies `action` to many messages in the selected mailbox.
+
+    One UID STORE per batch of UIDs (compressed into ranges like
+    "100:180,200") and, for delete, a single UID EXPUNGE at the end.
+    Returns {"succeeded": [uid], "not_found": [uid], "failed": [{"id", "error"}]}.
+    """
+    if action not in FLAG_ACTIONS and action not in REMOVING_ACTIONS:
+        raise ValueError(f"Unknown action {action!r}, expected one of {', '.join(BULK_ACTIONS)}")
+
+    requested = sorted({int(u) for u in uids})
+    present = existing_uids(mail, requested)
+    result = {
+        "succeeded": [],
+        "not_found": [str(u) for u in requested if u not in present],
+        "failed": [],
+    }
+
+    to_expunge = []
+    for batch in _batches(sorted(present)):
+        try:
+            if action in FLAG_ACTIONS:
+                _store(mail, batch, *FLAG_ACTIONS[action])
+            elif action == "delete":
+                _store(mail, batch, "+FLAGS", "\\Deleted")
+                to_expunge.extend(batch)
+            elif _archive(mail, batch):
+                to_expunge.extend(batch)
+            result["succeeded"].extend(str(u) for u in batch)
+        except Exception as e:
+            result["failed"].extend({"id": str(u), "error": str(e)} for u in batch)
+
+    if to_expunge:
+        try:
+            uid_expunge(mail, to_expunge)
+        except Exception as e:
+            # Flagged \Deleted but still there; report them as failed
+            expunge_failed = {str(u) for u in to_expunge}
+            result["succeeded"] = [u for u in result["succeeded"] if u not in expunge_failed]
+            result["failed"].extend({"id": u, "error": f"EXPUNGE failed: {e}"} for u in sorted(expunge_failed, key=int))
+    return result
@@ -1,18 +1,47 @@
 import os
 import imaplib
-import smtplib
-import email
-from email.header import decode_header
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from typing import List, Optional, Dict, Any
 from fastapi import FastAPI, HTTPException, Request, Body
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 import uvicorn
 from dotenv import load_dotenv
 import google.generativeai as genai
 import json
+import re
+import time
+import asyncio
+import functools
+import urllib.parse
+import datetime
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from imap_fetch import fetch_message_summaries, summary_to_listing, decode_subject
+from mime_parser import html_to_text
+from bodystructure import fetch_structure, fetch_text, text_part, attachment_parts, decoded_size, iter_part
+from mailbox_ops import BULK_ACTIONS, REMOVING_ACTIONS, apply_bulk_action, uid_expunge
+from message_cache import MessageCache
+from sync_engine import SyncStore
+from search_index import MailSearchIndex
+from vector_index import VectorIndex, create_embedder
+from event_stream import sse_stream, format_sse
+from sessions import SessionStore, create_session_backend
+from accounts import MailAccount, AccountRegistry
+from outbox import Outbox
+from send_time import parse_send_time
+from conversation_memory import ConversationMemory, estimate_tokens
+from tool_results import ResultShaper
+from tool_cache import ToolCallCache
+from tracing import tracer
+from folders import quote_mailbox
+from gemini_clients import GeminiClients
+from threads import ThreadIndex, reply_references, strip_quoted
 
 load_dotenv()
 
@@ -27,494 +56,778 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# In-memory storage
-active_session = {
-    "email": None,
-    "password": None,
-    "authenticated": False,
-    "gemini_api_key": None,
-    "chat_history": []  # Store conversation history for better memory
-}
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Token sessions: credentials, Gemini key and chat history per user.
+# Kept in memory by default so credentials never touch disk; the sqlite/redis
+# backends let several workers or nodes share them (and store them as-is).
+session_store = SessionStore(create_session_backend(
+    os.getenv("SESSION_BACKEND", "memory"),
+    path=os.getenv("SESSION_DB_PATH", os.path.join(BACKEND_DIR, "sessions.db")),
+    ttl=int(os.getenv("SESSION_TTL", "86400")),
+    max_sessions=int(os.getenv("SESSION_MAX", "1000")),
+    redis_url=os.getenv("REDIS_URL"),
+))
+
+# The session the current request (and the tools it runs) acts for
+current_session = contextvars.ContextVar("current_session", default=None)
+
+# Blocking IMAP/SMTP tools run on this bounded pool so agent turns never block the event loop
+tool_executor = ThreadPoolExecutor(max_workers=int(os.getenv("TOOL_WORKERS", "8")), thread_name_prefix="agent-tool")
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", "45"))
+MODEL_CALL_TIMEOUT = float(os.getenv("MODEL_CALL_TIMEOUT", "60"))
+AGENT_TURN_TIMEOUT = float(os.getenv("AGENT_TURN_TIMEOUT", "120"))
+ATTACHMENT_CHUNK_SIZE = int(os.getenv("ATTACHMENT_CHUNK_SIZE", str(512 * 1024)))
+
+# Attachment types get_attachment returns as text
+TEXT_ATTACHMENT_TYPES = {"application/json", "application/xml", "application/csv", "application/x-yaml"}
+# Longest body get_email_details hands to the result shaper
+MAX_BODY_CHARS = int(os.getenv("MAX_BODY_CHARS", "20000"))
+# Most messages one bulk tool call may touch
+BULK_MAX_MESSAGES = int(os.getenv("BULK_MAX_MESSAGES", "500"))
+# Most messages get_thread returns (the newest ones of longer conversations)
+THREAD_MAX_MESSAGES = int(os.getenv("THREAD_MAX_MESSAGES", "25"))
+
+# Parsed messages keyed by (account, mailbox, UIDVALIDITY, UID)
+MAIL_CACHE_PATH = os.getenv("MAIL_CACHE_PATH", os.path.join(BACKEND_DIR, "mail_cache.db"))
+message_cache = MessageCache(MAIL_CACHE_PATH)
+sync_store = SyncStore(MAIL_CACHE_PATH)
+
+# Full-text index over synced and opened mail, used by search_emails before asking the server
+search_index = MailSearchIndex(MAIL_CACHE_PATH)
+
+# Embeddings of the same mail for semantic_search (offline hashing embedder unless configured)
+vector_index = VectorIndex(MAIL_CACHE_PATH, embedder=create_embedder(
+    os.getenv("SEMANTIC_EMBEDDER", "hashing"),
+    model_name=os.getenv("SEMANTIC_EMBEDDER_MODEL"),
+))
+# Conversations (Message-ID/References/X-GM-THRID) across the synced folders, for get_thread and replies
+thread_index = ThreadIndex(MAIL_CACHE_PATH)
+MAIL_INDEXES = [search_index, vector_index, thread_index]
+
+# Results of read-only tool calls, reused within and across agent turns until
+# they expire or something changes the account's mailbox
+tool_cache = ToolCallCache(
+    ttl=int(os.getenv("TOOL_CACHE_TTL", "60")),
+    max_entries=int(os.getenv("TOOL_CACHE_SIZE", "512")),
+)
+
+def invalidate_tool_cache(account, mailbox, deltas):
+    tool_cache.invalidate(account)
+
+# Per-account IMAP pool, background sync, IDLE push and SSE broker, opened on first use
+mail_accounts = AccountRegistry(
+    factory=functools.partial(
+        MailAccount,
+        sync_store=sync_store,
+        host=os.getenv("IMAP_HOST", "imap.gmail.com"),
+        port=int(os.getenv("IMAP_PORT", "993")),
+        # IMAP_SSL/SMTP_SSL=0 only for local servers such as the benchmark stand-ins
+        ssl=os.getenv("IMAP_SSL", "1") == "1",
+        pool_size=int(os.getenv("IMAP_POOL_SIZE", "4")),
+        pool_idle_timeout=int(os.getenv("IMAP_POOL_IDLE_TIMEOUT", "300")),
+        sync_interval=int(os.getenv("SYNC_INTERVAL", "60")),
+        sync_window=int(os.getenv("SYNC_WINDOW", "500")),
+        indexes=MAIL_INDEXES,
+        smtp_host=os.getenv("SMTP_HOST", "smtp.gmail.com"),
+        smtp_port=int(os.getenv("SMTP_PORT", "465")),
+        smtp_ssl=os.getenv("SMTP_SSL", "1") == "1",
+        smtp_pool_size=int(os.getenv("SMTP_POOL_SIZE", "2")),
+        # Folders kept in sync (roles like "sent"/"all" or label names), synced in parallel
+        sync_mailboxes=[m.strip() for m in os.getenv("SYNC_MAILBOXES", "inbox,sent,all").split(",") if m.strip()],
+        sync_workers=int(os.getenv("SYNC_WORKERS", "2")),
+        # New mail, flag changes and expunges seen by sync make cached results stale
+        sync_listeners=[invalidate_tool_cache],
+    ),
+    idle_timeout=int(os.getenv("ACCOUNT_IDLE_TIMEOUT", "1800")),
+)
+
+def smtp_pool_for(email_address):
+    """The account's SMTP pool; reopens the account from a live session if it was closed (e.g. scheduled mail)."""
+    account = mail_accounts.find(email_address)
+    if account is None:
+        password = session_store.credentials_for(email_address)
+        if password is None:
+            return None
+        account = mail_accounts.get(email_address, password)
+    return account.smtp
+
+# Outgoing and scheduled mail is accepted into a durable queue and delivered by
+# background workers over pooled SMTP sessions (own file, so clearing the mail cache can't drop mail)
+outbox = Outbox(
+    os.getenv("OUTBOX_PATH", os.path.join(BACKEND_DIR, "outbox.db")),
+    smtp_for=smtp_pool_for,
+    workers=int(os.getenv("OUTBOX_WORKERS", "2")),
+    max_attempts=int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8")),
+    claim_timeout=int(os.getenv("OUTBOX_CLAIM_TIMEOUT", "600")),
+)
+outbox.start()
 
 class LoginRequest(BaseModel):
     email: str
     password: str
 
+def get_session(request):
+    """Returns the session for the request's bearer token (or ?token=, for EventSource), or None.
+    
+    The session also becomes the current one for tools run by this request.
+    """
+    auth = request.headers.get("Authorization", "")
+    token = auth[7:] if auth.startswith("Bearer ") else request.query_params.get("token")
+    session = session_store.get(token)
+    if session:
+        current_session.set(session)
+    return session
 
+def account_for(session):
+    """Returns the running MailAccount for a session, opening it on this worker if needed."""
+    return mail_accounts.get(session["email"], session["password"])
 
-def get_imap_connection():
-    if not active_session["authenticated"]:
-        return None
-    try:
-        mail = imaplib.IMAP4_SSL("imap.gmail.com")
-        mail.login(active_session["email"], active_session["password"])
-        return mail
-    except Exception as e:
-        print(f"IMAP Connection Error: {e}")
+def current_account():
+    """Returns the running MailAccount of the current session, or None."""
+    session = current_session.get()
+    if not session:
         return None
+    return account_for(session)
+
+@contextmanager
+def traced_connection(pool, mailbox):
+    """pool.connection() inside an "imap.connection" span; checkout_ms is the wait for the session (login/SELECT included)."""
+    with tracer.span("imap.connection", mailbox=mailbox or "") as span:
+        started = time.perf_counter()
+        with pool.connection(mailbox) as mail:
+            span.set(checkout_ms=round((time.perf_counter() - started) * 1000, 1))
+            yield mail
 
-def get_smtp_connection():
-    if not active_session["authenticated"]:
+def get_imap_connection(mailbox="inbox"):
+    """Borrows a pooled IMAP session with `mailbox` selected (use as a context manager)."""
+    account = current_account()
+    if account is None:
         return None
-    try:
-        server = smtplib.SMTP_SSL("smtp.gmail.com", 465)
-        server.login(active_session["email"], active_session["password"])
-        return server
-    except Exception as e:
-        print(f"SMTP Connection Error: {e}")
+    return traced_connection(account.pool, mailbox)
+
+def resolve_mailbox(mailbox="inbox"):
+    """The server name of a folder given by name, role ("sent", "all", "drafts"...) or Gmail label.
+    
+    Raises ValueError for a mailbox the account doesn't have.
+    """
+    account = current_account()
+    if account is None:
+        return mailbox or "inbox"
+    return account.folders.resolve(mailbox)
+
+def resolve_mailboxes(mailbox):
+    """Server names for a cross-folder `mailbox`: "*" (every synced folder) or a comma-separated list.
+    
+    Returns None when `mailbox` names a single folder.
+    """
+    account = current_account()
+    if account is None or not mailbox or (mailbox.strip() != "*" and "," not in mailbox):
         return None
+    if mailbox.strip() == "*":
+        return account.sync.tracked() or ["inbox"]
+    return list(dict.fromkeys(account.folders.resolve(name) for name in mailbox.split(",") if name.strip()))
+
+def queue_email(msg, send_at=None):
+    """Hands a message to the outbox for the current account; returns its delivery id."""
+    session = current_session.get()
+    # Opens the account (and its SMTP pool) on this worker if needed
+    account_for(session)
+    msg['From'] = session["email"]
+    return outbox.enqueue(session["email"], msg, send_at=send_at)
+
+def forget_messages(email_ids, mailbox="inbox"):
+    """Drops deleted/moved messages from the local cache and indexes, and schedules a sync."""
+    account = current_session.get()["email"]
+    message_cache.discard(account, mailbox, email_ids)
+    for index in MAIL_INDEXES:
+        index.remove(account, mailbox, email_ids)
+    current_account().sync.request_sync(mailbox)
+
+def imap_search_criteria(sender=None, subject=None, date_from=None, date_to=None, query=None):
+    """Builds an IMAP SEARCH string from the search tool's filters (None if no filter is given)."""
+    search_parts = []
+    if query:
+        search_parts.append(f'TEXT "{query}"')
+    if sender:
+        search_parts.append(f'FROM "{sender}"')
+    if subject:
+        search_parts.append(f'SUBJECT "{subject}"')
+    if date_from:
+        search_parts.append(f'SINCE "{date_from}"')
+    if date_to:
+        search_parts.append(f'BEFORE "{date_to}"')
+    return ' '.join(search_parts) or None
 
 # --- Email Tools ---
 
-def fetch_emails_tool(limit=10, query="ALL"):
-    """Fetches emails from the inbox."""
-    mail = get_imap_connection()
-    if not mail:
+def email_page(mailbox="inbox", limit=15, before=None, after=None):
+    """One page of the listing, newest first, from the synced state: {"emails", "next_before", "next_after"}.
+    
+    `mailbox` may name several folders ("*" or a comma list); their pages
+    are merged by date and `after` does not apply.
+    """
+    account = current_account()
+    mailboxes = resolve_mailboxes(mailbox)
+    if mailboxes:
+        return account.sync.list_across(mailboxes, limit=limit, before=before)
+    return account.sync.page(resolve_mailbox(mailbox), limit=limit, before=before, after=after)
+
+def fetch_emails_tool(limit=10, query="ALL", mailbox="inbox", before=None, after=None):
+    """Fetches a page of emails from a folder, or from several at once (served from the locally synced state)."""
+    if not current_session.get():
         return json.dumps({"error": "Not authenticated"})
     
     try:
-        mail.select("inbox")
-        
-        # Search for emails
-        search_crit = "ALL"
+        limit = max(1, min(int(limit or 10), 100))
         if query and query != "ALL":
-            search_crit = f'(SUBJECT "{query}")'
-            
-        status, search_data = mail.search(None, search_crit)
-        if status != 'OK' or not search_data[0]:
-            # Fallback to ALL if search fails
-            _, search_data = mail.search(None, "ALL")
-
-        mail_ids = search_data[0].split()
-        if not mail_ids:
-            mail.close()
-            mail.logout()
-            return json.dumps([])
+            return json.dumps(subject_search_page(query, limit, mailbox, before, after))
         
-        # Get latest emails
-        latest_ids = mail_ids[-int(limit):]
-        latest_ids.reverse()
+        page = email_page(mailbox, limit, before, after)
+        for row in page["emails"]:
+            row.pop("flags", None)
+        return json.dumps({
+            "results": page["emails"],
+            "next_before": page["next_before"],
+            "next_after": page["next_after"]
+        })
+    except Exception as e:
+        print(f"Error in fetch_emails_tool: {str(e)}")
+        return json.dumps({"error": f"Error fetching emails: {str(e)}"})
+
+def subject_search_page(query, limit, mailbox="inbox", before=None, after=None):
+    """A fetch_emails page of emails whose subject contains `query`; raises if the server search fails.
+    
+    Searches the server within the cursor's UID range, so the response
+    only holds matching UIDs; across folders the synced state is filtered.
+    """
+    mailboxes = resolve_mailboxes(mailbox)
+    if mailboxes:
+        rows = current_account().sync.list_across(mailboxes, limit=500)["emails"]
+        rows = [r for r in rows if query.lower() in r["subject"].lower()][:limit]
+        for row in rows:
+            row.pop("flags", None)
+        return {"results": rows, "next_before": None, "next_after": None}
+    
+    before, after = (int(before) if before else None), (int(after) if after else None)
+    if before is not None and before <= 1:
+        return {"results": [], "next_before": None, "next_after": None}
+    uid_range = f"UID {after + 1}:*" if after is not None else f"UID 1:{before - 1}" if before else ""
+    with get_imap_connection(resolve_mailbox(mailbox)) as mail:
+        status, search_data = mail.uid("SEARCH", None, f'{uid_range} (SUBJECT "{query}")'.strip())
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"SEARCH failed: {search_data}")
+        # "n:*" also matches the highest UID when none is above n
+        mail_ids = [u for u in search_data[0].split() if after is None or int(u) > after]
+        page_ids = mail_ids[:limit] if after is not None else mail_ids[-limit:]
+        more = len(mail_ids) > limit
         
         emails_data = []
-        for i in latest_ids:
+        for summary in fetch_message_summaries(mail, page_ids[::-1]):
             try:
-                _, msg_data = mail.fetch(i, "(RFC822)")
-                for response_part in msg_data:
-                    if isinstance(response_part, tuple):
-                        msg = email.message_from_bytes(response_part[1])
-                        
-                        # Get subject safely
-                        subject = "No Subject"
-                        if msg.get("Subject"):
-                            try:
-                                decoded_parts = decode_header(msg["Subject"])
-                                subject_parts = []
-                                for content, encoding in decoded_parts:
-                                    if isinstance(content, bytes):
-                                        subject_parts.append(content.decode(encoding if encoding else "utf-8", errors="ignore"))
-                                    else:
-                                        subject_parts.append(str(content))
-                                subject = "".join(subject_parts)
-                            except:
-                                subject = str(msg.get("Subject", "No Subject"))
-                        
-                        # Get sender safely
-                        sender = msg.get("From", "Unknown Sender")
-                        
-                        # Get body safely
-                        body = ""
-                        try:
-                            if msg.is_multipart():
-                                for part in msg.walk():
-                                    if part.get_content_type() == "text/plain":
-                                        try:
-                                            payload = part.get_payload(decode=True)
-                                            if payload:
-                                                body = payload.decode("utf-8", errors="ignore")
-                                                break
-                                        except:
-                                            continue
-                            else:
-                                payload = msg.get_payload(decode=True)
-                                if payload:
-                                    body = payload.decode("utf-8", errors="ignore")
-                        except:
-                            body = "Could not decode email body"
-                        
-                        emails_data.append({
-                            "id": str(int(i)),
-                            "sender": sender,
-                            "subject": subject,
-                            "body_snippet": body[:200] if body else "No content"
-                        })
+                row = summary_to_listing(summary)
+                del row["flags"]
+                emails_data.append(row)
             except Exception as e:
-                print(f"Error processing email {i}: {str(e)}")
+                print(f"Error processing email {summary['id']}: {str(e)}")
                 continue
-        
-        mail.close()
-        mail.logout()
-        return json.dumps(emails_data)
-    except Exception as e:
-        print(f"Error in fetch_emails_tool: {str(e)}")
-        return json.dumps({"error": f"Error fetching emails: {str(e)}"})
+    
+    return {
+        "results": emails_data,
+        "next_before": emails_data[-1]["id"] if emails_data and (more or after is not None) else None,
+        "next_after": emails_data[0]["id"] if emails_data and (more if after is not None else before is not None) else None
+    }
 
 def send_email_tool(to_email, subject, body):
-    """Sends an email."""
-    server = get_smtp_connection()
-    if not server:
+    """Sends an email (queued and delivered in the background)."""
+    if not current_session.get():
         return "Error: Not authenticated."
     
     try:
         msg = MIMEMultipart()
-        msg['From'] = active_session["email"]
         msg['To'] = to_email
         msg['Subject'] = subject
         msg.attach(MIMEText(body, 'plain'))
         
-        server.send_message(msg)
-        server.quit()
-        return f"Email sent successfully to {to_email}"
+        delivery_id = queue_email(msg)
+        return f"Email to {to_email} accepted for delivery (delivery id: {delivery_id})"
     except Exception as e:
         return f"Error sending email: {str(e)}"
 
-def count_unread_tool():
+def count_unread_tool(mailbox="inbox"):
     """Counts unread emails."""
-    mail = get_imap_connection()
-    if not mail:
-        return "Error: Not authenticated."
     try:
-        mail.select("inbox")
-        _, search_data = mail.search(None, "UNSEEN")
-        count = len(search_data[0].split())
-        mail.close()
-        mail.logout()
-        return str(count)
+        conn = get_imap_connection(resolve_mailbox(mailbox))
+        if not conn:
+            return "Error: Not authenticated."
+        with conn as mail:
+            _, search_data = mail.search(None, "UNSEEN")
+            count = len(search_data[0].split())
+            return str(count)
     except Exception as e:
         return f"Error counting unread: {str(e)}"
 
-def delete_email_tool(email_id):
+def delete_email_tool(email_id, mailbox="inbox"):
     """Deletes an email by ID."""
-    mail = get_imap_connection()
-    if not mail:
-        return "Error: Not authenticated."
     try:
-        mail.select("inbox")
-        mail.store(email_id, '+FLAGS', '\\Deleted')
-        mail.expunge()
-        mail.close()
-        mail.logout()
-        return f"Email {email_id} deleted successfully"
+        mailbox = resolve_mailbox(mailbox)
+        conn = get_imap_connection(mailbox)
+        if not conn:
+            return "Error: Not authenticated."
+        with conn as mail:
+            mail.uid("STORE", str(email_id), '+FLAGS', '\\Deleted')
+            uid_expunge(mail, [email_id])
+            forget_messages([email_id], mailbox)
+            return f"Email {email_id} deleted successfully"
     except Exception as e:
         return f"Error deleting email: {str(e)}"
 
-def mark_as_read_tool(email_id):
+def mark_as_read_tool(email_id, mailbox="inbox"):
     """Marks an email as read."""
-    mail = get_imap_connection()
-    if not mail:
-        return "Error: Not authenticated."
     try:
-        mail.select("inbox")
-        mail.store(email_id, '+FLAGS', '\\Seen')
-        mail.close()
-        mail.logout()
-        return f"Email {email_id} marked as read"
+        mailbox = resolve_mailbox(mailbox)
+        conn = get_imap_connection(mailbox)
+        if not conn:
+            return "Error: Not authenticated."
+        with conn as mail:
+            mail.uid("STORE", str(email_id), '+FLAGS', '\\Seen')
+            current_account().sync.request_sync(mailbox)
+            return f"Email {email_id} marked as read"
     except Exception as e:
         return f"Error marking as read: {str(e)}"
 
-def mark_as_unread_tool(email_id):
+def mark_as_unread_tool(email_id, mailbox="inbox"):
     """Marks an email as unread."""
-    mail = get_imap_connection()
-    if not mail:
-        return "Error: Not authenticated."
     try:
-        mail.select("inbox")
-        mail.store(email_id, '-FLAGS', '\\Seen')
-        mail.close()
-        mail.logout()
-        return f"Email {email_id} marked as unread"
+        mailbox = resolve_mailbox(mailbox)
+        conn = get_imap_connection(mailbox)
+        if not conn:
+            return "Error: Not authenticated."
+        with conn as mail:
+            mail.uid("STORE", str(email_id), '-FLAGS', '\\Seen')
+            current_account().sync.request_sync(mailbox)
+            return f"Email {email_id} marked as unread"
     except Exception as e:
         return f"Error marking as unread: {str(e)}"
 
-def search_emails_tool(sender=None, subject=None, date_from=None, date_to=None):
-    """Advanced email search by sender, subject, or date range."""
-    mail = get_imap_connection()
-    if not mail:
+def search_emails_tool(sender=None, subject=None, date_from=None, date_to=None, query=None, page=1, page_size=10, mailbox="inbox"):
+    """Advanced email search by sender, subject, body text or date range.
+    
+    The synced part of a folder is searched in the local full-text index;
+    matches older than the synced window are found with a server SEARCH
+    below it and listed after the local ones. Folders never synced are
+    searched on the server. Searches over several folders only use the
+    local index.
+    """
+    session = current_session.get()
+    if not session:
+        return json.dumps({"error": "Not authenticated"})
+    
+    page = max(1, int(page or 1))
+    page_size = max(1, min(int(page_size or 10), 50))
+    offset = (page - 1) * page_size
+    sync = current_account().sync
+    try:
+        mailboxes = resolve_mailboxes(mailbox)
+        if not mailboxes:
+            mailbox = resolve_mailbox(mailbox)
+    except ValueError as e:
+        return json.dumps({"error": str(e)})
+    if mailboxes:
+        sync.ensure_synced(mailboxes)
+        found = search_index.search(
+            session["email"], mailboxes, query=query, sender=sender, subject=subject,
+            date_from=date_from, date_to=date_to, limit=page_size, offset=offset
+        )
+        if found is None:
+            return json.dumps({"error": "Searching several folders needs the local index, which is unavailable"})
+        result = {
+            "source": "local",
+            "page": page,
+            "total": found["total"],
+            "has_more": offset + page_size < found["total"],
+            "results": found["results"]
+        }
+        partial = [name for name in mailboxes if sync.unsynced_below(name) is not None]
+        if partial:
+            result["note"] = f"Only recent mail of {', '.join(partial)} is searched across folders; search one folder to include older mail."
+        return json.dumps(result)
+    
+    found, low = None, None
+    if sync.is_synced(mailbox):
+        # Below `low` (if set) the mailbox is only on the server
+        low = sync.unsynced_below(mailbox)
+        found = search_index.search(
+            session["email"], mailbox, query=query, sender=sender, subject=subject,
+            date_from=date_from, date_to=date_to, limit=page_size, offset=offset, min_uid=low
+        )
+    if found and low is None and (found["total"] or page > 1):
+        return json.dumps({
+            "source": "local",
+            "page": page,
+            "total": found["total"],
+            "has_more": offset + page_size < found["total"],
+            "results": found["results"]
+        })
+    
+    conn = get_imap_connection(mailbox)
+    if not conn:
+        return json.dumps({"error": "Not authenticated"})
+    
+    try:
+        with conn as mail:
+            criteria = imap_search_criteria(sender, subject, date_from, date_to, query)
+            if found is not None and low is not None:
+                search_crit = f"UID 1:{low - 1}" + (f" {criteria}" if criteria else "")
+                local_total, emails_data = found["total"], list(found["results"])
+            else:
+                search_crit = criteria or "ALL"
+                local_total, emails_data = 0, []
+            
+            _, search_data = mail.uid("SEARCH", None, search_crit)
+            mail_ids = search_data[0].split()
+            
+            # Newest matches first, after the local ones
+            mail_ids.reverse()
+            start = max(0, offset - local_total)
+            page_ids = mail_ids[start:start + page_size - len(emails_data)]
+            
+            for summary in fetch_message_summaries(mail, page_ids, snippet_bytes=0):
+                msg = summary["message"]
+                emails_data.append({
+                    "id": summary["id"],
+                    "sender": msg.get("From", "Unknown"),
+                    "subject": decode_subject(msg),
+                    "date": msg.get("Date", "Unknown")
+                })
+            
+            total = local_total + len(mail_ids)
+            return json.dumps({
+                "source": "local+server" if local_total else "server",
+                "page": page,
+                "total": total,
+                "has_more": offset + page_size < total,
+                "results": emails_data
+            })
+    except Exception as e:
+        return json.dumps({"error": f"Search failed: {str(e)}"})
+
+def semantic_search_tool(query, limit=5, mailbox="inbox"):
+    """Finds the emails closest in meaning to a description, from the local vector index."""
+    session = current_session.get()
+    if not session:
         return json.dumps({"error": "Not authenticated"})
     
     try:
-        mail.select("inbox")
-        
-        # Build search criteria
-        search_parts = []
-        if sender:
-            search_parts.append(f'FROM "{sender}"')
-        if subject:
-            search_parts.append(f'SUBJECT "{subject}"')
-        if date_from:
-            search_parts.append(f'SINCE "{date_from}"')
-        if date_to:
-            search_parts.append(f'BEFORE "{date_to}"')
-        
-        search_crit = ' '.join(search_parts) if search_parts else "ALL"
-        
-        _, search_data = mail.search(None, search_crit)
-        mail_ids = search_data[0].split()
-        
-        if not mail_ids:
-            mail.close()
-            mail.logout()
-            return json.dumps([])
+        limit = max(1, min(int(limit or 5), 20))
+        mailboxes = resolve_mailboxes(mailbox)
+        if mailboxes:
+            results = [
+                {**result, "mailbox": name}
+                for name in mailboxes
+                for result in vector_index.search(session["email"], name, query, limit=limit)
+            ]
+            results = sorted(results, key=lambda r: r["score"], reverse=True)[:limit]
+        else:
+            results = vector_index.search(session["email"], resolve_mailbox(mailbox), query, limit=limit)
+        if not results:
+            return json.dumps({"results": [], "note": "The mailbox has not been indexed yet; try search_emails."})
+        return json.dumps({"results": results})
+    except Exception as e:
+        return json.dumps({"error": f"Semantic search failed: {str(e)}"})
+
+# Bumped when the record layout changes so older cached records are re-fetched
+MESSAGE_RECORD_VERSION = 2
+
+def build_message_record(uid, header, body, attachments):
+    """Builds the record stored in the local message cache from the headers, body text and attachment list."""
+    return {
+        "version": MESSAGE_RECORD_VERSION,
+        "uid": str(uid),
+        "from": header.get("From", "Unknown"),
+        "to": header.get("To", "Unknown"),
+        "cc": header.get("Cc", ""),
+        "subject": decode_subject(header),
+        "raw_subject": header.get("Subject", ""),
+        "date": header.get("Date", "Unknown"),
+        "message_id": header.get("Message-ID", ""),
+        "in_reply_to": header.get("In-Reply-To", ""),
+        "references": header.get("References", ""),
+        "body": body,
+        "attachments": attachments
+    }
+
+def load_message_record(mail, email_id, mailbox="inbox"):
+    """Returns the parsed record for message UID `email_id`, from the local cache when possible.
+    
+    Only the headers, BODYSTRUCTURE and the text part are downloaded;
+    attachments stay on the server until someone asks for one.
+    """
+    account = current_session.get()["email"]
+    cached = message_cache.get(account, mailbox, mail.uidvalidity, email_id)
+    if cached and cached.get("version") == MESSAGE_RECORD_VERSION:
+        return cached
+    
+    parts, header = fetch_structure(mail, email_id)
+    if parts is None:
+        return None
+    
+    body_part = text_part(parts)
+    try:
+        body = fetch_text(mail, email_id, body_part) if body_part else ""
+    except Exception:
+        body = "Could not decode"
+    
+    record = build_message_record(email_id, header, body, attachment_parts(parts))
+    message_cache.put(account, mailbox, mail.uidvalidity, email_id, record)
+    # Upgrade the partial search documents to the full body
+    document = {
+        "uid": email_id,
+        "sender": record["from"],
+        "recipients": f'{record["to"]} {record["cc"]}',
+        "subject": record["subject"],
+        "body": record["body"],
+        "date": record["date"],
+        "message_id": record["message_id"],
+        "in_reply_to": record["in_reply_to"],
+        "references": record["references"],
+        "from_header": record["from"],
+        "subject_header": record["raw_subject"]
+    }
+    for index in MAIL_INDEXES:
+        index.index(account, mailbox, [document])
+    return record
+
+def get_email_details_tool(email_id, mailbox="inbox"):
+    """Gets full email details including body and attachments info."""
+    try:
+        mailbox = resolve_mailbox(mailbox)
+        conn = get_imap_connection(mailbox)
+        if not conn:
+            return json.dumps({"error": "Not authenticated"})
         
-        # Get latest 10 matching emails
-        latest_ids = mail_ids[-10:]
-        latest_ids.reverse()
+        with conn as mail:
+            record = load_message_record(mail, email_id, mailbox)
         
-        emails_data = []
-        for i in latest_ids:
-            try:
-                _, msg_data = mail.fetch(i, "(RFC822)")
-                for response_part in msg_data:
-                    if isinstance(response_part, tuple):
-                        msg = email.message_from_bytes(response_part[1])
-                        
-                        subject_text = "No Subject"
-                        if msg.get("Subject"):
-                            try:
-                                decoded_parts = decode_header(msg["Subject"])
-                                subject_parts = []
-                                for content, encoding in decoded_parts:
-                                    if isinstance(content, bytes):
-                                        subject_parts.append(content.decode(encoding if encoding else "utf-8", errors="ignore"))
-                                    else:
-                                        subject_parts.append(str(content))
-                                subject_text = "".join(subject_parts)
-                            except:
-                                subject_text = str(msg.get("Subject", "No Subject"))
-                        
-                        emails_data.append({
-                            "id": str(int(i)),
-                            "sender": msg.get("From", "Unknown"),
-                            "subject": subject_text,
-                            "date": msg.get("Date", "Unknown")
-                        })
-            except:
-                continue
+        if not record:
+            return json.dumps({"error": "Email not found"})
         
-        mail.close()
-        mail.logout()
-        return json.dumps(emails_data)
+        return json.dumps({
+            "id": email_id,
+            "from": record["from"],
+            "to": record["to"],
+            "subject": record["subject"],
+            "date": record["date"],
+            # Cut to the turn's token budget when the result is shaped for the model
+            "body": record["body"][:MAX_BODY_CHARS],
+            "attachments": record["attachments"]
+        })
     except Exception as e:
-        return json.dumps({"error": f"Search failed: {str(e)}"})
+        return json.dumps({"error": f"Error: {str(e)}"})
 
-def get_email_details_tool(email_id):
-    """Gets full email details including body and attachments info."""
-    mail = get_imap_connection()
-    if not mail:
+def load_thread(email_id, mailbox="inbox"):
+    """The conversation message `email_id` belongs to, across the synced folders, or None if it doesn't exist.
+    
+    Membership comes from the local thread index; bodies from the message
+    cache, fetched (one connection per folder) only for messages not read
+    before. Quoted text is stripped, since the earlier messages are there.
+    """
+    account = current_session.get()["email"]
+    entry = thread_index.message(account, mailbox, email_id)
+    if entry is None:
+        # Older than the sync window: reading it indexes it
+        with get_imap_connection(mailbox) as mail:
+            if not load_message_record(mail, email_id, mailbox):
+                return None
+        entry = thread_index.message(account, mailbox, email_id)
+    
+    # Gmail lists every message in All Mail too: keep one copy, preferring the folder asked about, then the inbox
+    rows = thread_index.thread(account, entry["thread"])
+    preference = {mailbox: 0, "inbox": 1}
+    copies = {}
+    for row in sorted(rows, key=lambda r: preference.get(r["mailbox"], 2)):
+        copies.setdefault(row["message_id"], row)
+    rows = [row for row in rows if copies[row["message_id"]] is row]
+    total = len(rows)
+    rows = rows[-THREAD_MAX_MESSAGES:]
+    
+    records = {}
+    for name in dict.fromkeys(row["mailbox"] for row in rows):
+        with get_imap_connection(name) as mail:
+            for row in rows:
+                if row["mailbox"] == name:
+                    records[(name, row["id"])] = load_message_record(mail, row["id"], name)
+    
+    messages = []
+    for row in rows:
+        record = records.get((row["mailbox"], row["id"]))
+        if not record:
+            # Gone from the server since it was indexed
+            continue
+        messages.append({
+            "id": row["id"],
+            "mailbox": row["mailbox"],
+            "from": row["sender"],
+            "to": record["to"],
+            "date": record["date"],
+            "body": strip_quoted(record["body"])[:MAX_BODY_CHARS],
+            "attachments": [a["filename"] for a in record["attachments"]]
+        })
+    return {
+        "thread_id": entry["thread"],
+        "subject": rows[0]["subject"] if rows else entry["subject"],
+        "message_count": total,
+        "participants": list(dict.fromkeys(m["from"] for m in messages)),
+        "messages": messages,
+        **({"note": f"Only the newest {len(rows)} of {total} messages are included."} if total > len(rows) else {})
+    }
+
+def get_thread_tool(email_id, mailbox="inbox"):
+    """Gets a whole conversation (every message of the email's thread, oldest first) in one call."""
+    if not current_session.get():
         return json.dumps({"error": "Not authenticated"})
     
     try:
-        mail.select("inbox")
-        _, msg_data = mail.fetch(str(email_id), "(RFC822)")
+        thread = load_thread(email_id, resolve_mailbox(mailbox))
+        if thread is None:
+            return json.dumps({"error": "Email not found"})
+        return json.dumps(thread)
+    except Exception as e:
+        return json.dumps({"error": f"Error loading thread: {str(e)}"})
+
+def attachment_download_path(email_id, part, mailbox="inbox"):
+    path = f"/api/emails/{email_id}/attachments/{part}"
+    if mailbox != "inbox":
+        path += "?" + urllib.parse.urlencode({"mailbox": mailbox})
+    return path
+
+def get_attachment_tool(email_id, part, max_chars=4000, mailbox="inbox"):
+    """Gets one attachment: its metadata and download link, plus the text of text-like attachments."""
+    try:
+        mailbox = resolve_mailbox(mailbox)
+        conn = get_imap_connection(mailbox)
+        if not conn:
+            return json.dumps({"error": "Not authenticated"})
         
-        for response_part in msg_data:
-            if isinstance(response_part, tuple):
-                msg = email.message_from_bytes(response_part[1])
-                
-                # Get subject
-                subject = "No Subject"
-                if msg.get("Subject"):
-                    try:
-                        decoded_parts = decode_header(msg["Subject"])
-                        subject_parts = []
-                        for content, encoding in decoded_parts:
-                            if isinstance(content, bytes):
-                                subject_parts.append(content.decode(encoding if encoding else "utf-8", errors="ignore"))
-                            else:
-                                subject_parts.append(str(content))
-                        subject = "".join(subject_parts)
-                    except:
-                        subject = str(msg.get("Subject", "No Subject"))
-                
-                # Get body
-                body = ""
-                attachments = []
-                
-                if msg.is_multipart():
-                    for part in msg.walk():
-                        content_type = part.get_content_type()
-                        content_disposition = str(part.get("Content-Disposition"))
-                        
-                        if "attachment" in content_disposition:
-                            filename = part.get_filename()
-                            if filename:
-                                attachments.append(filename)
-                        elif content_type == "text/plain" and not body:
-                            try:
-                                payload = part.get_payload(decode=True)
-                                if payload:
-                                    body = payload.decode("utf-8", errors="ignore")
-                            except:
-                                pass
-                else:
-                    try:
-                        payload = msg.get_payload(decode=True)
-                        if payload:
-                            body = payload.decode("utf-8", errors="ignore")
-                    except:
-                        body = "Could not decode"
-                
-                mail.close()
-                mail.logout()
-                
-                return json.dumps({
-                    "id": email_id,
-                    "from": msg.get("From", "Unknown"),
-                    "to": msg.get("To", "Unknown"),
-                    "subject": subject,
-                    "date": msg.get("Date", "Unknown"),
-                    "body": body[:1000],  # Limit to 1000 chars
-                    "attachments": attachments
-                })
+        with conn as mail:
+            parts, _ = fetch_structure(mail, email_id, with_header=False)
+            target = next((p for p in parts or [] if p["part"] == str(part)), None)
+            if not target:
+                return json.dumps({"error": f"Email {email_id} has no part {part}"})
+            
+            info = {
+                "id": email_id,
+                "part": target["part"],
+                "filename": target["filename"],
+                "content_type": target["content_type"],
+                "size": decoded_size(target),
+                "download_url": attachment_download_path(email_id, target["part"], mailbox)
+            }
+            if target["content_type"].startswith("text/") or target["content_type"] in TEXT_ATTACHMENT_TYPES:
+                # Read only as much of the part as the model will see
+                max_chars = max(1, int(max_chars))
+                data = b"".join(iter_part(mail, email_id, target, chunk_size=max_chars * 2, max_bytes=max_chars * 2))
+                text = data.decode(target["charset"] or "utf-8", errors="replace")
+                if target["content_type"] == "text/html":
+                    text = html_to_text(text)
+                info["content"] = text[:max_chars]
+                info["truncated"] = len(text) > max_chars or decoded_size(target) > len(data)
         
-        mail.close()
-        mail.logout()
-        return json.dumps({"error": "Email not found"})
+        return json.dumps(info)
     except Exception as e:
-        return json.dumps({"error": f"Error: {str(e)}"})
+        return json.dumps({"error": f"Error reading attachment: {str(e)}"})
 
-def reply_to_email_tool(email_id, reply_body):
+def reply_to_email_tool(email_id, reply_body, mailbox="inbox"):
     """Replies to an email."""
-    mail = get_imap_connection()
-    if not mail:
+    session = current_session.get()
+    if not session:
         return "Error: Not authenticated."
     
     try:
-        # Get original email
-        mail.select("inbox")
-        _, msg_data = mail.fetch(str(email_id), "(RFC822)")
-        
-        original_msg = None
-        for response_part in msg_data:
-            if isinstance(response_part, tuple):
-                original_msg = email.message_from_bytes(response_part[1])
-                break
-        
-        if not original_msg:
-            return "Error: Original email not found"
+        mailbox = resolve_mailbox(mailbox)
+        # The thread index keeps the headers a reply needs; the original is only fetched if it was never synced
+        indexed = thread_index.message(session["email"], mailbox, email_id)
+        if indexed:
+            original = indexed["headers"]
+        else:
+            with get_imap_connection(mailbox) as mail:
+                record = load_message_record(mail, email_id, mailbox)
+            if not record:
+                return "Error: Original email not found"
+            original = {"from": record["from"], "subject": record["raw_subject"],
+                        "message_id": record["message_id"], "references": record["references"]}
         
         # Get original sender and subject
-        to_email = original_msg.get("From")
-        original_subject = original_msg.get("Subject", "")
-        reply_subject = f"Re: {original_subject}" if not original_subject.startswith("Re:") else original_subject
-        
-        mail.close()
-        mail.logout()
-        
-        # Send reply
-        server = get_smtp_connection()
-        if not server:
-            return "Error: SMTP connection failed"
+        to_email = original["from"]
+        original_subject = original["subject"]
+        reply_subject = f"Re: {original_subject}" if not original_subject.lower().startswith("re:") else original_subject
         
+        # Send reply, threaded under the whole chain the original belongs to
         msg = MIMEMultipart()
-        msg['From'] = active_session["email"]
         msg['To'] = to_email
         msg['Subject'] = reply_subject
-        msg['In-Reply-To'] = original_msg.get("Message-ID", "")
-        msg['References'] = original_msg.get("Message-ID", "")
+        if original["message_id"]:
+            msg['In-Reply-To'] = original["message_id"]
+        references = reply_references(original["references"], original["message_id"])
+        if references:
+            msg['References'] = references
         msg.attach(MIMEText(reply_body, 'plain'))
         
-        server.send_message(msg)
-        server.quit()
-        
-        return f"Reply sent successfully to {to_email}"
+        delivery_id = queue_email(msg)
+        return f"Reply to {to_email} accepted for delivery (delivery id: {delivery_id})"
     except Exception as e:
         return f"Error replying: {str(e)}"
 
-def forward_email_tool(email_id, to_email, message=""):
+def forward_email_tool(email_id, to_email, message="", mailbox="inbox"):
     """Forwards an email to another recipient."""
-    mail = get_imap_connection()
-    if not mail:
-        return "Error: Not authenticated."
-    
     try:
-        mail.select("inbox")
-        _, msg_data = mail.fetch(str(email_id), "(RFC822)")
+        mailbox = resolve_mailbox(mailbox)
+        conn = get_imap_connection(mailbox)
+        if not conn:
+            return "Error: Not authenticated."
         
-        original_msg = None
-        for response_part in msg_data:
-            if isinstance(response_part, tuple):
-                original_msg = email.message_from_bytes(response_part[1])
-                break
+        with conn as mail:
+            original = load_message_record(mail, email_id, mailbox)
         
-        if not original_msg:
+        if not original:
             return "Error: Original email not found"
         
-        original_subject = original_msg.get("Subject", "")
+        original_subject = original["raw_subject"]
         forward_subject = f"Fwd: {original_subject}" if not original_subject.startswith("Fwd:") else original_subject
-        
-        # Get original body
-        original_body = ""
-        if original_msg.is_multipart():
-            for part in original_msg.walk():
-                if part.get_content_type() == "text/plain":
-                    try:
-                        payload = part.get_payload(decode=True)
-                        if payload:
-                            original_body = payload.decode("utf-8", errors="ignore")
-                            break
-                    except:
-                        pass
-        else:
-            try:
-                payload = original_msg.get_payload(decode=True)
-                if payload:
-                    original_body = payload.decode("utf-8", errors="ignore")
-            except:
-                pass
-        
-        mail.close()
-        mail.logout()
+        original_body = original["body"]
         
         # Send forward
-        server = get_smtp_connection()
-        if not server:
-            return "Error: SMTP connection failed"
-        
         msg = MIMEMultipart()
-        msg['From'] = active_session["email"]
         msg['To'] = to_email
         msg['Subject'] = forward_subject
         
         forward_body = f"{message}\n\n---------- Forwarded message ----------\n{original_body}"
         msg.attach(MIMEText(forward_body, 'plain'))
         
-        server.send_message(msg)
-        server.quit()
-        
-        return f"Email forwarded successfully to {to_email}"
+        delivery_id = queue_email(msg)
+        return f"Forward to {to_email} accepted for delivery (delivery id: {delivery_id})"
     except Exception as e:
         return f"Error forwarding: {str(e)}"
 
 def create_draft_tool(to_email, subject, body):
     """Creates a draft email (saves to Drafts folder)."""
-    mail = get_imap_connection()
-    if not mail:
+    # APPEND does not need a selected mailbox
+    conn = get_imap_connection(mailbox=None)
+    if not conn:
         return "Error: Not authenticated."
     
     try:
         # Create email message
         msg = MIMEMultipart()
-        msg['From'] = active_session["email"]
+        msg['From'] = current_session.get()["email"]
         msg['To'] = to_email
         msg['Subject'] = subject
         msg.attach(MIMEText(body, 'plain'))
         
-        # Save to Drafts
-        mail.select("[Gmail]/Drafts")
-        mail.append("[Gmail]/Drafts", '', imaplib.Time2Internaldate(None), msg.as_bytes())
-        
-        mail.close()
-        mail.logout()
+        # Save to the account's Drafts folder (found by its \Drafts role)
+        drafts = resolve_mailbox("drafts")
+        with conn as mail:
+            mail.append(quote_mailbox(drafts), '', imaplib.Time2Internaldate(time.time()), msg.as_bytes())
         
         return f"Draft created successfully for {to_email}"
     except Exception as e:
@@ -522,622 +835,1428 @@ def create_draft_tool(to_email, subject, body):
 
 def archive_email_tool(email_id):
     """Archives an email (removes from inbox, keeps in All Mail)."""
-    mail = get_imap_connection()
-    if not mail:
+    conn = get_imap_connection()
+    if not conn:
         return "Error: Not authenticated."
     
     try:
-        mail.select("inbox")
-        # Move to All Mail by removing Inbox label
-        mail.store(email_id, '-X-GM-LABELS', '\\Inbox')
-        mail.close()
-        mail.logout()
-        return f"Email {email_id} archived successfully"
-    except Exception as e:
-        # Fallback: just remove from inbox
-        try:
-            mail.select("inbox")
-            mail.store(email_id, '+FLAGS', '\\Deleted')
-            mail.expunge()
-            mail.close()
-            mail.logout()
+        with conn as mail:
+            try:
+                # Move to All Mail by removing Inbox label
+                status, data = mail.uid("STORE", str(email_id), '-X-GM-LABELS', '\\Inbox')
+            except imaplib.IMAP4.error:
+                status = None
+            if status == 'OK':
+                forget_messages([email_id])
+                return f"Email {email_id} archived successfully"
+            
+            # Fallback: just remove from inbox
+            status, data = mail.uid("STORE", str(email_id), '+FLAGS', '\\Deleted')
+            if status != 'OK':
+                return f"Error archiving: {data}"
+            uid_expunge(mail, [email_id])
+            forget_messages([email_id])
             return f"Email {email_id} removed from inbox"
-        except:
-            return f"Error archiving: {str(e)}"
+    except Exception as e:
+        return f"Error archiving: {str(e)}"
 
-def star_email_tool(email_id):
+def star_email_tool(email_id, mailbox="inbox"):
     """Stars/flags an email."""
-    mail = get_imap_connection()
-    if not mail:
-        return "Error: Not authenticated."
-    
     try:
-        mail.select("inbox")
-        mail.store(email_id, '+FLAGS', '\\Flagged')
-        mail.close()
-        mail.logout()
-        return f"Email {email_id} starred successfully"
+        mailbox = resolve_mailbox(mailbox)
+        conn = get_imap_connection(mailbox)
+        if not conn:
+            return "Error: Not authenticated."
+        
+        with conn as mail:
+            mail.uid("STORE", str(email_id), '+FLAGS', '\\Flagged')
+            current_account().sync.request_sync(mailbox)
+            return f"Email {email_id} starred successfully"
     except Exception as e:
         return f"Error starring email: {str(e)}"
 
-def extract_contacts_tool(limit=20):
+def bulk_email_action_tool(action, email_ids=None, sender=None, subject=None, date_from=None, date_to=None, query=None, mailbox="inbox"):
+    """Applies one action (delete, archive, mark_read, ...) to many emails at once.
+
+    Targets are the given IDs, or every email matching the search filters
+    (newest first, at most BULK_MAX_MESSAGES). Runs one UID STORE over the
+    whole UID set instead of one call per email, and reports each ID's result.
+    """
+    if action not in BULK_ACTIONS:
+        return json.dumps({"error": f"Unknown action '{action}'. Use one of: {', '.join(BULK_ACTIONS)}"})
+    criteria = imap_search_criteria(sender, subject, date_from, date_to, query)
+    if not email_ids and not criteria:
+        return json.dumps({"error": "Give email_ids or at least one search filter"})
+    try:
+        mailbox = resolve_mailbox(mailbox)
+    except ValueError as e:
+        return json.dumps({"error": str(e)})
+    if action == "archive" and mailbox != "inbox":
+        return json.dumps({"error": "Only inbox emails can be archived"})
+
+    conn = get_imap_connection(mailbox)
+    if not conn:
+        return json.dumps({"error": "Not authenticated"})
+
+    try:
+        with conn as mail:
+            if email_ids:
+                uids = [str(i) for i in email_ids]
+            else:
+                _, search_data = mail.uid("SEARCH", None, criteria)
+                uids = [u.decode() for u in search_data[0].split()]
+            truncated = len(uids) > BULK_MAX_MESSAGES
+            if truncated:
+                uids = sorted(uids, key=int)[-BULK_MAX_MESSAGES:]
+
+            result = apply_bulk_action(mail, action, uids)
+            if action in REMOVING_ACTIONS and result["succeeded"]:
+                forget_messages(result["succeeded"], mailbox)
+            else:
+                current_account().sync.request_sync(mailbox)
+
+            return json.dumps({
+                "action": action,
+                "matched": len(uids),
+                "truncated": truncated,
+                **result
+            })
+    except Exception as e:
+        return json.dumps({"error": f"Bulk {action} failed: {str(e)}"})
+
+def extract_contacts_tool(limit=20, mailbox="inbox"):
     """Extracts unique email contacts from recent emails."""
-    mail = get_imap_connection()
-    if not mail:
+    if not current_session.get():
         return json.dumps({"error": "Not authenticated"})
     
     try:
-        mail.select("inbox")
-        _, search_data = mail.search(None, "ALL")
-        mail_ids = search_data[0].split()
-        
-        if not mail_ids:
-            mail.close()
-            mail.logout()
-            return json.dumps([])
-        
-        latest_ids = mail_ids[-int(limit):]
+        # Senders of the newest emails, from the synced listing (the server only for what lies beyond it)
+        rows = current_account().sync.page(resolve_mailbox(mailbox), limit=max(1, min(int(limit), 500)))["emails"]
         contacts = set()
         
-        for i in latest_ids:
-            try:
-                _, msg_data = mail.fetch(i, "(RFC822)")
-                for response_part in msg_data:
-                    if isinstance(response_part, tuple):
-                        msg = email.message_from_bytes(response_part[1])
-                        sender = msg.get("From", "")
-                        if sender and "@" in sender:
-                            # Extract email from "Name <email@domain.com>" format
-                            import re
-                            email_match = re.search(r'[\w\.-]+@[\w\.-]+', sender)
-                            if email_match:
-                                contacts.add(email_match.group(0))
-            except:
-                continue
-        
-        mail.close()
-        mail.logout()
+        for row in rows:
+            sender = row.get("sender", "")
+            if sender and "@" in sender:
+                # Extract email from "Name <email@domain.com>" format
+                email_match = re.search(r'[\w\.-]+@[\w\.-]+', sender)
+                if email_match:
+                    contacts.add(email_match.group(0))
         
         return json.dumps(list(contacts)[:50])  # Return max 50 unique contacts
     except Exception as e:
         return json.dumps({"error": f"Error: {str(e)}"})
 
 def schedule_email_tool(to_email, subject, body, send_time):
-    """Schedules an email to be sent later (creates draft with note)."""
-    # Note: Gmail doesn't support native scheduling via IMAP
-    # This creates a draft with scheduling info in the body
+    """Schedules an email to be sent later.
+    
+    Gmail has no scheduled send over IMAP/SMTP, so the message waits in the
+    outbox until its due time and is then sent like any other email.
+    """
+    if not current_session.get():
+        return "Error: Not authenticated."
     
-    scheduled_body = f"[SCHEDULED FOR: {send_time}]\n\n{body}\n\n---\nNote: This is a draft. Please use Gmail's schedule send feature to set the actual send time."
+    try:
+        when = parse_send_time(send_time)
+    except ValueError as e:
+        return f"Error: {str(e)}. Use e.g. 'tomorrow 9am', 'Dec 10 2pm', 'in 2 hours' or '2025-12-10 14:00'."
     
-    return create_draft_tool(to_email, subject, scheduled_body)
+    try:
+        msg = MIMEMultipart()
+        msg['To'] = to_email
+        msg['Subject'] = subject
+        msg.attach(MIMEText(body, 'plain'))
+        
+        delivery_id = queue_email(msg, send_at=when.timestamp())
+        return f"Email to {to_email} scheduled for {when:%a %d %b %Y %H:%M %Z} (delivery id: {delivery_id})"
+    except Exception as e:
+        return f"Error scheduling email: {str(e)}"
+
+def cancel_scheduled_email_tool(delivery_id):
+    """Cancels a scheduled (or still queued) email."""
+    session = current_session.get()
+    if not session:
+        return "Error: Not authenticated."
+    if outbox.cancel(delivery_id, session["email"]):
+        return f"Scheduled email {delivery_id} cancelled"
+    return f"Error: {delivery_id} is unknown or was already sent"
+
+# --- Tool Registry ---
+# Single source for the Gemini function declarations and the name -> function
+# map used to execute calls. Built once at import time.
+
+# "mailbox" parameter of the tools that act on emails in one folder
+MAILBOX_PARAMETER = {
+    "type_": "STRING",
+    "description": "Folder or Gmail label the email is in: 'inbox' (default), 'sent', 'all', 'drafts', 'trash', 'spam', 'starred' or a label name. Email IDs are only valid within their folder."
+}
+# ...and of the listing/search tools, which can also look across folders
+MAILBOXES_PARAMETER = {
+    "type_": "STRING",
+    "description": "Folder or Gmail label to look in: 'inbox' (default), 'sent', 'all', 'drafts', 'trash', 'spam', 'starred' or a label name. '*' looks in every synced folder and 'inbox,sent' in several; results then include each email's mailbox."
+}
+
+TOOL_REGISTRY = [
+    {
+        "name": "fetch_emails",
+        "function": fetch_emails_tool,
+        "description": "Fetches a page of emails, newest first, from the inbox or another folder/label (or several at once), with sender, subject and body snippet. Returns next_before when older emails exist.",
+        "parameters": {
+            "type_": "OBJECT",
+            "properties": {
+                "limit": {
+                    "type_": "INTEGER",
+                    "description": "Number of emails to fetch (default: 10, max 100)"
+                },
+                "query": {
+                    "type_": "STRING",
+                    "description": "Search query - can be a subject keyword or 'ALL' for all emails"
+                },
+                "before": {
+                    "type_": "STRING",
+                    "description": "Page cursor: the next_before of the previous page, for older emails"
+                },
+                "after": {
+                    "type_": "STRING",
+                    "description": "Page cursor: the next_after of a page, for newer emails (single folder only)"
+                },
+                "mailbox": MAILBOXES_PARAMETER
+            }
+        }
+    },
+    {
+        "name": "send_email",
+        "function": send_email_tool,
+        "description": "Sends an email to a specified recipient.",
+        "parameters": {
+            "type_": "OBJECT",
+            "properties": {
+                "to_email": {
+                    "type_": "STRING",
+                    "description": "Recipient email address"
+                },
+                "subject": {
+                    "type_": "STRING",
+                    "description": "Email subject line"
+                },
+                "body": {
+                    "type_": "STRING",
+                    "description": "Email body content"
+                }
+            },
+            "required": [
+                "to_email",
+                "subject",
+                "body"
+            ]
+        }
+    },
+    {
+        "name": "count_unread",
+        "function": count_unread_tool,
+        "description": "Counts the number of unread emails in the inbox or another folder/label.",
+        "parameters": {
+            "type_": "OBJECT",
+            "properties": {
+                "mailbox": MAILBOX_PARAMETER
+            }
+        }
+    },
+    {
+        "name": "delete_email",
+        "function": delete_email_tool,
+        "description": "Deletes an email by its ID.",
+        "parameters": {
+            "type_": "OBJECT",
+            "properties": {
+                "email_id": {
+                    "type_": "STRING",
+                    "description": "The ID of the email to delete"
+                },
+                "mailbox": MAILBOX_PARAMETER
+            },
+            "required": [
+                "email_id"
+            ]
+        }
+    },
+    {
+        "name": "mark_as_read",
+        "function": mark_as_read_tool,
+        "description": "Marks an email as read.",
+        "parameters": {
+            "type_": "OBJECT",
+            "properties": {
+                "email_id": {
+                    "type_": "STRING",
+                    "description": "The ID of the email to mark as read"
+                },
+                "mailbox": MAILBOX_PARAMETER
+            },
+            "required": [
+                "email_id"
+            ]
+        }
+    },
+    {
+        "name": "mark_as_unread",
+        "function": mark_as_unread_tool,
+        "description": "Marks an email as unread.",
+        "parameters": {
+            "type_": "OBJECT",
+            "properties": {
+                "email_id": {
+                    "type_": "STRING",
+                    "description": "The ID of the email to mark as unread"
+                },
+                "mailbox": MAILBOX_PARAMETER
+            },
+            "required": [
+                "email_id"
+            ]
+        }
+    },
+    {
+        "name": "search_emails",
+        "function": search_emails_tool,
+        "description": "Advanced email search by sender, subject, body text or date range. Returns ranked matches with a text snippet, one page at a time.",
+        "parameters": {
+            "type_": "OBJECT",
+            "properties": {
+                "query": {
+                    "type_": "STRING",
+                    "description": "Words to look for anywhere in the email (sender, recipients, subject or body)"
+                },
+                "sender": {
+                    "type_": "STRING",
+                    "description": "Filter by sender email address"
+                },
+                "subject": {
+                    "type_": "STRING",
+                    "description": "Filter by subject keywords"
+                },
+                "date_from": {
+                    "type_": "STRING",
+                    "description": "Start date in format DD-Mon-YYYY (e.g., 01-Jan-2024)"
+                },
+                "date_to": {
+                    "type_": "STRING",
+                    "description": "End date in format DD-Mon-YYYY"
+                },
+                "page": {
+                    "type_": "INTEGER",
+                    "description": "Page of results to return, starting at 1 (default: 1)"
+                },
+                "page_size": {
+                    "type_": "INTEGER",
+                    "description": "Results per page, at most 50 (default: 10)"
+                },
+                "mailbox": MAILBOXES_PARAMETER
+            }
+        }
+    },
+    {
+        "name": "semantic_search",
+        "function": semantic_search_tool,
+        "description": "Finds emails by meaning from a loose description (e.g. 'that invoice from Google', 'the message about moving the meeting'). Returns the closest emails with a similarity score.",
+        "parameters": {
+            "type_": "OBJECT",
+            "properties": {
+                "query": {
+                    "type_": "STRING",
+                    "description": "Description of the email(s) to find"
+                },
+                "limit": {
+                    "type_": "INTEGER",
+                    "description": "Number of emails to return, at most 20 (default: 5)"
+                },
+                "mailbox": MAILBOXES_PARAMETER
+            },
+            "required": [
+                "query"
+            ]
+        }
+    },
+    {
+        "name": "get_email_details",
+        "function": get_email_details_tool,
+        "description": "Gets full email details including complete body and attachment information.",
+        "parameters": {
+            "type_": "OBJECT",
+            "properties": {
+                "email_id": {
+                    "type_": "STRING",
+                    "description": "The ID of the email to get details for"
+                },
+                "mailbox": MAILBOX_PARAMETER
+            },
+            "required": [
+                "email_id"
+            ]
+        }
+    },
+    {
+        "name": "get_thread",
+        "function": get_thread_tool,
+        "description": "Gets the whole conversation an email belongs to: every message of its thread across folders (including sent replies), oldest first, with quoted text removed.",
+        "parameters": {
+            "type_": "OBJECT",
+            "properties": {
+                "email_id": {
+                    "type_": "STRING",
+                    "description": "The ID of any email in the conversation"
+                },
+                "mailbox": MAILBOX_PARAMETER
+            },
+            "required": [
+                "email_id"
+            ]
+        }
+    },
+    {
+        "name": "get_attachment",
+        "function": get_attachment_tool,
+        "description": "Reads one attachment of an email (use the part number listed by get_email_details). Returns its metadata and a download link, and the text content for text-like files (txt, csv, html, json...).",
+        "parameters": {
+            "type_": "OBJECT",
+            "properties": {
+                "email_id": {
+                    "type_": "STRING",
+                    "description": "The ID of the email"
+                },
+                "part": {
+                    "type_": "STRING",
+                    "description": "The attachment's part number, e.g. '2' or '1.2'"
+                },
+                "max_chars": {
+                    "type_": "INTEGER",
+                    "description": "Maximum characters of text content to return (default: 4000)"
+                },
+                "mailbox": MAILBOX_PARAMETER
+            },
+            "required": [
+                "email_id",
+                "part"
+            ]
+        }
+    },
+    {
+        "name": "reply_to_email",
+        "function": reply_to_email_tool,
+        "description": "Replies to an email. Automatically includes Re: in subject and proper threading.",
+        "parameters": {
+            "type_": "OBJECT",
+            "properties": {
+                "email_id": {
+                    "type_": "STRING",
+                    "description": "The ID of the email to reply to"
+                },
+                "reply_body": {
+                    "type_": "STRING",
+                    "description": "The reply message content"
+                },
+                "mailbox": MAILBOX_PARAMETER
+            },
+            "required": [
+                "email_id",
+                "reply_body"
+            ]
+        }
+    },
+    {
+        "name": "forward_email",
+        "function": forward_email_tool,
+        "description": "Forwards an email to another recipient with optional message.",
+        "parameters": {
+            "type_": "OBJECT",
+            "properties": {
+                "email_id": {
+                    "type_": "STRING",
+                    "description": "The ID of the email to forward"
+                },
+                "to_email": {
+                    "type_": "STRING",
+                    "description": "Recipient email address"
+                },
+                "message": {
+                    "type_": "STRING",
+                    "description": "Optional message to add before forwarded content"
+                },
+                "mailbox": MAILBOX_PARAMETER
+            },
+            "required": [
+                "email_id",
+                "to_email"
+            ]
+        }
+    },
+    {
+        "name": "create_draft",
+        "function": create_draft_tool,
+        "description": "Creates a draft email and saves it to the Drafts folder.",
+        "parameters": {
+            "type_": "OBJECT",
+            "properties": {
+                "to_email": {
+                    "type_": "STRING",
+                    "description": "Recipient email address"
+                },
+                "subject": {
+                    "type_": "STRING",
+                    "description": "Email subject"
+                },
+                "body": {
+                    "type_": "STRING",
+                    "description": "Email body content"
+                }
+            },
+            "required": [
+                "to_email",
+                "subject",
+                "body"
+            ]
+        }
+    },
+    {
+        "name": "archive_email",
+        "function": archive_email_tool,
+        "description": "Archives an email (removes from inbox but keeps in All Mail).",
+        "parameters": {
+            "type_": "OBJECT",
+            "properties": {
+                "email_id": {
+                    "type_": "STRING",
+                    "description": "The ID of the email to archive"
+                }
+            },
+            "required": [
+                "email_id"
+            ]
+        }
+    },
+    {
+        "name": "star_email",
+        "function": star_email_tool,
+        "description": "Stars/flags an email for importance.",
+        "parameters": {
+            "type_": "OBJECT",
+            "properties": {
+                "email_id": {
+                    "type_": "STRING",
+                    "description": "The ID of the email to star"
+                },
+                "mailbox": MAILBOX_PARAMETER
+            },
+            "required": [
+                "email_id"
+            ]
+        }
+    },
+    {
+        "name": "bulk_email_action",
+        "function": bulk_email_action_tool,
+        "description": "Deletes, archives, marks read/unread or stars/unstars many emails in one call. Target them by a list of IDs or by search filters (e.g. every email from a newsletter sender). Returns which IDs succeeded, were not found, or failed.",
+        "parameters": {
+            "type_": "OBJECT",
+            "properties": {
+                "action": {
+                    "type_": "STRING",
+                    "enum": BULK_ACTIONS,
+                    "description": "What to do with the emails"
+                },
+                "email_ids": {
+                    "type_": "ARRAY",
+                    "items": {
+                        "type_": "STRING"
+                    },
+                    "description": "IDs of the emails to act on"
+                },
+                "sender": {
+                    "type_": "STRING",
+                    "description": "Instead of IDs: act on emails from this sender"
+                },
+                "subject": {
+                    "type_": "STRING",
+                    "description": "Instead of IDs: act on emails whose subject contains this"
+                },
+                "date_from": {
+                    "type_": "STRING",
+                    "description": "Only emails since this date (DD-Mon-YYYY format, e.g., 01-Jan-2024)"
+                },
+                "date_to": {
+                    "type_": "STRING",
+                    "description": "Only emails before this date (DD-Mon-YYYY format)"
+                },
+                "query": {
+                    "type_": "STRING",
+                    "description": "Instead of IDs: act on emails containing these words"
+                },
+                "mailbox": MAILBOX_PARAMETER
+            },
+            "required": [
+                "action"
+            ]
+        }
+    },
+    {
+        "name": "extract_contacts",
+        "function": extract_contacts_tool,
+        "description": "Extracts unique email contacts from recent emails.",
+        "parameters": {
+            "type_": "OBJECT",
+            "properties": {
+                "limit": {
+                    "type_": "INTEGER",
+                    "description": "Number of recent emails to scan (default: 20)"
+                },
+                "mailbox": MAILBOX_PARAMETER
+            }
+        }
+    },
+    {
+        "name": "schedule_email",
+        "function": schedule_email_tool,
+        "description": "Schedules an email to be sent automatically at a later time. Returns the send time and a delivery id.",
+        "parameters": {
+            "type_": "OBJECT",
+            "properties": {
+                "to_email": {
+                    "type_": "STRING",
+                    "description": "Recipient email address"
+                },
+                "subject": {
+                    "type_": "STRING",
+                    "description": "Email subject"
+                },
+                "body": {
+                    "type_": "STRING",
+                    "description": "Email body content"
+                },
+                "send_time": {
+                    "type_": "STRING",
+                    "description": "When to send (e.g., 'tomorrow 9am', 'Dec 10 2pm', 'in 2 hours', '2025-12-10 14:00')"
+                }
+            },
+            "required": [
+                "to_email",
+                "subject",
+                "body",
+                "send_time"
+            ]
+        }
+    },
+    {
+        "name": "cancel_scheduled_email",
+        "function": cancel_scheduled_email_tool,
+        "description": "Cancels an email scheduled with schedule_email that hasn't been sent yet.",
+        "parameters": {
+            "type_": "OBJECT",
+            "properties": {
+                "delivery_id": {
+                    "type_": "STRING",
+                    "description": "The delivery id returned by schedule_email"
+                }
+            },
+            "required": [
+                "delivery_id"
+            ]
+        }
+    }
+]
+
+AGENT_TOOLS = [{
+    "function_declarations": [
+        {key: value for key, value in tool.items() if key != "function"}
+        for tool in TOOL_REGISTRY
+    ]
+}]
+FUNCTION_MAP = {tool["name"]: tool["function"] for tool in TOOL_REGISTRY}
+
+# System Prompt
+SYSTEM_INSTRUCTION = """
+    # Role & Objective
+You are an Elite AI Email Concierge. Your purpose is to manage the user's Gmail inbox with high efficiency, precision, and privacy. You act as an intelligent bridge between the user and their email data.
+
+# Tool Capabilities & Logic
+You have access to the following tools. Use them intelligently based on the user's intent:
+
+## A. Retrieval (Finding Info)
+- Use `fetch_emails(limit, query)` for general browsing or "checking latest emails."
+- Use `search_emails(...)` when specific filters (Sender, Date, Subject) or exact words are provided.
+- Use `semantic_search(query)` when the user describes an email loosely ("that invoice from Google"); it usually finds it in one call.
+- Use `get_email_details(email_id)` ONLY when the user asks to read a specific email's full content.
+- Use `get_thread(email_id)` to read or summarize a whole conversation (all replies, including the user's own from Sent) in one call instead of opening its emails one by one.
+- Use `get_attachment(email_id, part)` to read or link an attachment listed by `get_email_details`.
+- Use `count_unread()` for status updates.
+- To go further back than one `fetch_emails` page, call it again with `before` set to the `next_before` it returned; don't raise `limit` to reach old mail.
+- Use `extract_contacts(limit)` for relationship management.
+- Every email tool takes an optional `mailbox`: a folder or Gmail label ("sent", "all", "spam", "Receipts"...). Email IDs belong to their folder, so pass the `mailbox` an email was found in. `fetch_emails`, `search_emails` and `semantic_search` also accept "*" to look in every synced folder at once.
+
+## B. Action (Communication)
+- `send_email`: Write professional, concise emails. Always maintain the user's voice.
+  - Sending is queued: a result with a delivery id means the email was accepted and will be delivered shortly.
+- `reply_to_email` & `forward_email`: Always reference context from the original thread.
+- `create_draft`: Use this when the request is ambiguous or requires user review before sending.
+- `schedule_email`: Use when timing is specified (e.g., "send this tomorrow morning"). `cancel_scheduled_email` takes back a scheduled email by its delivery id.
+
+## C. Organization (Inbox Zero)
+- `archive_email`, `delete_email`: Use carefully. 
+- `mark_as_read`, `mark_as_unread`, `star_email`: Use to prioritize important items.
+- `bulk_email_action`: Use for anything touching more than a couple of emails ("archive all newsletters from X", "mark these 5 as read") instead of calling the single-email tools repeatedly.
+
+# Operational Guidelines (CRITICAL)
+1. **Think Before Acting:** Analyze the request. If the user says "Find that invoice from Google," prefer `semantic_search` or `search_emails` over `fetch_emails`.
+2. **Chain of Actions:** You can chain tools. Example: Search for an email -> Get its ID -> Reply to it.
+   - When several lookups don't depend on each other (e.g. `get_email_details` for three IDs), request them together in one response; they run in parallel.
+3. **Safety First:** If a request involves deleting multiple emails or sending sensitive info, ask for confirmation or create a draft first.
+4. **Formatting:** Present output in clean Markdown. Use bullet points for email lists.
+   - Tool results list emails as tables (`columns` + `rows`); a `sender#` column indexes the `senders` list. Texts ending in "…" were shortened; call `get_email_details` for more.
+   - Format: **[Sender Name]**: *Subject Line* (Date/Time)
+5. **Context Awareness:** Remember previous interactions in this session to handle follow-up questions like "Reply to that last email."
+   - Older turns arrive as a [Conversation memory] summary plus the emails referenced so far (most recent first); use those IDs directly instead of searching again.
+
+# Tone & Style
+- Be helpful, direct, and professional.
+- Do not make up information. If a tool returns no results, state clearly: "I couldn't find any emails matching that criteria."
+"""
 
 # --- API Endpoints ---
 
 @app.post("/auth/login")
 def login(creds: LoginRequest):
     try:
-        mail = imaplib.IMAP4_SSL("imap.gmail.com")
-        mail.login(creds.email, creds.password)
-        mail.logout()
-        
-        active_session["email"] = creds.email
-        active_session["password"] = creds.password
-        active_session["authenticated"] = True
-        
-        return {"status": "success"}
+        # Validate the credentials with a pooled session so the first tool call reuses it
+        mail_accounts.get(creds.email, creds.password, validate=True)
     except Exception as e:
         raise HTTPException(status_code=401, detail=str(e))
-
-@app.post("/auth/logout")
-def logout():
-    active_session.update({
-        "email": None, 
-        "password": None, 
-        "authenticated": False, 
+    
+    token = session_store.create({
+        "email": creds.email,
+        "password": creds.password,
         "gemini_api_key": None,
-        "chat_history": []
+        "chat_history": [],  # Recent messages, kept under the memory token budget
+        "memory": {"summary": "", "references": []}
     })
+    return {"status": "success", "token": token}
+
+@app.post("/auth/logout")
+def logout(request: Request):
+    session = get_session(request)
+    if session:
+        # Other sessions may share the account; the reaper closes it once idle
+        session_store.delete(session["token"])
     return {"status": "success"}
 
 @app.get("/api/status")
-def status():
+def status(request: Request):
+    session = get_session(request)
+    return {
+        "authenticated": session is not None, 
+        "email": session["email"] if session else None,
+        "has_gemini_key": bool(session and session["gemini_api_key"])
+    }
+
+@app.get("/api/metrics/imap")
+def imap_metrics(request: Request):
+    """IMAP pool hit/miss counters and handshake latency"""
+    if not get_session(request):
+        raise HTTPException(status_code=401, detail="Please login first")
+    return current_account().pool.stats()
+
+@app.get("/api/metrics/cache")
+def cache_metrics():
+    """Local message cache hit/miss counters"""
     return {
-        "authenticated": active_session["authenticated"], 
-        "email": active_session["email"],
-        "has_gemini_key": active_session["gemini_api_key"] is not None
+        **message_cache.stats(),
+        "search": search_index.stats(),
+        "vectors": vector_index.stats(),
+        "threads": thread_index.stats(),
+        "tool_calls": tool_cache.stats()
     }
 
+@app.get("/api/metrics/sync")
+def sync_metrics(request: Request):
+    """Incremental sync pass counters"""
+    if not get_session(request):
+        raise HTTPException(status_code=401, detail="Please login first")
+    account = current_account()
+    return {**account.sync.stats(), "idle": account.idle.stats(), "event_subscribers": account.events.subscriber_count}
+
+@app.get("/api/metrics/model")
+def model_metrics():
+    """Agent model cache, context cache, conversation memory and tool result counters"""
+    with model_cache_lock:
+        return {
+            **model_cache_stats,
+            "models": len(model_cache),
+            "memory": conversation_memory.stats(),
+            "tool_results": result_shaper.stats()
+        }
+
+@app.get("/api/metrics/outbox")
+def outbox_metrics(request: Request):
+    """Outbound queue counters plus this account's SMTP pool"""
+    if not get_session(request):
+        raise HTTPException(status_code=401, detail="Please login first")
+    return {**outbox.stats(), "smtp": current_account().smtp.stats()}
+
+@app.get("/api/metrics/sessions")
+def session_metrics():
+    """Session store and open account counters for this worker"""
+    return {**session_store.stats(), "accounts": mail_accounts.stats()}
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """Span latency histograms, bytes and tokens, plus the worker-wide counters above (Prometheus text format)"""
+    return PlainTextResponse(
+        tracer.render(gauges={
+            "cache": cache_metrics(),
+            "model": model_metrics(),
+            "sessions": session_metrics(),
+            "outbox": outbox.stats()
+        }),
+        media_type="text/plain; version=0.0.4"
+    )
+
+@app.get("/api/events")
+async def events_endpoint(request: Request):
+    """Server-sent events with new-message, flag-change and expunge deltas for the synced folders (each names its mailbox)"""
+    session = get_session(request)
+    if not session:
+        raise HTTPException(status_code=401, detail="Please login first")
+    # Opening the account may log in to IMAP, so keep it off the event loop
+    account = await asyncio.get_running_loop().run_in_executor(tool_executor, account_for, session)
+    return StreamingResponse(
+        sse_stream(account.events, request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/api/settings/gemini")
-def set_gemini_key(key: str = Body(..., embed=True)):
-    active_session["gemini_api_key"] = key
+def set_gemini_key(request: Request, key: str = Body(..., embed=True)):
+    session = get_session(request)
+    if not session:
+        raise HTTPException(status_code=401, detail="Please login first")
+    session["gemini_api_key"] = key
+    session_store.save(session)
     return {"status": "success"}
 
 @app.post("/api/clear-history")
-def clear_chat_history():
+def clear_chat_history(request: Request):
     """Clear chat history to start fresh conversation"""
-    active_session["chat_history"] = []
+    session = get_session(request)
+    if session:
+        conversation_memory.clear(session)
+        session_store.save(session)
     return {"status": "success", "message": "Chat history cleared"}
 
+def mailboxes_for_request(mailbox):
+    """Resolved server names for an endpoint's ?mailbox= (one folder, "*" or a comma-separated list); 404 if unknown."""
+    try:
+        return resolve_mailboxes(mailbox) or [resolve_mailbox(mailbox)]
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+def mailbox_for_request(mailbox):
+    """The one folder a single-message endpoint's ?mailbox= names (UIDs only mean something within a folder); 400 for "*" or a list, 404 if unknown."""
+    if mailbox and (mailbox.strip() == "*" or "," in mailbox):
+        raise HTTPException(status_code=400, detail="Name a single mailbox; an email ID only identifies a message within one folder")
+    try:
+        return resolve_mailbox(mailbox)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.get("/api/mailboxes")
+def list_mailboxes(request: Request):
+    """The account's folders and labels, with which of them are kept in sync"""
+    if not get_session(request):
+        raise HTTPException(status_code=401, detail="Please login first")
+    account = current_account()
+    tracked = set(account.sync.tracked())
+    return {"mailboxes": [{**folder, "synced": folder["name"] in tracked} for folder in account.folders.describe()]}
+
 @app.get("/api/emails")
-def get_emails_endpoint():
+def get_emails_endpoint(request: Request, refresh: bool = False, mailbox: str = "inbox", limit: int = 15,
+                        before: Optional[str] = None, after: Optional[str] = None):
+    """A page of emails, newest first; pass the returned next_before/next_after as before/after for the next page"""
+    if not get_session(request):
+        return {"emails": []}
+    
+    mailboxes = mailboxes_for_request(mailbox)
+    limit = max(1, min(limit, 100))
+    # Served from the locally synced folders; `refresh` runs a sync pass first
+    try:
+        account = current_account()
+        if refresh:
+            for name in mailboxes:
+                account.sync.sync_now(name)
+        if len(mailboxes) > 1:
+            return account.sync.list_across(mailboxes, limit=limit, before=before)
+        return account.sync.page(mailboxes[0], limit=limit, before=before, after=after)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(f"Sync unavailable, fetching live: {e}")
+    
     # Re-use the tool logic but return object
-    res = fetch_emails_tool(limit=15)
+    res = fetch_emails_tool(limit=limit, mailbox=mailbox, before=before, after=after)
     try:
-        return {"emails": json.loads(res)}
+        page = json.loads(res)
+        return {"emails": page["results"], "next_before": page["next_before"], "next_after": page["next_after"]}
     except:
         return {"emails": []}
 
-class AgentRequest(BaseModel):
-    command: str
-    gemini_key: Optional[str] = None
-    model: Optional[str] = "gemini-2.0-flash-exp"
+@app.get("/api/emails/{email_id}/thread")
+def get_thread_endpoint(email_id: str, request: Request, mailbox: str = "inbox"):
+    """The whole conversation an email belongs to, oldest message first"""
+    if not get_session(request):
+        raise HTTPException(status_code=401, detail="Please login first")
+    thread = load_thread(email_id, mailbox_for_request(mailbox))
+    if thread is None:
+        raise HTTPException(status_code=404, detail="Email not found")
+    return thread
 
-@app.post("/api/agent")
-async def agent_endpoint(req: AgentRequest):
-    if not active_session["authenticated"]:
+@app.get("/api/emails/{email_id}/attachments/{part}")
+def download_attachment(email_id: str, part: str, request: Request, mailbox: str = "inbox"):
+    """Streams one attachment, decoded, straight from IMAP in chunks (?token= works for plain links)"""
+    if not get_session(request):
         raise HTTPException(status_code=401, detail="Please login first")
+    account = current_account()
+    mailbox = mailbox_for_request(mailbox)
     
-    api_key = req.gemini_key or active_session["gemini_api_key"]
-    if not api_key:
-        return {
-            "type": "error", 
-            "message": "Gemini API Key is missing. Please add it in settings."
-        }
+    with account.pool.connection(mailbox) as mail:
+        parts, _ = fetch_structure(mail, email_id, with_header=False)
+    target = next((p for p in parts or [] if p["part"] == part), None)
+    if not target:
+        raise HTTPException(status_code=404, detail="Attachment not found")
     
-    # Configure Gemini
-    genai.configure(api_key=api_key)
+    def stream():
+        # Holds one pooled connection for the duration of the download
+        with account.pool.connection(mailbox) as mail:
+            yield from iter_part(mail, email_id, target, chunk_size=ATTACHMENT_CHUNK_SIZE)
     
-    # System Prompt
-    system_instruction = """
-    # Role & Objective
-You are an Elite AI Email Concierge. Your purpose is to manage the user's Gmail inbox with high efficiency, precision, and privacy. You act as an intelligent bridge between the user and their email data.
+    filename = target["filename"] or f"part-{part}"
+    return StreamingResponse(
+        stream(),
+        media_type=target["content_type"],
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{urllib.parse.quote(filename)}"}
+    )
 
-# Tool Capabilities & Logic
-You have access to 15 specific tools. Use them intelligently based on the user's intent:
+@app.get("/api/outbox")
+def list_outbox(request: Request, limit: int = 20):
+    """Recently sent and queued mail of this account with delivery status"""
+    session = get_session(request)
+    if not session:
+        raise HTTPException(status_code=401, detail="Please login first")
+    return {"messages": outbox.list(session["email"], limit=min(limit, 100))}
 
-## A. Retrieval (Finding Info)
-- Use `fetch_emails(limit, query)` for general browsing or "checking latest emails."
-- Use `search_emails(...)` when specific filters (Sender, Date, Subject) are provided.
-- Use `get_email_details(email_id)` ONLY when the user asks to read a specific email's full content or needs to summarize a long thread.
-- Use `count_unread()` for status updates.
-- Use `extract_contacts(limit)` for relationship management.
+@app.get("/api/outbox/{delivery_id}")
+def delivery_status(delivery_id: str, request: Request):
+    """Delivery status of one message: scheduled, queued, sending, sent, failed or cancelled"""
+    session = get_session(request)
+    if not session:
+        raise HTTPException(status_code=401, detail="Please login first")
+    status = outbox.get(delivery_id, account=session["email"])
+    if not status:
+        raise HTTPException(status_code=404, detail="Unknown delivery id")
+    return status
 
-## B. Action (Communication)
-- `send_email`: Write professional, concise emails. Always maintain the user's voice.
-- `reply_to_email` & `forward_email`: Always reference context from the original thread.
-- `create_draft`: Use this when the request is ambiguous or requires user review before sending.
-- `schedule_email`: Use when timing is specified (e.g., "send this tomorrow morning").
+@app.delete("/api/outbox/{delivery_id}")
+def cancel_delivery(delivery_id: str, request: Request):
+    """Cancels a scheduled or still queued message"""
+    session = get_session(request)
+    if not session:
+        raise HTTPException(status_code=401, detail="Please login first")
+    if not outbox.cancel(delivery_id, session["email"]):
+        raise HTTPException(status_code=404, detail="Nothing to cancel")
+    return {"status": "success"}
 
-## C. Organization (Inbox Zero)
-- `archive_email`, `delete_email`: Use carefully. 
-- `mark_as_read`, `mark_as_unread`, `star_email`: Use to prioritize important items.
+class AgentRequest(BaseModel):
+    command: str
+    gemini_key: Optional[str] = None
+    model: Optional[str] = "gemini-2.0-flash-exp"
+    # Return the turn's timing spans with the response
+    debug: Optional[bool] = False
 
-# Operational Guidelines (CRITICAL)
-1. **Think Before Acting:** Analyze the request. If the user says "Find that invoice from Google," prefer `search_emails` over `fetch_emails`.
-2. **Chain of Actions:** You can chain tools. Example: Search for an email -> Get its ID -> Reply to it.
-3. **Safety First:** If a request involves deleting multiple emails or sending sensitive info, ask for confirmation or create a draft first.
-4. **Formatting:** Present output in clean Markdown. Use bullet points for email lists.
-   - Format: **[Sender Name]**: *Subject Line* (Date/Time)
-5. **Context Awareness:** Remember previous interactions in this session to handle follow-up questions like "Reply to that last email."
+async def run_tool(function, function_args):
+    """Runs a blocking IMAP/SMTP tool in the bounded tool pool, with a timeout."""
+    loop = asyncio.get_running_loop()
+    # Carry the current session into the worker thread
+    context = contextvars.copy_context()
+    return await asyncio.wait_for(
+        loop.run_in_executor(tool_executor, functools.partial(context.run, function, **function_args)),
+        timeout=TOOL_TIMEOUT
+    )
 
-# Tone & Style
-- Be helpful, direct, and professional.
-- Do not make up information. If a tool returns no results, state clearly: "I couldn't find any emails matching that criteria."
-    """
+async def send_to_model(chat, content, emit=None):
+    """Sends a message on a Gemini chat without blocking the event loop.
     
-    try:
-        model_name = req.model if req.model else "gemini-2.5-flash"
+    With `emit`, the response is streamed and each text chunk is emitted as a
+    "token" event as soon as it arrives; the returned response is complete.
+    """
+    with tracer.span("model.send", streamed=emit is not None, request_bytes=len(str(content))) as span:
+        if emit is None:
+            response = await asyncio.wait_for(chat.send_message_async(content), timeout=MODEL_CALL_TIMEOUT)
+            record_model_usage(span, response)
+            return response
         
-        # Define all 15 tools
-        tools = [
-            {
-                "function_declarations": [
-                    {
-                        "name": "fetch_emails",
-                        "description": "Fetches emails from the inbox. Returns a JSON list of recent emails with sender, subject, and body snippet.",
-                        "parameters": {
-                            "type_": "OBJECT",
-                            "properties": {
-                                "limit": {
-                                    "type_": "INTEGER",
-                                    "description": "Number of emails to fetch (default: 10)"
-                                },
-                                "query": {
-                                    "type_": "STRING",
-                                    "description": "Search query - can be a subject keyword or 'ALL' for all emails"
-                                }
-                            }
-                        }
-                    },
-                    {
-                        "name": "send_email",
-                        "description": "Sends an email to a specified recipient.",
-                        "parameters": {
-                            "type_": "OBJECT",
-                            "properties": {
-                                "to_email": {
-                                    "type_": "STRING",
-                                    "description": "Recipient email address"
-                                },
-                                "subject": {
-                                    "type_": "STRING",
-                                    "description": "Email subject line"
-                                },
-                                "body": {
-                                    "type_": "STRING",
-                                    "description": "Email body content"
-                                }
-                            },
-                            "required": ["to_email", "subject", "body"]
-                        }
-                    },
-                    {
-                        "name": "count_unread",
-                        "description": "Counts the number of unread emails in the inbox.",
-                        "parameters": {
-                            "type_": "OBJECT",
-                            "properties": {}
-                        }
-                    },
-                    {
-                        "name": "delete_email",
-                        "description": "Deletes an email by its ID.",
-                        "parameters": {
-                            "type_": "OBJECT",
-                            "properties": {
-                                "email_id": {
-                                    "type_": "STRING",
-                                    "description": "The ID of the email to delete"
-                                }
-                            },
-                            "required": ["email_id"]
-                        }
-                    },
-                    {
-                        "name": "mark_as_read",
-                        "description": "Marks an email as read.",
-                        "parameters": {
-                            "type_": "OBJECT",
-                            "properties": {
-                                "email_id": {
-                                    "type_": "STRING",
-                                    "description": "The ID of the email to mark as read"
-                                }
-                            },
-                            "required": ["email_id"]
-                        }
-                    },
-                    {
-                        "name": "mark_as_unread",
-                        "description": "Marks an email as unread.",
-                        "parameters": {
-                            "type_": "OBJECT",
-                            "properties": {
-                                "email_id": {
-                                    "type_": "STRING",
-                                    "description": "The ID of the email to mark as unread"
-                                }
-                            },
-                            "required": ["email_id"]
-                        }
-                    },
-                    {
-                        "name": "search_emails",
-                        "description": "Advanced email search by sender, subject, or date range. Returns matching emails.",
-                        "parameters": {
-                            "type_": "OBJECT",
-                            "properties": {
-                                "sender": {
-                                    "type_": "STRING",
-                                    "description": "Filter by sender email address"
-                                },
-                                "subject": {
-                                    "type_": "STRING",
-                                    "description": "Filter by subject keywords"
-                                },
-                                "date_from": {
-                                    "type_": "STRING",
-                                    "description": "Start date in format DD-Mon-YYYY (e.g., 01-Jan-2024)"
-                                },
-                                "date_to": {
-                                    "type_": "STRING",
-                                    "description": "End date in format DD-Mon-YYYY"
-                                }
-                            }
-                        }
-                    },
-                    {
-                        "name": "get_email_details",
-                        "description": "Gets full email details including complete body and attachment information.",
-                        "parameters": {
-                            "type_": "OBJECT",
-                            "properties": {
-                                "email_id": {
-                                    "type_": "STRING",
-                                    "description": "The ID of the email to get details for"
-                                }
-                            },
-                            "required": ["email_id"]
-                        }
-                    },
-                    {
-                        "name": "reply_to_email",
-                        "description": "Replies to an email. Automatically includes Re: in subject and proper threading.",
-                        "parameters": {
-                            "type_": "OBJECT",
-                            "properties": {
-                                "email_id": {
-                                    "type_": "STRING",
-                                    "description": "The ID of the email to reply to"
-                                },
-                                "reply_body": {
-                                    "type_": "STRING",
-                                    "description": "The reply message content"
-                                }
-                            },
-                            "required": ["email_id", "reply_body"]
-                        }
-                    },
-                    {
-                        "name": "forward_email",
-                        "description": "Forwards an email to another recipient with optional message.",
-                        "parameters": {
-                            "type_": "OBJECT",
-                            "properties": {
-                                "email_id": {
-                                    "type_": "STRING",
-                                    "description": "The ID of the email to forward"
-                                },
-                                "to_email": {
-                                    "type_": "STRING",
-                                    "description": "Recipient email address"
-                                },
-                                "message": {
-                                    "type_": "STRING",
-                                    "description": "Optional message to add before forwarded content"
-                                }
-                            },
-                            "required": ["email_id", "to_email"]
-                        }
-                    },
-                    {
-                        "name": "create_draft",
-                        "description": "Creates a draft email and saves it to the Drafts folder.",
-                        "parameters": {
-                            "type_": "OBJECT",
-                            "properties": {
-                                "to_email": {
-                                    "type_": "STRING",
-                                    "description": "Recipient email address"
-                                },
-                                "subject": {
-                                    "type_": "STRING",
-                                    "description": "Email subject"
-                                },
-                                "body": {
-                                    "type_": "STRING",
-                                    "description": "Email body content"
-                                }
-                            },
-                            "required": ["to_email", "subject", "body"]
-                        }
-                    },
-                    {
-                        "name": "archive_email",
-                        "description": "Archives an email (removes from inbox but keeps in All Mail).",
-                        "parameters": {
-                            "type_": "OBJECT",
-                            "properties": {
-                                "email_id": {
-                                    "type_": "STRING",
-                                    "description": "The ID of the email to archive"
-                                }
-                            },
-                            "required": ["email_id"]
-                        }
-                    },
-                    {
-                        "name": "star_email",
-                        "description": "Stars/flags an email for importance.",
-                        "parameters": {
-                            "type_": "OBJECT",
-                            "properties": {
-                                "email_id": {
-                                    "type_": "STRING",
-                                    "description": "The ID of the email to star"
-                                }
-                            },
-                            "required": ["email_id"]
-                        }
-                    },
-                    {
-                        "name": "extract_contacts",
-                        "description": "Extracts unique email contacts from recent emails.",
-                        "parameters": {
-                            "type_": "OBJECT",
-                            "properties": {
-                                "limit": {
-                                    "type_": "INTEGER",
-                                    "description": "Number of recent emails to scan (default: 20)"
-                                }
-                            }
-                        }
-                    },
-                    {
-                        "name": "schedule_email",
-                        "description": "Schedules an email to be sent later (creates draft with scheduling note).",
-                        "parameters": {
-                            "type_": "OBJECT",
-                            "properties": {
-                                "to_email": {
-                                    "type_": "STRING",
-                                    "description": "Recipient email address"
-                                },
-                                "subject": {
-                                    "type_": "STRING",
-                                    "description": "Email subject"
-                                },
-                                "body": {
-                                    "type_": "STRING",
-                                    "description": "Email body content"
-                                },
-                                "send_time": {
-                                    "type_": "STRING",
-                                    "description": "When to send (e.g., 'tomorrow 9am', 'Dec 10 2pm')"
-                                }
-                            },
-                            "required": ["to_email", "subject", "body", "send_time"]
-                        }
-                    }
-                ]
-            }
-        ]
+        started = time.perf_counter()
         
-        model = genai.GenerativeModel(
-            model_name=model_name,
-            system_instruction=system_instruction,
-            tools=tools
-        )
+        async def stream():
+            response = await chat.send_message_async(content, stream=True)
+            async for chunk in response:
+                for candidate in chunk.candidates[:1]:
+                    for part in candidate.content.parts:
+                        if getattr(part, 'text', None):
+                            if "first_token_ms" not in span.attrs:
+                                span.set(first_token_ms=round((time.perf_counter() - started) * 1000, 1))
+                            await emit("token", {"text": part.text})
+            return response
         
-        # Build conversation history manually for powerful memory
-        # Convert stored history to proper format
-        conversation_history = []
+        response = await asyncio.wait_for(stream(), timeout=MODEL_CALL_TIMEOUT)
+        record_model_usage(span, response)
+        return response
+
+def record_model_usage(span, response):
+    """Puts Gemini's token counts on a model span (estimated from the reply text if the response has none)."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None and getattr(usage, "prompt_token_count", None) is not None:
+        span.set(
+            prompt_tokens=usage.prompt_token_count,
+            output_tokens=getattr(usage, "candidates_token_count", 0) or 0,
+            cached_tokens=getattr(usage, "cached_content_token_count", 0) or 0
+        )
+        return
+    parts = response.candidates[0].content.parts if response and response.candidates and response.candidates[0].content else []
+    span.set(output_tokens=estimate_tokens("".join(getattr(p, "text", "") or "" for p in parts)))
+
+# Tool results go back to the model as compact native objects, all results of
+# one turn sharing a token budget
+result_shaper = ResultShaper(
+    turn_tokens=int(os.getenv("TOOL_RESULT_TOKEN_BUDGET", "6000")),
+    min_result_tokens=int(os.getenv("TOOL_RESULT_MIN_TOKENS", "300")),
+)
+
+# Tools that only read the mailbox; consecutive calls to these run concurrently
+READ_ONLY_TOOLS = {"fetch_emails", "search_emails", "semantic_search", "get_email_details", "get_thread", "get_attachment", "count_unread", "extract_contacts"}
+# Read-only tools whose results are served from tool_cache, and the tools that
+# change the mailbox and so invalidate it (sending doesn't touch the inbox)
+CACHED_TOOLS = {"fetch_emails", "search_emails", "get_email_details", "get_thread", "count_unread", "extract_contacts"}
+MAILBOX_CHANGING_TOOLS = {"delete_email", "archive_email", "mark_as_read", "mark_as_unread", "star_email", "bulk_email_action"}
+
+def is_error_result(result):
+    """True for the error strings/objects tools return instead of raising."""
+    if not isinstance(result, str):
+        return False
+    if result.startswith("Error"):
+        return True
+    try:
+        data = json.loads(result)
+    except ValueError:
+        return False
+    return isinstance(data, dict) and "error" in data
+
+async def run_cached_tool(function_name, function, function_args):
+    """Runs a tool, reading CACHED_TOOLS through tool_cache and invalidating it after mailbox changes."""
+    session = current_session.get()
+    if not session or function_name not in CACHED_TOOLS | MAILBOX_CHANGING_TOOLS:
+        return await run_tool(function, function_args)
+    account = session["email"]
+
+    if function_name in MAILBOX_CHANGING_TOOLS:
+        try:
+            return await run_tool(function, function_args)
+        finally:
+            # Reads that overlapped the change carry an old generation and won't be stored
+            tool_cache.invalidate(account)
+
+    key = tool_cache.key(account, function_name, function_args)
+    cached = tool_cache.get(key)
+    if cached is not None:
+        tracer.annotate(cached=True)
+        return cached
+    generation = tool_cache.generation(account)
+    result = await run_tool(function, function_args)
+    if not is_error_result(result):
+        tool_cache.put(key, result, generation)
+    return result
+
+async def call_tool(function_call, function_map, emit=None):
+    """Executes one model function call and returns (name, FunctionResponse payload)."""
+    function_name = function_call.name
+    function_args = dict(function_call.args) if function_call.args else {}
+    
+    if emit:
+        await emit("tool_start", {"name": function_name, "args": function_args})
+    started = time.perf_counter()
+    
+    # Names the model made up share one span name, so they can't add metric series
+    known = function_name in function_map
+    span_name = f"tool.{function_name}" if known else "tool.unknown"
+    with tracer.span(span_name, args=function_args, function=function_name) as span:
+        if not known:
+            payload = {"error": f"Unknown function: {function_name}"}
+        else:
+            try:
+                payload = {"result": await run_cached_tool(function_name, function_map[function_name], function_args)}
+            except asyncio.TimeoutError:
+                payload = {"error": f"{function_name} timed out"}
+            except Exception as func_error:
+                # If function execution fails, send error back to model
+                payload = {"error": str(func_error)}
         
-        # Add previous messages from session (last 10 exchanges = 20 messages)
-        if active_session["chat_history"]:
-            for msg in active_session["chat_history"][-20:]:
-                if msg.get("role") == "user":
-                    conversation_history.append({
-                        "role": "user",
-                        "parts": [{"text": msg.get("content", "")}]
-                    })
-                elif msg.get("role") == "model":
-                    conversation_history.append({
-                        "role": "model", 
-                        "parts": [{"text": msg.get("content", "")}]
-                    })
+        result = str(payload.get("result", payload.get("error", "")))
+        span.set(result_bytes=len(result.encode("utf-8")), result_tokens=estimate_tokens(result))
+        if "error" in payload or is_error_result(payload["result"]):
+            span.fail(result[:200])
+    
+    if emit:
+        await emit("tool_finish", {
+            "name": function_name,
+            "ok": "error" not in payload,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 1)
+        })
+    return function_name, payload
+
+async def run_function_calls(function_calls, function_map, emit=None):
+    """Runs a response's function calls, keeping their order in the results.
+    
+    Consecutive read-only calls run concurrently; a mutating call waits for
+    everything before it and blocks everything after it, so "read then
+    delete" style sequences keep their meaning.
+    """
+    results = []
+    batch = []
+    for function_call in function_calls:
+        if function_call.name in READ_ONLY_TOOLS:
+            batch.append(function_call)
+            continue
+        if batch:
+            results.extend(await asyncio.gather(*(call_tool(c, function_map, emit) for c in batch)))
+            batch = []
+        results.append(await call_tool(function_call, function_map, emit))
+    if batch:
+        results.extend(await asyncio.gather(*(call_tool(c, function_map, emit) for c in batch)))
+    return results
+
+async def run_agent_turn(chat, command, function_map, emit=None, tool_log=None):
+    """Runs one user command through the model/tool loop and returns the final text.
+    
+    `emit(event, data)` (async) receives tool_start/tool_finish/token events
+    as they happen; without it the turn runs unstreamed. Every tool call is
+    appended to `tool_log` as (name, args, result).
+    """
+    # Send user message
+    response = await send_to_model(chat, command, emit)
+    
+    # Handle function calls manually
+    max_iterations = 5
+    iteration = 0
+    final_text = ""
+    result_budget = result_shaper.turn_tokens
+    
+    while iteration < max_iterations:
+        iteration += 1
         
-        # Start chat with history
-        chat = model.start_chat(history=conversation_history)
+        # Validate response
+        if not response or not response.candidates:
+            final_text = "I apologize, but I couldn't generate a proper response. Please try again."
+            break
         
-        # Function mapping for all 15 tools
-        function_map = {
-            "fetch_emails": fetch_emails_tool,
-            "send_email": send_email_tool,
-            "count_unread": count_unread_tool,
-            "delete_email": delete_email_tool,
-            "mark_as_read": mark_as_read_tool,
-            "mark_as_unread": mark_as_unread_tool,
-            "search_emails": search_emails_tool,
-            "get_email_details": get_email_details_tool,
-            "reply_to_email": reply_to_email_tool,
-            "forward_email": forward_email_tool,
-            "create_draft": create_draft_tool,
-            "archive_email": archive_email_tool,
-            "star_email": star_email_tool,
-            "extract_contacts": extract_contacts_tool,
-            "schedule_email": schedule_email_tool
-        }
+        candidate = response.candidates[0]
         
-        # Send user message
-        response = chat.send_message(req.command)
+        # Check if response has content
+        if not candidate.content or not candidate.content.parts:
+            final_text = "I received your message but couldn't generate a response. Please rephrase and try again."
+            break
         
-        # Handle function calls manually
-        max_iterations = 5
-        iteration = 0
-        final_text = ""
+        # The model may ask for several tools in one response; answer them all in one message
+        function_calls = [
+            part.function_call for part in candidate.content.parts
+            if hasattr(part, 'function_call') and part.function_call
+        ]
         
-        while iteration < max_iterations:
-            iteration += 1
-            
-            # Validate response
-            if not response or not response.candidates:
-                final_text = "I apologize, but I couldn't generate a proper response. Please try again."
-                break
-            
-            candidate = response.candidates[0]
+        if function_calls:
+            results = await run_function_calls(function_calls, function_map, emit)
+            if tool_log is not None:
+                tool_log.extend(
+                    (name, dict(call.args) if call.args else {}, payload.get("result"))
+                    for call, (name, payload) in zip(function_calls, results)
+                )
             
-            # Check if response has content
-            if not candidate.content or not candidate.content.parts:
-                final_text = "I received your message but couldn't generate a response. Please rephrase and try again."
-                break
-                
-            part = candidate.content.parts[0]
+            shaped, result_budget = result_shaper.shape_batch(results, result_budget)
             
-            # Check if there's a function call
-            if hasattr(part, 'function_call') and part.function_call:
-                function_call = part.function_call
-                function_name = function_call.name
-                function_args = dict(function_call.args) if function_call.args else {}
-                
-                # Execute the function
-                if function_name in function_map:
-                    try:
-                        result = function_map[function_name](**function_args)
-                        
-                        # Send the result back to the model
-                        response = chat.send_message(
-                            genai.protos.Content(
-                                parts=[genai.protos.Part(
-                                    function_response=genai.protos.FunctionResponse(
-                                        name=function_name,
-                                        response={"result": result}
-                                    )
-                                )]
-                            )
+            try:
+                # Send the results back to the model
+                response = await send_to_model(
+                    chat,
+                    genai.protos.Content(parts=[
+                        genai.protos.Part(
+                            function_response=genai.protos.FunctionResponse(name=name, response=payload)
                         )
-                    except Exception as func_error:
-                        # If function execution fails, send error back to model
-                        try:
-                            response = chat.send_message(
-                                genai.protos.Content(
-                                    parts=[genai.protos.Part(
-                                        function_response=genai.protos.FunctionResponse(
-                                            name=function_name,
-                                            response={"error": str(func_error)}
-                                        )
-                                    )]
-                                )
-                            )
-                        except:
-                            final_text = f"Error executing {function_name}: {str(func_error)}"
-                            break
-                else:
-                    final_text = f"Unknown function: {function_name}"
-                    break
-            else:
-                # No more function calls, we have the final response
-                if hasattr(part, 'text') and part.text:
-                    final_text = part.text
-                else:
-                    final_text = "I processed your request but couldn't generate a text response."
+                        for name, payload in shaped
+                    ]),
+                    emit
+                )
+            except Exception as send_error:
+                final_text = f"Error executing {', '.join(name for name, _ in results)}: {str(send_error)}"
                 break
-        
-        # Ensure we have a response
-        if not final_text:
-            if response and response.text:
-                final_text = response.text
+        else:
+            # No more function calls, we have the final response
+            text = "".join(part.text for part in candidate.content.parts if hasattr(part, 'text') and part.text)
+            if text:
+                final_text = text
             else:
-                final_text = "I apologize, but I couldn't complete your request. Please try again with a different question."
-        
-        # Save conversation to memory (user message + AI response)
-        active_session["chat_history"].append({
-            "role": "user",
-            "content": req.command
-        })
-        active_session["chat_history"].append({
-            "role": "model",
-            "content": final_text
-        })
-        
-        # Keep only last 30 messages (15 exchanges) for powerful memory
-        if len(active_session["chat_history"]) > 30:
-            active_session["chat_history"] = active_session["chat_history"][-30:]
-        
+                final_text = "I processed your request but couldn't generate a text response."
+            break
+    
+    # Ensure we have a response
+    if not final_text:
+        if response and response.text:
+            final_text = response.text
+        else:
+            final_text = "I apologize, but I couldn't complete your request. Please try again with a different question."
+    
+    return final_text
+
+async def wait_for_agent_turn(turn, request):
+    """Awaits an agent turn, cancelling it on client disconnect (returns None) or timeout."""
+    async def watch_disconnect():
+        while not await request.is_disconnected():
+            await asyncio.sleep(0.5)
+    
+    watcher = asyncio.create_task(watch_disconnect())
+    try:
+        done, _ = await asyncio.wait({turn, watcher}, timeout=AGENT_TURN_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+    
+    if turn in done:
+        return turn.result()
+    
+    turn.cancel()
+    if watcher in done:
+        return None
+    return "Sorry, that took too long to complete. Please try again or narrow the request."
+
+# --- Model Cache ---
+# GenerativeModel objects (and the server-side cached prefix of system prompt +
+# tool schema) are reused across requests instead of being rebuilt per turn.
+MODEL_CACHE_SIZE = int(os.getenv("MODEL_CACHE_SIZE", "8"))
+CONTEXT_CACHE_ENABLED = os.getenv("GEMINI_CONTEXT_CACHE", "1") == "1"
+CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+
+# Users bring their own API keys, so every model talks through its key's own clients
+gemini_clients = GeminiClients()
+
+model_cache = OrderedDict()
+# Guards model_cache and model_builds only; models are built outside it
+model_cache_lock = threading.Lock()
+# (api_key, model_name) -> Future of a model being built, so concurrent misses build it once
+model_builds = {}
+model_cache_stats = {"hits": 0, "misses": 0, "context_cached": 0, "context_cache_failures": 0}
+
+def create_agent_model(api_key, model_name):
+    """Builds a model for the agent, preferring a cached system prompt + tool prefix.
+    
+    Blocking (creating the context cache is a network call), so run it off
+    the event loop. Returns (model, expires_at); expires_at is None for a
+    plain model.
+    """
+    if CONTEXT_CACHE_ENABLED:
+        try:
+            cached = gemini_clients.create_cached_content(
+                api_key,
+                model=model_name if model_name.startswith("models/") else f"models/{model_name}",
+                display_name="email-assistant-agent",
+                system_instruction=SYSTEM_INSTRUCTION,
+                tools=AGENT_TOOLS,
+                ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL),
+            )
+            with model_cache_lock:
+                model_cache_stats["context_cached"] += 1
+            # Refresh a minute early so a turn never starts on an expiring cache
+            return gemini_clients.model_from_cached_content(api_key, cached), time.time() + CONTEXT_CACHE_TTL - 60
+        except Exception as e:
+            # Unsupported model, prompt below the minimum cacheable size, older SDK...
+            with model_cache_lock:
+                model_cache_stats["context_cache_failures"] += 1
+            print(f"Context caching unavailable for {model_name}: {e}")
+    
+    model = gemini_clients.model(
+        api_key,
+        model_name,
+        system_instruction=SYSTEM_INSTRUCTION,
+        tools=AGENT_TOOLS
+    )
+    return model, None
+
+def cached_agent_model(api_key, model_name):
+    """The cached, unexpired model for (api_key, model_name), or None (never blocks on a build)."""
+    key = (api_key, model_name)
+    with model_cache_lock:
+        entry = model_cache.get(key)
+        if entry and (entry["expires_at"] is None or entry["expires_at"] > time.time()):
+            model_cache.move_to_end(key)
+            model_cache_stats["hits"] += 1
+            return entry["model"]
+    return None
+
+def get_agent_model(api_key, model_name):
+    """Returns the cached model for (api_key, model_name), building it on first use.
+    
+    Blocking on a miss: the first caller builds the model without holding
+    model_cache_lock, concurrent callers for the same key wait for it, and
+    other keys are not held up.
+    """
+    model = cached_agent_model(api_key, model_name)
+    if model is not None:
+        return model
+    
+    key = (api_key, model_name)
+    with model_cache_lock:
+        build = model_builds.get(key)
+        owner = build is None
+        if owner:
+            build = model_builds[key] = Future()
+            model_cache_stats["misses"] += 1
+    if not owner:
+        return build.result(timeout=MODEL_CALL_TIMEOUT)
+    
+    try:
+        model, expires_at = create_agent_model(api_key, model_name)
+    except BaseException as e:
+        with model_cache_lock:
+            model_builds.pop(key, None)
+        build.set_exception(e)
+        raise
+    with model_cache_lock:
+        model_builds.pop(key, None)
+        model_cache[key] = {"model": model, "expires_at": expires_at}
+        model_cache.move_to_end(key)
+        while len(model_cache) > MODEL_CACHE_SIZE:
+            model_cache.popitem(last=False)
+    build.set_result(model)
+    return model
+
+# --- Conversation Memory ---
+# Recent messages under a token budget, older turns folded into a running
+# summary, plus the email IDs/senders the tools returned.
+conversation_memory = ConversationMemory(
+    window_tokens=int(os.getenv("MEMORY_WINDOW_TOKENS", "4000")),
+    summary_tokens=int(os.getenv("MEMORY_SUMMARY_TOKENS", "600")),
+    max_references=int(os.getenv("MEMORY_MAX_REFERENCES", "20")),
+)
+# "model" summarizes evicted turns with Gemini, "extractive" keeps clipped lines (no extra call)
+MEMORY_SUMMARIZER = os.getenv("MEMORY_SUMMARIZER", "model")
+
+def model_summarizer(api_key, model_name):
+    """Folds evicted turns into the running summary with one plain (tool-less) Gemini call under the session's key."""
+    def summarize(previous_summary, messages, max_tokens):
+        transcript = "\n".join(
+            f"{'User' if m['role'] == 'user' else 'Assistant'}: {m['content']}" for m in messages
+        )
+        prompt = (
+            f"Update the running summary of a conversation between a user and their email assistant. "
+            f"Keep it under {max_tokens * 3 // 4} words. Keep facts, decisions, open requests, names, "
+            f"email addresses and email IDs; drop pleasantries.\n\n"
+            f"Current summary:\n{previous_summary or '(none)'}\n\n"
+            f"Older turns to fold in:\n{transcript}\n\nUpdated summary:"
+        )
+        response = gemini_clients.model(api_key, model_name).generate_content(
+            prompt, request_options={"timeout": MODEL_CALL_TIMEOUT}
+        )
+        return response.text
+    return summarize
+
+async def build_agent_chat(api_key, model_name, session):
+    """Creates a Gemini chat primed with the system prompt, tools and the session's memory.
+    
+    A model that isn't cached yet is built in the tool pool, so a cache
+    miss never blocks the event loop. Returns (chat, function_map).
+    """
+    with tracer.span("model.load", model=model_name) as span:
+        model = cached_agent_model(api_key, model_name)
+        if model is None:
+            span.set(built=True)
+            context = contextvars.copy_context()
+            model = await asyncio.get_running_loop().run_in_executor(
+                tool_executor, functools.partial(context.run, get_agent_model, api_key, model_name)
+            )
+    with tracer.span("history.assemble") as span:
+        history = conversation_memory.history(session)
+        span.set(
+            messages=len(history),
+            history_tokens=sum(estimate_tokens(part["text"]) for content in history for part in content["parts"])
+        )
+    chat = model.start_chat(history=history)
+    return chat, FUNCTION_MAP
+
+def remember_exchange(session, command, final_text, tool_log=(), model_name=None, api_key=None):
+    """Saves a finished exchange (and the emails its tools touched) to the session memory.
+    
+    May call the model to summarize older turns, so run it off the event loop.
+    """
+    # Re-read the session so exchanges finished meanwhile (other tabs/workers) are kept
+    session = session_store.get(session["token"]) or session
+    summarizer = model_summarizer(api_key, model_name) if MEMORY_SUMMARIZER == "model" and model_name and api_key else None
+    conversation_memory.remember(session, command, final_text, tool_log, summarizer=summarizer)
+    session_store.save(session)
+
+async def remember_exchange_async(session, command, final_text, tool_log, model_name, api_key):
+    """remember_exchange in the tool pool, inside a "memory.remember" span."""
+    with tracer.span("memory.remember"):
+        context = contextvars.copy_context()
+        await asyncio.get_running_loop().run_in_executor(
+            tool_executor, functools.partial(context.run, remember_exchange, session, command, final_text, tool_log, model_name, api_key)
+        )
+
+# Turns slower than this print their slowest spans to the console
+SLOW_TURN_SECONDS = float(os.getenv("SLOW_TURN_SECONDS", "10"))
+
+def log_slow_turn(trace):
+    duration = time.perf_counter() - trace.started
+    if duration > SLOW_TURN_SECONDS:
+        print(f"Slow agent turn ({duration:.1f}s): {trace.breakdown()}")
+
+@app.post("/api/agent")
+async def agent_endpoint(req: AgentRequest, request: Request):
+    session = get_session(request)
+    if not session:
+        raise HTTPException(status_code=401, detail="Please login first")
+    
+    api_key = req.gemini_key or session["gemini_api_key"]
+    if not api_key:
         return {
+            "type": "error", 
+            "message": "Gemini API Key is missing. Please add it in settings."
+        }
+    
+    try:
+        model_name = req.model if req.model else "gemini-2.5-flash"
+        with tracer.trace() as trace:
+            with tracer.span("agent.turn", model=model_name):
+                chat, function_map = await build_agent_chat(api_key, model_name, session)
+                tool_log = []
+                
+                # Run the turn off the request path so a client disconnect or timeout can cancel it
+                final_text = await wait_for_agent_turn(
+                    asyncio.create_task(run_agent_turn(chat, req.command, function_map, tool_log=tool_log)),
+                    request
+                )
+                if final_text is None:
+                    # Client went away; nothing to send or remember
+                    return {"type": "error", "message": "Request cancelled"}
+                
+                await remember_exchange_async(session, req.command, final_text, tool_log, model_name, api_key)
+        log_slow_turn(trace)
+        
+        response = {
             "type": "response",
             "message": final_text
         }
+        if req.debug:
+            response["trace"] = trace.to_dict()
+        return response
         
     except Exception as e:
         import traceback
@@ -1148,5 +2267,71 @@ You have access to 15 specific tools. Use them intelligently based on the user's
             "message": f"AI Error: {str(e)}"
         }
 
+@app.post("/api/agent/stream")
+async def agent_stream_endpoint(req: AgentRequest, request: Request):
+    """Same as /api/agent, but streams tool_start/tool_finish/token events and a final done event (SSE)"""
+    session = get_session(request)
+    if not session:
+        raise HTTPException(status_code=401, detail="Please login first")
+    
+    api_key = req.gemini_key or session["gemini_api_key"]
+    if not api_key:
+        return {
+            "type": "error", 
+            "message": "Gemini API Key is missing. Please add it in settings."
+        }
+    
+    events = asyncio.Queue()
+    
+    async def emit(event, data):
+        await events.put((event, data))
+    
+    async def produce():
+        # The response body is produced outside the endpoint call, so re-bind the session
+        current_session.set(session)
+        started = time.perf_counter()
+        try:
+            model_name = req.model if req.model else "gemini-2.5-flash"
+            with tracer.trace() as trace:
+                with tracer.span("agent.turn", model=model_name, streamed=True):
+                    chat, function_map = await build_agent_chat(api_key, model_name, session)
+                    tool_log = []
+                    final_text = await asyncio.wait_for(
+                        run_agent_turn(chat, req.command, function_map, emit, tool_log=tool_log),
+                        timeout=AGENT_TURN_TIMEOUT
+                    )
+                    await remember_exchange_async(session, req.command, final_text, tool_log, model_name, api_key)
+            log_slow_turn(trace)
+            done = {"message": final_text, "duration_ms": round((time.perf_counter() - started) * 1000, 1)}
+            if req.debug:
+                done["trace"] = trace.to_dict()
+            await emit("done", done)
+        except asyncio.TimeoutError:
+            await emit("error", {"message": "Sorry, that took too long to complete. Please try again or narrow the request."})
+        except Exception as e:
+            import traceback
+            print(f"Error: {traceback.format_exc()}")  # Log to console
+            await emit("error", {"message": f"AI Error: {str(e)}"})
+        finally:
+            await events.put(None)
+    
+    async def event_source():
+        # Closing the stream (client disconnect) cancels the turn
+        turn = asyncio.create_task(produce())
+        try:
+            while True:
+                item = await events.get()
+                if item is None:
+                    break
+                yield format_sse(*item)
+        finally:
+            turn.cancel()
+    
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
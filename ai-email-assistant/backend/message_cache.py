@@ -0,0 +1,128 @@
+import json
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mailboxes (
+    account TEXT NOT NULL,
+    mailbox TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    PRIMARY KEY (account, mailbox)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    account TEXT NOT NULL,
+    mailbox TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uid INTEGER NOT NULL,
+    record TEXT NOT NULL,
+    cached_at REAL NOT NULL,
+    PRIMARY KEY (account, mailbox, uidvalidity, uid)
+);
+"""
+
+
+class MessageCache:
+    """On-disk cache of parsed messages keyed by (account, mailbox, UIDVALIDITY, UID).
+
+    A UID only identifies the same message while the mailbox UIDVALIDITY
+    stays the same, so every read and write goes through the current
+    UIDVALIDITY and a change drops everything cached for that mailbox.
+    """
+
+    def __init__(self, path="mail_cache.db"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+        self._stats = {"hits": 0, "misses": 0, "writes": 0, "invalidations": 0}
+
+    def check_uidvalidity(self, account, mailbox, uidvalidity):
+        """Records the mailbox UIDVALIDITY, invalidating the mailbox if it changed.
+
+        Returns True when cached entries for the mailbox are still valid.
+        """
+        if uidvalidity is None:
+            return False
+        with self._lock:
+            row = self._db.execute(
+                "SELECT uidvalidity FROM mailboxes WHERE account = ? AND mailbox = ?",
+                (account, mailbox),
+            ).fetchone()
+            if row and row[0] == uidvalidity:
+                return True
+
+            if row:
+                self._db.execute(
+                    "DELETE FROM messages WHERE account = ? AND mailbox = ?",
+                    (account, mailbox),
+                )
+                self._stats["invalidations"] += 1
+            self._db.execute(
+                "INSERT OR REPLACE INTO mailboxes (account, mailbox, uidvalidity) VALUES (?, ?, ?)",
+                (account, mailbox, uidvalidity),
+            )
+            self._db.commit()
+            return row is None
+
+    def get(self, account, mailbox, uidvalidity, uid):
+        """Returns the cached record for a message, or None."""
+        if uidvalidity is None or not self.check_uidvalidity(account, mailbox, uidvalidity):
+            self._bump("misses")
+            return None
+        with self._lock:
+            row = self._db.execute(
+                "SELECT record FROM messages WHERE account = ? AND mailbox = ? AND uidvalidity = ? AND uid = ?",
+                (account, mailbox, uidvalidity, int(uid)),
+            ).fetchone()
+            self._stats["hits" if row else "misses"] += 1
+        return json.loads(row[0]) if row else None
+
+    def put(self, account, mailbox, uidvalidity, uid, record):
+        """Stores a parsed message record (a JSON-serialisable dict)."""
+        if uidvalidity is None:
+            return
+        self.check_uidvalidity(account, mailbox, uidvalidity)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO messages (account, mailbox, uidvalidity, uid, record, cached_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (account, mailbox, uidvalidity, int(uid), json.dumps(record), time.time()),
+            )
+            self._db.commit()
+            self._stats["writes"] += 1
+
+    def discard(self, account, mailbox, uids):
+        """Drops messages that were deleted or moved out of `mailbox`."""
+        uids = [int(u) for u in uids]
+        if not uids:
+            return
+        with self._lock:
+            self._db.executemany(
+                "DELETE FROM messages WHERE account = ? AND mailbox = ? AND uid = ?",
+                [(account, mailbox, u) for u in uids],
+            )
+            self._db.commit()
+
+    def clear(self, account=None):
+        """Drops everything cached (for one account, or for all of them)."""
+        with self._lock:
+            if account is None:
+                self._db.execute("DELETE FROM messages")
+                self._db.execute("DELETE FROM mailboxes")
+            else:
+                self._db.execute("DELETE FROM messages WHERE account = ?", (account,))
+                self._db.execute("DELETE FROM mailboxes WHERE account = ?", (account,))
+            self._db.commit()
+
+    def _bump(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["messages"] = self._db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        return snapshot
@@ -0,0 +1,63 @@
+from email.header import decode_header, make_header
+from email.parser import BytesParser
+
+from bs4 import BeautifulSoup
+
+
+def decode_header_value(value, default=""):
+    """Decodes RFC 2047 encoded-words ("=?utf-8?b?...?=") in a header value."""
+    if not value:
+        return default
+    try:
+        return str(make_header(decode_header(str(value))))
+    except Exception:
+        return str(value)
+
+
+def is_attachment(part):
+    return part.get_content_disposition() == "attachment"
+
+
+def decode_text_part(part):
+    """Decodes a text part's payload with its declared charset (UTF-8 if none or unknown)."""
+    payload = part.get_payload(decode=True)
+    if not payload:
+        return ""
+    charset = part.get_content_charset() or "utf-8"
+    try:
+        return payload.decode(charset, errors="replace")
+    except LookupError:
+        return payload.decode("utf-8", errors="replace")
+
+
+def html_to_text(html):
+    soup = BeautifulSoup(html, "html.parser")
+    for tag in soup(["script", "style", "head"]):
+        tag.decompose()
+    return "\n".join(line.strip() for line in soup.get_text().splitlines() if line.strip())
+
+
+def message_text(msg):
+    """The message's readable text: the first text/plain part, else the first text/html part as text.
+
+    Attachment parts are skipped without decoding them.
+    """
+    html_part = None
+    for part in msg.walk():
+        if part.is_multipart() or is_attachment(part):
+            continue
+        content_type = part.get_content_type()
+        if content_type == "text/plain":
+            text = decode_text_part(part)
+            if text:
+                return text
+        elif content_type == "text/html" and html_part is None:
+            html_part = part
+    if html_part is not None:
+        return html_to_text(decode_text_part(html_part))
+    return ""
+
+
+def parse_message(source):
+    """Parses raw message bytes (a header block, a partial or a whole message)."""
+    return BytesParser().parsebytes(bytes(source))
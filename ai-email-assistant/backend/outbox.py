@@ -0,0 +1,341 @@
+import json
+import random
+import smtplib
+import sqlite3
+import threading
+import time
+import uuid
+from email.utils import getaddresses, make_msgid
+
+from mime_parser import decode_header_value
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id TEXT PRIMARY KEY,
+    account TEXT NOT NULL,
+    recipients TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    message BLOB NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    due_at REAL NOT NULL,
+    scheduled_for REAL,
+    claim TEXT,
+    claimed_at REAL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    sent_at REAL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, due_at);
+CREATE INDEX IF NOT EXISTS outbox_account ON outbox (account, created_at);
+"""
+
+# Seconds to wait before looking again for mail of an account that isn't open on this worker
+ACCOUNT_WAIT = 30
+
+
+def is_connection_error(error):
+    """Dropped connections and socket errors (smtplib's own exceptions subclass OSError too)."""
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+def is_transient(error):
+    """True for failures worth retrying: dropped connections, timeouts and 4xx replies."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return any(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return is_connection_error(error)
+
+
+def message_recipients(msg):
+    return [address for _, address in getaddresses(msg.get_all("To", []) + msg.get_all("Cc", []) + msg.get_all("Bcc", [])) if address]
+
+
+class Outbox:
+    """Durable outbound mail queue delivered by background workers.
+
+    Accepted messages are written to SQLite before enqueue() returns, so a
+    crash doesn't lose them. A claim on messages being sent lapses after
+    `claim_timeout` seconds, so mail caught mid-send by a crashed worker is
+    sent again by another one (at-least-once, with the same Message-ID)
+    without other processes sharing the file re-sending live claims. Workers take
+    up to `batch_size` due messages of one account at a time and send them
+    over a single pooled SMTP session. Transient failures are retried with
+    exponential backoff; permanent ones (5xx) mark the message failed.
+
+    Scheduled mail is the same queue with a later due time: workers sleep
+    until the earliest due_at (an indexed lookup, so thousands of pending
+    messages cost no timers), and enqueue() wakes them early when needed.
+
+    `smtp_for(account)` returns that account's SMTPPool, or None while the
+    account isn't open on this process; its mail then waits, without using
+    up attempts.
+    """
+
+    def __init__(self, path="outbox.db", smtp_for=None, workers=2, batch_size=20,
+                 max_attempts=8, base_delay=5, max_delay=3600, retention=7 * 86400, max_wait=60, claim_timeout=600):
+        self.smtp_for = smtp_for
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retention = retention
+        # Upper bound on a worker's sleep, so mail queued by another process is still noticed
+        self.max_wait = max_wait
+        self.claim_timeout = claim_timeout
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._last_purge = 0.0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(outbox)")}
+        if "scheduled_for" not in columns:
+            self._db.execute("ALTER TABLE outbox ADD COLUMN scheduled_for REAL")
+        if "claimed_at" not in columns:
+            self._db.execute("ALTER TABLE outbox ADD COLUMN claimed_at REAL")
+        self._db.commit()
+        self._stats = {"enqueued": 0, "sent": 0, "failed": 0, "retries": 0, "batches": 0, "send_seconds_total": 0.0}
+
+    # --- Producer side ---
+
+    def enqueue(self, account, msg, send_at=None):
+        """Persists an email.message.Message for delivery; returns its outbox id.
+
+        `send_at` (a timestamp) schedules it for later instead of sending now.
+        """
+        if not msg.get("Message-ID"):
+            msg["Message-ID"] = make_msgid()
+        recipients = message_recipients(msg)
+        if not recipients:
+            raise ValueError("Message has no recipients")
+        # Bcc goes in the envelope only
+        del msg["Bcc"]
+
+        message_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO outbox (id, account, recipients, subject, message, status, due_at, scheduled_for, created_at) VALUES (?, ?, ?, ?, ?, 'queued', ?, ?, ?)",
+                (message_id, account, json.dumps(recipients), decode_header_value(msg.get("Subject")),
+                 msg.as_bytes(), send_at or now, send_at, now),
+            )
+            self._db.commit()
+            self._stats["enqueued"] += 1
+        self._notify()
+        return message_id
+
+    def get(self, message_id, account=None):
+        """Delivery status of one message ({"id", "status", "attempts", ...}), or None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, account, recipients, subject, status, attempts, due_at, scheduled_for, last_error, created_at, sent_at FROM outbox WHERE id = ?",
+                (message_id,),
+            ).fetchone()
+        if not row or (account is not None and row[1] != account):
+            return None
+        return self._status_dict(row)
+
+    def list(self, account, limit=20):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, account, recipients, subject, status, attempts, due_at, scheduled_for, last_error, created_at, sent_at FROM outbox WHERE account = ? ORDER BY created_at DESC LIMIT ?",
+                (account, int(limit)),
+            ).fetchall()
+        return [self._status_dict(r) for r in rows]
+
+    @staticmethod
+    def _status_dict(row):
+        message_id, _, recipients, subject, status, attempts, due_at, scheduled_for, last_error, created_at, sent_at = row
+        if status == "queued" and scheduled_for and not attempts and due_at > time.time():
+            status = "scheduled"
+        return {
+            "id": message_id,
+            "status": status,
+            "recipients": json.loads(recipients),
+            "subject": subject,
+            "attempts": attempts,
+            "next_attempt_at": due_at if status in ("queued", "scheduled") else None,
+            "scheduled_for": scheduled_for,
+            "last_error": last_error,
+            "created_at": created_at,
+            "sent_at": sent_at,
+        }
+
+    def cancel(self, message_id, account):
+        """Cancels a message that hasn't been sent yet; returns False if it is gone or already sent."""
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE outbox SET status = 'cancelled', claim = NULL WHERE id = ? AND account = ? AND status = 'queued'",
+                (message_id, account),
+            )
+            self._db.commit()
+        return cursor.rowcount == 1
+
+    # --- Workers ---
+
+    def start(self):
+        self._stop.clear()
+        self._threads = [t for t in self._threads if t.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._run, name=f"outbox-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        self._notify()
+
+    def _notify(self):
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            # Cleared before looking, so an enqueue() during the lookup still wakes us
+            self._wakeup.clear()
+            try:
+                account, jobs = self._claim()
+                if jobs:
+                    self._deliver(account, jobs)
+                    continue
+                self._purge_old()
+                delay = self._seconds_until_due()
+            except Exception as e:
+                print(f"Outbox worker error: {e}")
+                delay = 5
+            self._wakeup.wait(timeout=delay)
+
+    def _claim(self):
+        """Marks up to batch_size due messages of one account as sending; returns (account, [(id, recipients, message)])."""
+        now = time.time()
+        claim = uuid.uuid4().hex
+        with self._lock:
+            # The worker holding these died mid-send (rows from before claimed_at existed count as lapsed)
+            self._db.execute(
+                "UPDATE outbox SET status = 'queued', claim = NULL, claimed_at = NULL "
+                "WHERE status = 'sending' AND COALESCE(claimed_at, 0) < ?",
+                (now - self.claim_timeout,),
+            )
+            first = self._db.execute(
+                "SELECT account FROM outbox WHERE status = 'queued' AND due_at <= ? ORDER BY due_at LIMIT 1", (now,)
+            ).fetchone()
+            if not first:
+                return None, []
+            self._db.execute(
+                "UPDATE outbox SET status = 'sending', claim = ?, claimed_at = ? WHERE id IN "
+                "(SELECT id FROM outbox WHERE status = 'queued' AND account = ? AND due_at <= ? ORDER BY due_at LIMIT ?)",
+                (claim, now, first[0], now, self.batch_size),
+            )
+            self._db.commit()
+            rows = self._db.execute(
+                "SELECT id, recipients, message FROM outbox WHERE claim = ? AND status = 'sending' ORDER BY due_at", (claim,)
+            ).fetchall()
+        return first[0], [(r[0], json.loads(r[1]), r[2]) for r in rows]
+
+    def _seconds_until_due(self):
+        with self._lock:
+            row = self._db.execute("SELECT MIN(due_at) FROM outbox WHERE status = 'queued'").fetchone()
+        if not row or row[0] is None:
+            return self.max_wait
+        return min(self.max_wait, max(0.05, row[0] - time.time()))
+
+    def _deliver(self, account, jobs):
+        try:
+            pool = self.smtp_for(account) if self.smtp_for else None
+        except Exception as e:
+            print(f"Outbox can't open SMTP for {account}: {e}")
+            pool = None
+        if pool is None:
+            self._requeue([job[0] for job in jobs], delay=ACCOUNT_WAIT)
+            return
+
+        started = time.perf_counter()
+        pending = list(jobs)
+        try:
+            with pool.connection() as smtp:
+                while pending:
+                    message_id, recipients, message = pending[0]
+                    try:
+                        refused = smtp.sendmail(account, recipients, message)
+                    except Exception as e:
+                        if is_connection_error(e):
+                            raise
+                        # Rejected by the server; the session is still usable for the rest
+                        self._failed_attempt(message_id, e)
+                    else:
+                        self._mark_sent(message_id, refused)
+                    pending.pop(0)
+        except Exception as e:
+            # Login failed or the connection dropped: none of the remaining were sent
+            for message_id, _, _ in pending:
+                self._failed_attempt(message_id, e)
+        with self._lock:
+            self._stats["batches"] += 1
+            self._stats["send_seconds_total"] += time.perf_counter() - started
+
+    def _mark_sent(self, message_id, refused):
+        note = f"Refused recipients: {', '.join(refused)}" if refused else None
+        with self._lock:
+            self._db.execute(
+                "UPDATE outbox SET status = 'sent', claim = NULL, sent_at = ?, attempts = attempts + 1, last_error = ? WHERE id = ?",
+                (time.time(), note, message_id),
+            )
+            self._db.commit()
+            self._stats["sent"] += 1
+
+    def _failed_attempt(self, message_id, error):
+        with self._lock:
+            attempts = self._db.execute("SELECT attempts FROM outbox WHERE id = ?", (message_id,)).fetchone()[0] + 1
+            if is_transient(error) and attempts < self.max_attempts:
+                delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+                self._db.execute(
+                    "UPDATE outbox SET status = 'queued', claim = NULL, attempts = ?, due_at = ?, last_error = ? WHERE id = ?",
+                    (attempts, time.time() + delay, str(error), message_id),
+                )
+                self._stats["retries"] += 1
+            else:
+                self._db.execute(
+                    "UPDATE outbox SET status = 'failed', claim = NULL, attempts = ?, last_error = ? WHERE id = ?",
+                    (attempts, str(error), message_id),
+                )
+                self._stats["failed"] += 1
+            self._db.commit()
+        print(f"Outbox delivery of {message_id} failed (attempt {attempts}): {error}")
+
+    def _requeue(self, message_ids, delay):
+        with self._lock:
+            self._db.executemany(
+                "UPDATE outbox SET status = 'queued', claim = NULL, due_at = ? WHERE id = ?",
+                [(time.time() + delay, message_id) for message_id in message_ids],
+            )
+            self._db.commit()
+
+    def _purge_old(self):
+        now = time.time()
+        if now - self._last_purge < 3600:
+            return
+        self._last_purge = now
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM outbox WHERE status IN ('sent', 'failed', 'cancelled') AND COALESCE(sent_at, due_at) < ?", (now - self.retention,)
+            )
+            self._db.commit()
+
+    # --- Metrics ---
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["by_status"] = dict(self._db.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+        batches = snapshot["batches"]
+        snapshot["send_seconds_avg_per_batch"] = snapshot["send_seconds_total"] / batches if batches else 0.0
+        snapshot["workers"] = sum(1 for t in self._threads if t.is_alive())
+        return snapshot
@@ -0,0 +1,240 @@
+import datetime
+import sqlite3
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_docs (
+    id INTEGER PRIMARY KEY,
+    account TEXT NOT NULL,
+    mailbox TEXT NOT NULL,
+    uid INTEGER NOT NULL,
+    sent_at REAL,
+    sender TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    date TEXT NOT NULL,
+    partial INTEGER NOT NULL,
+    UNIQUE (account, mailbox, uid)
+);
+CREATE INDEX IF NOT EXISTS search_docs_sent ON search_docs (account, mailbox, sent_at);
+CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+    sender, recipients, subject, body,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+# bm25 column weights: sender, recipients, subject, body
+_WEIGHTS = (4.0, 2.0, 6.0, 1.0)
+_DATE_FORMATS = ("%d-%b-%Y", "%Y-%m-%d", "%Y/%m/%d", "%d/%m/%Y")
+
+
+def parse_search_date(value):
+    """Parses "01-Jan-2024" (IMAP style) or "2024-01-01" into a UTC timestamp, or None."""
+    if not value:
+        return None
+    for fmt in _DATE_FORMATS:
+        try:
+            day = datetime.datetime.strptime(value.strip(), fmt)
+            return day.replace(tzinfo=datetime.timezone.utc).timestamp()
+        except ValueError:
+            continue
+    return None
+
+
+def _sent_at(date_header):
+    try:
+        return parsedate_to_datetime(date_header).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _match_terms(text, column=None):
+    """Turns free text into an FTS5 expression: every word must match, as a prefix."""
+    terms = []
+    for word in text.split():
+        word = word.replace('"', '""')
+        term = f'"{word}"*'
+        terms.append(f"{column} : {term}" if column else term)
+    return " AND ".join(terms)
+
+
+class MailSearchIndex:
+    """SQLite FTS5 index over sender, recipients, subject and body of locally known mail.
+
+    Documents are keyed by (account, mailbox, UID). The sync engine adds
+    partial documents (headers + first bytes of the body) as mail arrives,
+    and full bodies replace them when a message is read in full. If the
+    SQLite build has no FTS5, `available` is False and every call is a no-op.
+    """
+
+    def __init__(self, path="mail_cache.db"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        try:
+            self._db.executescript(SCHEMA)
+            self._db.commit()
+            self.available = True
+        except sqlite3.OperationalError as e:
+            print(f"Local search index disabled (SQLite without FTS5?): {e}")
+            self.available = False
+        self._stats = {"indexed": 0, "removed": 0, "searches": 0, "search_seconds_total": 0.0}
+
+    # --- Updates ---
+
+    def index(self, account, mailbox, documents):
+        """Adds or replaces documents: {"uid", "sender", "recipients", "subject", "body", "date", "partial"}.
+
+        A partial document never replaces a full one for the same UID.
+        """
+        if not self.available or not documents:
+            return
+        with self._lock:
+            for doc in documents:
+                uid = int(doc["uid"])
+                partial = 1 if doc.get("partial") else 0
+                row = self._db.execute(
+                    "SELECT id, partial FROM search_docs WHERE account = ? AND mailbox = ? AND uid = ?",
+                    (account, mailbox, uid),
+                ).fetchone()
+                if row and partial and not row[1]:
+                    continue
+
+                values = (_sent_at(doc.get("date")), doc.get("sender") or "", doc.get("subject") or "", doc.get("date") or "", partial)
+                if row:
+                    doc_id = row[0]
+                    self._db.execute(
+                        "UPDATE search_docs SET sent_at = ?, sender = ?, subject = ?, date = ?, partial = ? WHERE id = ?",
+                        values + (doc_id,),
+                    )
+                    self._db.execute("DELETE FROM search_fts WHERE rowid = ?", (doc_id,))
+                else:
+                    doc_id = self._db.execute(
+                        "INSERT INTO search_docs (account, mailbox, uid, sent_at, sender, subject, date, partial) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (account, mailbox, uid) + values,
+                    ).lastrowid
+                self._db.execute(
+                    "INSERT INTO search_fts (rowid, sender, recipients, subject, body) VALUES (?, ?, ?, ?, ?)",
+                    (doc_id, doc.get("sender") or "", doc.get("recipients") or "", doc.get("subject") or "", doc.get("body") or ""),
+                )
+            self._db.commit()
+            self._stats["indexed"] += len(documents)
+
+    def remove(self, account, mailbox, uids):
+        """Drops expunged, deleted or moved messages."""
+        uids = [int(u) for u in uids]
+        if not self.available or not uids:
+            return
+        with self._lock:
+            for uid in uids:
+                row = self._db.execute(
+                    "SELECT id FROM search_docs WHERE account = ? AND mailbox = ? AND uid = ?",
+                    (account, mailbox, uid),
+                ).fetchone()
+                if row:
+                    self._db.execute("DELETE FROM search_fts WHERE rowid = ?", (row[0],))
+                    self._db.execute("DELETE FROM search_docs WHERE id = ?", (row[0],))
+                    self._stats["removed"] += 1
+            self._db.commit()
+
+    def clear_mailbox(self, account, mailbox):
+        """Drops a mailbox's documents (its UIDVALIDITY changed, UIDs mean something else now)."""
+        if not self.available:
+            return
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM search_fts WHERE rowid IN (SELECT id FROM search_docs WHERE account = ? AND mailbox = ?)",
+                (account, mailbox),
+            )
+            self._db.execute("DELETE FROM search_docs WHERE account = ? AND mailbox = ?", (account, mailbox))
+            self._db.commit()
+
+    # --- Queries ---
+
+    def search(self, account, mailbox, query=None, sender=None, subject=None,
+               date_from=None, date_to=None, limit=10, offset=0, min_uid=None):
+        """Ranked search; returns {"total", "results": [{"id", "sender", "subject", "date", "snippet"}]}.
+
+        `query` matches any field, `sender`/`subject` only their column.
+        Dates are "DD-Mon-YYYY" or "YYYY-MM-DD"; date_to is exclusive, like
+        IMAP BEFORE. Without text criteria results are newest first.
+        `mailbox` may be a list, to search several folders at once; results
+        then carry their "mailbox". `min_uid` leaves out lower UIDs. Returns
+        None when the index is unavailable.
+        """
+        if not self.available:
+            return None
+
+        match = " AND ".join(filter(None, [
+            _match_terms(query) if query else "",
+            _match_terms(sender, "sender") if sender else "",
+            _match_terms(subject, "subject") if subject else "",
+        ]))
+        mailboxes = [mailbox] if isinstance(mailbox, str) else list(mailbox)
+        where = ["d.account = ?", f"d.mailbox IN ({', '.join('?' * len(mailboxes))})"]
+        params = [account, *mailboxes]
+        if match:
+            where.append("search_fts MATCH ?")
+            params.append(match)
+        if min_uid is not None:
+            where.append("d.uid >= ?")
+            params.append(int(min_uid))
+        since, before = parse_search_date(date_from), parse_search_date(date_to)
+        if since is not None:
+            where.append("d.sent_at >= ?")
+            params.append(since)
+        if before is not None:
+            where.append("d.sent_at < ?")
+            params.append(before)
+
+        if match:
+            snippet = "snippet(search_fts, 3, '', '', '…', 24)"
+            order = f"bm25(search_fts, {', '.join(str(w) for w in _WEIGHTS)}), d.sent_at DESC"
+        else:
+            snippet = "substr(search_fts.body, 1, 160)"
+            order = "d.sent_at DESC, d.uid DESC"
+        sql_from = f"FROM search_fts JOIN search_docs d ON d.id = search_fts.rowid WHERE {' AND '.join(where)}"
+
+        started = time.perf_counter()
+        with self._lock:
+            try:
+                total = self._db.execute(f"SELECT COUNT(*) {sql_from}", params).fetchone()[0]
+                rows = self._db.execute(
+                    f"SELECT d.mailbox, d.uid, d.sender, d.subject, d.date, {snippet} {sql_from} ORDER BY {order} LIMIT ? OFFSET ?",
+                    params + [int(limit), int(offset)],
+                ).fetchall()
+            except sqlite3.OperationalError as e:
+                # Malformed MATCH expressions surface here
+                print(f"Local search failed: {e}")
+                return None
+            self._stats["searches"] += 1
+            self._stats["search_seconds_total"] += time.perf_counter() - started
+
+        results = []
+        for mailbox_, uid, sender_, subject_, date, text in rows:
+            result = {"id": str(uid), "sender": sender_, "subject": subject_, "date": date, "snippet": text or ""}
+            if len(mailboxes) > 1:
+                result["mailbox"] = mailbox_
+            results.append(result)
+        return {"total": total, "results": results}
+
+    def has_mailbox(self, account, mailbox):
+        if not self.available:
+            return False
+        with self._lock:
+            return self._db.execute(
+                "SELECT 1 FROM search_docs WHERE account = ? AND mailbox = ? LIMIT 1", (account, mailbox)
+            ).fetchone() is not None
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["available"] = self.available
+            if self.available:
+                snapshot["documents"] = self._db.execute("SELECT COUNT(*) FROM search_docs").fetchone()[0]
+        searches = snapshot["searches"]
+        snapshot["search_seconds_avg"] = snapshot["search_seconds_total"] / searches if searches else 0.0
+        return snapshot
@@ -0,0 +1,104 @@
+import datetime
+import re
+
+# Times of day the model tends to pass instead of a clock time
+_NAMED_TIMES = {
+    "midnight": (0, 0), "morning": (9, 0), "noon": (12, 0), "midday": (12, 0),
+    "afternoon": (14, 0), "evening": (18, 0), "tonight": (20, 0), "night": (20, 0),
+}
+_WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+_MONTHS = ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"]
+_UNITS = {"minute": 60, "min": 60, "hour": 3600, "hr": 3600, "day": 86400, "week": 7 * 86400}
+
+_RELATIVE = re.compile(r"^in\s+(\d+|an?|one)\s+(minute|min|hour|hr|day|week)s?$")
+_CLOCK = re.compile(r"\b(\d{1,2})(?::(\d{2}))?\s*(am|pm)?\b")
+_MONTH_DAY = re.compile(r"\b([a-z]{3})[a-z]*\.?\s+(\d{1,2})(?:st|nd|rd|th)?(?:,?\s+(\d{4}))?\b")
+_DAY_MONTH = re.compile(r"\b(\d{1,2})(?:st|nd|rd|th)?\s+([a-z]{3})[a-z]*\.?(?:,?\s+(\d{4}))?\b")
+
+
+def _clock_time(text):
+    """(hour, minute) from "9am", "9:30 pm", "14:00", "noon"...; None if no time is given."""
+    for name, value in _NAMED_TIMES.items():
+        if re.search(rf"\b{name}\b", text):
+            return value
+    for match in _CLOCK.finditer(text):
+        hour, minute, meridiem = int(match.group(1)), int(match.group(2) or 0), match.group(3)
+        if not meridiem and match.group(2) is None:
+            # A bare number is a day of the month, not a time
+            continue
+        if meridiem == "pm" and hour < 12:
+            hour += 12
+        elif meridiem == "am" and hour == 12:
+            hour = 0
+        if hour < 24 and minute < 60:
+            return hour, minute
+    return None
+
+
+def _date(text, now):
+    """The date named in `text` (today, tomorrow, a weekday, "Dec 10", "10 December 2025"), or None."""
+    if re.search(r"\btoday\b|\btonight\b", text):
+        return now.date()
+    if re.search(r"\btomorrow\b", text):
+        return now.date() + datetime.timedelta(days=1)
+    for index, name in enumerate(_WEEKDAYS):
+        if re.search(rf"\b{name[:3]}(?:{name[3:]})?\b", text):
+            ahead = (index - now.weekday()) % 7 or 7
+            return now.date() + datetime.timedelta(days=ahead)
+
+    for pattern, month_group, day_group in ((_MONTH_DAY, 1, 2), (_DAY_MONTH, 2, 1)):
+        match = pattern.search(text)
+        if match and match.group(month_group) in _MONTHS:
+            month = _MONTHS.index(match.group(month_group)) + 1
+            day = int(match.group(day_group))
+            year = int(match.group(3)) if match.group(3) else now.year
+            date = datetime.date(year, month, day)
+            if not match.group(3) and date < now.date():
+                # "Jan 5" said in December means next year
+                date = date.replace(year=year + 1)
+            return date
+    return None
+
+
+def parse_send_time(text, now=None):
+    """Turns a send time like "tomorrow 9am", "Dec 10 2pm", "in 2 hours", "friday
+    evening" or an ISO timestamp into an aware datetime.
+
+    Times without a zone are in the server's local zone, with the UTC
+    offset in force on that date (not today's). A time of day
+    without a date means its next occurrence. Raises ValueError if the text
+    can't be understood or lies in the past.
+    """
+    now = now or datetime.datetime.now().astimezone()
+    raw = (text or "").strip()
+    if not raw:
+        raise ValueError("send_time is empty")
+    value = raw.lower()
+
+    try:
+        parsed = datetime.datetime.fromisoformat(raw.replace("Z", "+00:00"))
+        when = parsed if parsed.tzinfo else parsed.astimezone()
+    except ValueError:
+        when = None
+
+    if when is None and value == "now":
+        when = now
+    if when is None:
+        relative = _RELATIVE.match(value)
+        if relative:
+            amount = relative.group(1)
+            count = 1 if amount in ("a", "an", "one") else int(amount)
+            when = now + datetime.timedelta(seconds=count * _UNITS[relative.group(2)])
+    if when is None:
+        date, clock = _date(value, now), _clock_time(value)
+        if date is None and clock is None:
+            raise ValueError(f"Could not understand send time {raw!r}")
+        hour, minute = clock or (9, 0)
+        local = datetime.datetime.combine(date or now.date(), datetime.time(hour, minute))
+        when = local.astimezone()
+        if date is None and when <= now:
+            when = (local + datetime.timedelta(days=1)).astimezone()
+
+    if when < now - datetime.timedelta(minutes=1):
+        raise ValueError(f"Send time {raw!r} is in the past ({when:%Y-%m-%d %H:%M %Z})")
+    return when
@@ -0,0 +1,228 @@
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    token TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_expiry ON sessions (expires_at);
+"""
+
+
+class MemorySessionBackend:
+    """In-process LRU of sessions with a sliding TTL.
+
+    Only visible to the current process, so it suits a single uvicorn
+    worker; use the SQLite or Redis backend to share sessions.
+    """
+
+    def __init__(self, max_sessions=1000, ttl=86400):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            data, expires_at = entry
+            now = time.time()
+            if expires_at <= now:
+                del self._entries[token]
+                return None
+            # Every use pushes the expiry out again
+            self._entries[token] = (data, now + self.ttl)
+            self._entries.move_to_end(token)
+            return json.loads(data)
+
+    def store(self, token, data):
+        with self._lock:
+            self._entries[token] = (json.dumps(data), time.time() + self.ttl)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_sessions:
+                self._entries.popitem(last=False)
+
+    def delete(self, token):
+        with self._lock:
+            self._entries.pop(token, None)
+
+    def count(self):
+        with self._lock:
+            return len(self._entries)
+
+    def scan(self):
+        now = time.time()
+        with self._lock:
+            entries = [data for data, expires_at in self._entries.values() if expires_at > now]
+        return [json.loads(data) for data in entries]
+
+
+class SQLiteSessionBackend:
+    """Sessions in a SQLite file, shared by every worker process on the host.
+
+    Sessions hold the mailbox password and Gemini key as they are, so the
+    file is created readable by its owner only; keep it off shared disks.
+    """
+
+    def __init__(self, path="sessions.db", ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        if not os.path.exists(path):
+            os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def load(self, token):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data FROM sessions WHERE token = ? AND expires_at > ?",
+                (token, time.time()),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def store(self, token, data):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions (token, data, expires_at) VALUES (?, ?, ?)",
+                (token, json.dumps(data), now + self.ttl),
+            )
+            # Expired rows are swept opportunistically on writes
+            self._db.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+            self._db.commit()
+
+    def delete(self, token):
+        with self._lock:
+            self._db.execute("DELETE FROM sessions WHERE token = ?", (token,))
+            self._db.commit()
+
+    def count(self):
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM sessions WHERE expires_at > ?", (time.time(),)
+            ).fetchone()[0]
+
+    def scan(self):
+        with self._lock:
+            rows = self._db.execute("SELECT data FROM sessions WHERE expires_at > ?", (time.time(),)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+
+class RedisSessionBackend:
+    """Sessions in Redis (or anything speaking its get/set/delete API), shared across hosts.
+
+    `client` only needs `get(key)`, `set(key, value, ex=seconds)`,
+    `delete(key)` and `scan_iter(match=...)`, so a local stand-in can
+    replace a real server.
+    """
+
+    def __init__(self, client, ttl=86400, prefix="email-assistant:session:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def load(self, token):
+        raw = self.client.get(self.prefix + token)
+        return json.loads(raw) if raw else None
+
+    def store(self, token, data):
+        self.client.set(self.prefix + token, json.dumps(data), ex=self.ttl)
+
+    def delete(self, token):
+        self.client.delete(self.prefix + token)
+
+    def count(self):
+        return sum(1 for _ in self.client.scan_iter(match=self.prefix + "*"))
+
+    def scan(self):
+        sessions = []
+        for key in self.client.scan_iter(match=self.prefix + "*"):
+            raw = self.client.get(key)
+            if raw:
+                sessions.append(json.loads(raw))
+        return sessions
+
+
+class SessionStore:
+    """Token-based sessions on top of a pluggable backend.
+
+    A session is a JSON-serialisable dict (credentials, Gemini key, chat
+    history). Every save pushes the expiry out by the backend TTL.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._stats = {"created": 0, "lookups": 0, "misses": 0, "deleted": 0}
+        self._lock = threading.Lock()
+
+    def create(self, data):
+        token = secrets.token_urlsafe(32)
+        self.backend.store(token, data)
+        self._bump("created")
+        return token
+
+    def get(self, token):
+        """Returns the session dict for `token` (with its "token" key set), or None."""
+        if not token:
+            return None
+        data = self.backend.load(token)
+        self._bump("lookups")
+        if data is None:
+            self._bump("misses")
+            return None
+        data["token"] = token
+        return data
+
+    def save(self, session):
+        data = {key: value for key, value in session.items() if key != "token"}
+        self.backend.store(session["token"], data)
+
+    def delete(self, token):
+        self.backend.delete(token)
+        self._bump("deleted")
+
+    def credentials_for(self, email_address):
+        """The password of any live session of `email_address`, or None (used by background work like scheduled mail)."""
+        for data in self.backend.scan():
+            if data.get("email") == email_address:
+                return data.get("password")
+        return None
+
+    def _bump(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+        snapshot["backend"] = type(self.backend).__name__
+        snapshot["sessions"] = self.backend.count()
+        return snapshot
+
+
+def create_session_backend(kind="memory", path="sessions.db", ttl=86400, max_sessions=1000, redis_url=None):
+    """Builds the backend named by `kind`: "memory", "sqlite" or "redis"."""
+    if kind == "memory":
+        return MemorySessionBackend(max_sessions=max_sessions, ttl=ttl)
+    if kind == "sqlite":
+        return SQLiteSessionBackend(path, ttl=ttl)
+    if kind == "redis":
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("SESSION_BACKEND=redis needs the 'redis' package (pip install redis)")
+        return RedisSessionBackend(redis.Redis.from_url(redis_url or "redis://localhost:6379/0"), ttl=ttl)
+    raise ValueError(f"Unknown session backend: {kind}")
@@ -0,0 +1,171 @@
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PooledSMTPConnection:
+    def __init__(self, smtp, generation):
+        self.smtp = smtp
+        self.generation = generation
+        self.last_used = time.monotonic()
+
+    def is_alive(self):
+        try:
+            return self.smtp.noop()[0] == 250
+        except Exception:
+            return False
+
+    def shutdown(self):
+        try:
+            self.smtp.quit()
+        except Exception:
+            try:
+                self.smtp.close()
+            except Exception:
+                pass
+
+
+class SMTPPool:
+    """Keeps authenticated SMTP sessions for one account and hands them out per batch.
+
+    Works like IMAPPool: sessions idle for longer than `health_check_after`
+    seconds are checked with NOOP before reuse, dead ones are replaced, and
+    sessions unused for `idle_timeout` seconds are closed the next time the
+    pool is used (SMTP servers drop idle clients after a few minutes anyway).
+    """
+
+    def __init__(self, host="smtp.gmail.com", port=465, max_size=2, idle_timeout=120, health_check_after=15, timeout=30, ssl=True):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self.timeout = timeout
+
+        self._email = None
+        self._password = None
+        self._generation = 0
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._stats = {"hits": 0, "misses": 0, "reconnects": 0, "discarded": 0, "handshakes": 0, "handshake_seconds_total": 0.0}
+
+    def configure(self, email_address, password):
+        with self._lock:
+            self._email = email_address
+            self._password = password
+            self._generation += 1
+            stale, self._idle = self._idle, []
+        for conn in stale:
+            conn.shutdown()
+
+    def close_all(self):
+        with self._lock:
+            self._email = None
+            self._password = None
+            self._generation += 1
+            stale, self._idle = self._idle, []
+        for conn in stale:
+            conn.shutdown()
+
+    @property
+    def configured(self):
+        return self._email is not None
+
+    @contextmanager
+    def connection(self):
+        """Borrow a logged-in smtplib.SMTP; it is returned to the pool on exit."""
+        if not self.configured:
+            raise smtplib.SMTPException("SMTP pool is not configured")
+
+        self._slots.acquire()
+        conn = None
+        try:
+            conn = self._acquire()
+            try:
+                yield conn.smtp
+            except Exception as e:
+                # Error replies leave the session usable; dropped connections don't
+                if isinstance(e, smtplib.SMTPServerDisconnected) or (
+                        isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException)):
+                    self._discard(conn)
+                    conn = None
+                raise
+        finally:
+            if conn is not None:
+                self._release(conn)
+            self._slots.release()
+
+    def _acquire(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [c for c in self._idle if now - c.last_used > self.idle_timeout]
+            self._idle = [c for c in self._idle if now - c.last_used <= self.idle_timeout]
+        for conn in expired:
+            self._discard(conn)
+
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                self._bump("misses")
+                return self._connect()
+            if conn.generation != self._generation:
+                self._discard(conn)
+                continue
+            if now - conn.last_used > self.health_check_after and not conn.is_alive():
+                self._discard(conn)
+                self._bump("reconnects")
+                continue
+            self._bump("hits")
+            return conn
+
+    def _release(self, conn):
+        conn.last_used = time.monotonic()
+        with self._lock:
+            if conn.generation == self._generation and len(self._idle) < self.max_size:
+                self._idle.append(conn)
+                return
+        self._discard(conn)
+
+    def _discard(self, conn):
+        self._bump("discarded")
+        conn.shutdown()
+
+    def _connect(self):
+        with self._lock:
+            email_address, password, generation = self._email, self._password, self._generation
+        if email_address is None:
+            raise smtplib.SMTPException("SMTP pool is not configured")
+
+        started = time.perf_counter()
+        # Plain SMTP is only for local servers (benchmarks, test sinks)
+        smtp_class = smtplib.SMTP_SSL if self.ssl else smtplib.SMTP
+        smtp = smtp_class(self.host, self.port, timeout=self.timeout)
+        try:
+            smtp.login(email_address, password)
+        except Exception:
+            smtp.close()
+            raise
+        elapsed = time.perf_counter() - started
+
+        with self._lock:
+            self._stats["handshakes"] += 1
+            self._stats["handshake_seconds_total"] += elapsed
+        return PooledSMTPConnection(smtp, generation)
+
+    def _bump(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["idle_connections"] = len(self._idle)
+        handshakes = snapshot["handshakes"]
+        snapshot["handshake_seconds_avg"] = snapshot["handshake_seconds_total"] / handshakes if handshakes else 0.0
+        lookups = snapshot["hits"] + snapshot["misses"]
+        snapshot["hit_ratio"] = snapshot["hits"] / lookups if lookups else 0.0
+        return snapshot
@@ -0,0 +1,582 @@
+import base64
+import binascii
+import json
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+
+from folders import quote_mailbox
+from imap_fetch import fetch_message_summaries, parse_fetch_response, summary_to_listing, summary_to_search_document
+from mailbox_ops import search_uid_window
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sync_state (
+    account TEXT NOT NULL,
+    mailbox TEXT NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (account, mailbox)
+);
+CREATE TABLE IF NOT EXISTS mailbox_index (
+    account TEXT NOT NULL,
+    mailbox TEXT NOT NULL,
+    uid INTEGER NOT NULL,
+    row TEXT NOT NULL,
+    PRIMARY KEY (account, mailbox, uid)
+);
+"""
+
+_STATUS_ITEM = re.compile(rb"(MESSAGES|UIDNEXT|UIDVALIDITY|HIGHESTMODSEQ) (\d+)")
+
+
+def _timestamp(date_header):
+    try:
+        return parsedate_to_datetime(date_header).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return 0.0
+
+
+def encode_cursor(positions):
+    """An opaque page cursor for several folders: {mailbox: UID the next page starts below}."""
+    return base64.urlsafe_b64encode(json.dumps(positions, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """The {mailbox: UID} of an encode_cursor() cursor; raises ValueError if it isn't one."""
+    try:
+        positions = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f"Invalid page cursor {cursor!r}")
+    if not isinstance(positions, dict) or not all(isinstance(v, int) for v in positions.values()):
+        raise ValueError(f"Invalid page cursor {cursor!r}")
+    return positions
+
+
+def _uid_cursor(value):
+    """A single-folder cursor (a UID, as int or digits) as an int, or None."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, int) or str(value).isdigit():
+        return int(value)
+    raise ValueError(f"Invalid page cursor {value!r}: expected an email ID")
+
+
+class SyncStore:
+    """Local copy of mailbox listings plus the per-mailbox sync checkpoint."""
+
+    def __init__(self, path="mail_cache.db"):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def get_state(self, account, mailbox):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT state FROM sync_state WHERE account = ? AND mailbox = ?",
+                (account, mailbox),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_state(self, account, mailbox, state):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sync_state (account, mailbox, state) VALUES (?, ?, ?)",
+                (account, mailbox, json.dumps(state)),
+            )
+            self._db.commit()
+
+    def reset_mailbox(self, account, mailbox):
+        with self._lock:
+            self._db.execute("DELETE FROM sync_state WHERE account = ? AND mailbox = ?", (account, mailbox))
+            self._db.execute("DELETE FROM mailbox_index WHERE account = ? AND mailbox = ?", (account, mailbox))
+            self._db.commit()
+
+    def upsert(self, account, mailbox, rows):
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO mailbox_index (account, mailbox, uid, row) VALUES (?, ?, ?, ?)",
+                [(account, mailbox, int(r["id"]), json.dumps(r)) for r in rows],
+            )
+            self._db.commit()
+
+    def update_flags(self, account, mailbox, flags_by_uid):
+        """Applies {uid: [flags]}; returns the rows that actually changed."""
+        changed = []
+        with self._lock:
+            for uid, flags in flags_by_uid.items():
+                found = self._db.execute(
+                    "SELECT row FROM mailbox_index WHERE account = ? AND mailbox = ? AND uid = ?",
+                    (account, mailbox, int(uid)),
+                ).fetchone()
+                if not found:
+                    continue
+                row = json.loads(found[0])
+                if sorted(row.get("flags", [])) == sorted(flags):
+                    continue
+                row["flags"] = flags
+                row["is_unread"] = "\\Seen" not in flags
+                self._db.execute(
+                    "UPDATE mailbox_index SET row = ? WHERE account = ? AND mailbox = ? AND uid = ?",
+                    (json.dumps(row), account, mailbox, int(uid)),
+                )
+                changed.append(row)
+            self._db.commit()
+        return changed
+
+    def remove(self, account, mailbox, uids):
+        with self._lock:
+            self._db.executemany(
+                "DELETE FROM mailbox_index WHERE account = ? AND mailbox = ? AND uid = ?",
+                [(account, mailbox, int(u)) for u in uids],
+            )
+            self._db.commit()
+
+    def known_uids(self, account, mailbox):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT uid FROM mailbox_index WHERE account = ? AND mailbox = ?",
+                (account, mailbox),
+            ).fetchall()
+        return {r[0] for r in rows}
+
+    def trim(self, account, mailbox, keep):
+        """Keeps only the `keep` newest messages of a mailbox locally."""
+        with self._lock:
+            self._db.execute(
+                """DELETE FROM mailbox_index WHERE account = ? AND mailbox = ? AND uid < (
+                       SELECT MIN(uid) FROM (
+                           SELECT uid FROM mailbox_index WHERE account = ? AND mailbox = ?
+                           ORDER BY uid DESC LIMIT ?
+                       )
+                   )""",
+                (account, mailbox, account, mailbox, keep),
+            )
+            self._db.commit()
+
+    def latest(self, account, mailbox, limit):
+        """Newest `limit` listing rows (served from the UID primary-key index)."""
+        return self.page(account, mailbox, limit)
+
+    def page(self, account, mailbox, limit, before=None, after=None):
+        """Up to `limit` rows with UIDs below `before` (newest first) or above `after` (oldest first)."""
+        if after is not None:
+            where, order, bound = "uid > ?", "ASC", after
+        else:
+            where, order, bound = "uid < ?", "DESC", before if before is not None else 2 ** 63 - 1
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT row FROM mailbox_index WHERE account = ? AND mailbox = ? AND {where} ORDER BY uid {order} LIMIT ?",
+                (account, mailbox, bound, int(limit)),
+            ).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def extent(self, account, mailbox):
+        """(number of rows kept, lowest UID kept or None) for a mailbox."""
+        with self._lock:
+            count, low = self._db.execute(
+                "SELECT COUNT(*), MIN(uid) FROM mailbox_index WHERE account = ? AND mailbox = ?",
+                (account, mailbox),
+            ).fetchone()
+        return count, low
+
+
+class SyncEngine:
+    """Keeps SyncStore up to date with the server in the background.
+
+    Each pass compares a STATUS snapshot with the stored checkpoint and only
+    transfers what changed: new UIDs above the highest one seen, flag
+    changes since the last HIGHESTMODSEQ (CONDSTORE), and expunges found by
+    diffing the locally tracked UID range. Servers without CONDSTORE get a
+    FLAGS fetch over that UID range instead. A UIDVALIDITY change triggers a
+    full resync of the newest `window` messages.
+
+    Fetched messages are added to each of `indexes` (full-text, vector) as
+    they arrive and expunged ones are dropped from them.
+
+    `mailboxes` are the folders kept in sync (names, roles or labels, turned
+    into server names by `resolve`), plus any folder read through
+    list_emails() later. Each pass syncs them in parallel on up to `workers`
+    threads, each over its own pooled connection.
+    """
+
+    def __init__(self, pool, store, mailboxes=("inbox",), interval=60, window=500, indexes=(), resolve=None, workers=1):
+        self.pool = pool
+        self.store = store
+        self.indexes = list(indexes)
+        self.mailboxes = list(mailboxes)
+        self.resolve = resolve
+        self.workers = max(1, workers)
+        self.interval = interval
+        self.window = window
+
+        self.account = None
+        self._tracked = []
+        self._resolved = set()
+        self._pending = set()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._mailbox_locks = {}
+        self._listeners = []
+        self._stats = {"passes": 0, "unchanged": 0, "full_resyncs": 0, "new": 0, "flag_changes": 0, "expunged": 0, "errors": 0, "last_sync": None}
+
+    # --- Lifecycle ---
+
+    def start(self, account):
+        self.stop()
+        self.account = account
+        self._stop.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="imap-sync-folder")
+        self._thread = threading.Thread(target=self._run, name="imap-sync", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._wake.clear()
+        self.account = None
+
+    def request_sync(self, mailbox=None):
+        """Wakes the background worker for an early pass over `mailbox` (all folders if None)."""
+        with self._lock:
+            self._pending.add(mailbox)
+        self._wake.set()
+
+    def add_listener(self, callback):
+        """Registers callback(account, mailbox, deltas) run after each pass that changed something."""
+        self._listeners.append(callback)
+
+    def track(self, mailbox):
+        """Adds a folder to the ones synced in the background."""
+        with self._lock:
+            if mailbox not in self._tracked:
+                self._tracked.append(mailbox)
+
+    def tracked(self):
+        with self._lock:
+            return list(self._tracked)
+
+    def _resolve_configured(self):
+        """Tracks the configured folders; unknown ones are skipped, lookups that failed are retried next pass."""
+        for name in self.mailboxes:
+            if name in self._resolved:
+                continue
+            try:
+                self.track(self.resolve(name) if self.resolve else name)
+                self._resolved.add(name)
+            except ValueError as e:
+                self._resolved.add(name)
+                print(f"Not syncing mailbox '{name}': {e}")
+            except Exception as e:
+                print(f"Could not look up mailbox '{name}' yet: {e}")
+
+    def _run(self):
+        due = None
+        while not self._stop.is_set():
+            self._resolve_configured()
+            self._sync_all(self.tracked() if due is None else [m for m in self.tracked() if m in due])
+            # A full pass every `interval`; request_sync() runs just the folders asked for
+            woken = self._wake.wait(self.interval)
+            self._wake.clear()
+            with self._lock:
+                pending, self._pending = self._pending, set()
+            due = None if not woken or None in pending else pending
+
+    def _sync_all(self, mailboxes):
+        """Syncs `mailboxes` in parallel on the worker pool and waits for all of them."""
+        executor = self._executor
+        if executor is None or not mailboxes:
+            return
+        futures = {executor.submit(self.sync_now, mailbox): mailbox for mailbox in mailboxes}
+        for future, mailbox in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                self._bump("errors")
+                print(f"Sync error ({mailbox}): {e}")
+
+    # --- Reading ---
+
+    def is_synced(self, mailbox="inbox"):
+        return self.account is not None and self.store.get_state(self.account, mailbox) is not None
+
+    def ensure_synced(self, mailboxes):
+        """Syncs (in parallel) whichever of `mailboxes` were never synced, and keeps them all tracked."""
+        for mailbox in mailboxes:
+            self.track(mailbox)
+        missing = [m for m in mailboxes if not self.is_synced(m)]
+        if len(missing) == 1 or self._executor is None:
+            for mailbox in missing:
+                self.sync_now(mailbox)
+        elif missing:
+            for future in [self._executor.submit(self.sync_now, m) for m in missing]:
+                future.result()
+
+    def list_emails(self, mailbox="inbox", limit=15):
+        """Listing rows from local state; syncs once first if the mailbox was never synced."""
+        if self.account is None:
+            return []
+        self.ensure_synced([mailbox])
+        return self.store.latest(self.account, mailbox, limit)
+
+    def page(self, mailbox="inbox", limit=15, before=None, after=None):
+        """One page of listing rows, newest first: UIDs below `before`, or the next ones above `after`.
+
+        Returns {"emails", "next_before", "next_after"}; pass "next_before"
+        as `before` for the older page and "next_after" as `after` for the
+        newer one (None when there is none). Rows come from local state; the
+        part of a page below the synced window is looked up on the server
+        with narrow UID-range searches, so a deep page costs about as much
+        as the first one.
+        """
+        if self.account is None:
+            return {"emails": [], "next_before": None, "next_after": None}
+        before, after = _uid_cursor(before), _uid_cursor(after)
+        self.ensure_synced([mailbox])
+        account = self.account
+        low = self.unsynced_below(mailbox)
+        beyond = low is not None
+
+        if after is not None:
+            rows = self.store.page(account, mailbox, limit + 1, after=after)
+            if beyond and after + 1 < low:
+                rows = self._server_rows(mailbox, after + 1, low - 1, limit + 1, newest=False) + rows
+            more = len(rows) > limit
+            rows = rows[:limit][::-1]
+            return {
+                "emails": rows,
+                "next_before": rows[-1]["id"] if rows else None,
+                "next_after": rows[0]["id"] if more else None,
+            }
+
+        rows = self.store.page(account, mailbox, limit + 1, before=before)
+        if beyond and len(rows) <= limit:
+            high = min(low, before if before is not None else low) - 1
+            rows += self._server_rows(mailbox, 1, high, limit + 1 - len(rows))
+        more = len(rows) > limit
+        rows = rows[:limit]
+        return {
+            "emails": rows,
+            "next_before": rows[-1]["id"] if more else None,
+            "next_after": rows[0]["id"] if rows and before is not None else None,
+        }
+
+    def unsynced_below(self, mailbox="inbox"):
+        """The lowest UID kept locally when older messages of `mailbox` exist only on the server, else None."""
+        state = self.store.get_state(self.account, mailbox) or {}
+        kept, low = self.store.extent(self.account, mailbox)
+        if kept < state.get("messages", 0) and low is not None and low > 1:
+            return low
+        return None
+
+    def _server_rows(self, mailbox, low, high, count, newest=True):
+        """Listing rows for up to `count` UIDs in low..high, fetched from the server (not kept locally)."""
+        if high < low or count <= 0:
+            return []
+        with self.pool.connection(mailbox) as mail:
+            uids = search_uid_window(mail, low, high, count, newest=newest)
+            return self._listing_rows(mail, self.account, mailbox, [str(u) for u in uids])
+
+    def list_across(self, mailboxes, limit=15, before=None):
+        """Newest rows over several folders, each tagged with its "mailbox"; same result shape as page().
+
+        Folders are paged one by one and merged by Date header (UIDs of
+        different folders don't compare); `before` is the opaque
+        "next_before" of the previous page. A message seen in several
+        folders (Gmail's All Mail holds the inbox too) is listed once,
+        under the first of `mailboxes` that has it.
+        """
+        if self.account is None:
+            return {"emails": [], "next_before": None, "next_after": None}
+        positions = decode_cursor(before) if before else {}
+        self.ensure_synced(mailboxes)
+        # 0 marks a folder that ran out on an earlier page
+        pages = {m: self.page(m, limit, before=positions.get(m)) for m in mailboxes if positions.get(m) != 0}
+        heads = {m: list(p["emails"]) for m, p in pages.items()}
+
+        rows, seen = [], set()
+        while len(rows) < limit:
+            live = [m for m in mailboxes if heads.get(m)]
+            if not live:
+                break
+            mailbox = max(live, key=lambda m: _timestamp(heads[m][0].get("date")))
+            row = heads[mailbox].pop(0)
+            positions[mailbox] = int(row["id"])
+            key = (row.get("sender"), row.get("subject"), row.get("date"))
+            if key in seen:
+                continue
+            seen.add(key)
+            rows.append({**row, "mailbox": mailbox})
+
+        for mailbox, page in pages.items():
+            if not heads[mailbox] and page["next_before"] is None:
+                positions[mailbox] = 0
+        more = any(position != 0 for position in positions.values()) or len(positions) < len(mailboxes)
+        return {"emails": rows, "next_before": encode_cursor(positions) if more and rows else None, "next_after": None}
+
+    def _bump(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["mailboxes"] = list(self._tracked)
+        return snapshot
+
+    # --- Sync pass ---
+
+    def sync_now(self, mailbox="inbox"):
+        """Runs one incremental sync pass and returns the deltas it applied."""
+        account = self.account
+        if account is None:
+            return None
+        # Passes over the same folder never overlap; different folders sync concurrently
+        with self._lock:
+            mailbox_lock = self._mailbox_locks.setdefault(mailbox, threading.Lock())
+        with mailbox_lock:
+            with self.pool.connection(mailbox=None) as mail:
+                deltas = self._sync_mailbox(mail, account, mailbox)
+        with self._lock:
+            self._stats["passes"] += 1
+            self._stats["last_sync"] = time.time()
+        if deltas and (deltas["new"] or deltas["flags"] or deltas["expunged"]):
+            for callback in list(self._listeners):
+                try:
+                    callback(account, mailbox, deltas)
+                except Exception as e:
+                    print(f"Sync listener error: {e}")
+        return deltas
+
+    def _status(self, mail, mailbox, condstore):
+        items = "(MESSAGES UIDNEXT UIDVALIDITY HIGHESTMODSEQ)" if condstore else "(MESSAGES UIDNEXT UIDVALIDITY)"
+        status, data = mail.status(quote_mailbox(mailbox), items)
+        if status != "OK":
+            raise RuntimeError(f"STATUS {mailbox} failed: {data}")
+        return {k.decode().lower(): int(v) for k, v in _STATUS_ITEM.findall(data[0])}
+
+    def _sync_mailbox(self, mail, account, mailbox):
+        deltas = {"new": [], "flags": [], "expunged": [], "full_resync": False}
+        condstore = "CONDSTORE" in mail.capabilities
+        status = self._status(mail, mailbox, condstore)
+        state = self.store.get_state(account, mailbox)
+
+        if state and state.get("uidvalidity") != status.get("uidvalidity"):
+            for index in self.indexes:
+                index.clear_mailbox(account, mailbox)
+            state = None
+        if state and state.get("uidnext") == status.get("uidnext") and state.get("messages") == status.get("messages") \
+                and (not condstore or state.get("highestmodseq") == status.get("highestmodseq")):
+            self._bump("unchanged")
+            return deltas
+
+        mail.ensure_selected(mailbox)
+
+        if state is None:
+            deltas["full_resync"] = True
+            self._bump("full_resyncs")
+            self.store.reset_mailbox(account, mailbox)
+            uids = self._newest_uids(mail, status.get("messages", 0))
+            rows = self._listing_rows(mail, account, mailbox, uids)
+            self.store.upsert(account, mailbox, rows)
+            deltas["new"] = rows
+        else:
+            known = self.store.known_uids(account, mailbox)
+            last_uid = state.get("last_uid", 0)
+            low_uid = min(known) if known else last_uid + 1
+
+            # New mail: everything above the highest UID we have seen
+            _, data = mail.uid("SEARCH", None, f"UID {last_uid + 1}:*")
+            arrived = [u for u in (data[0] or b"").split() if int(u) > last_uid]
+            # Only the newest `window` are fetched, but all of them count towards MESSAGES
+            new_uids = arrived[-self.window:]
+            rows = self._listing_rows(mail, account, mailbox, new_uids)
+            self.store.upsert(account, mailbox, rows)
+            deltas["new"] = rows
+
+            if known:
+                if condstore and state.get("highestmodseq"):
+                    # Only messages whose MODSEQ moved since the last pass are returned
+                    _, data = mail.uid("FETCH", f"{low_uid}:{last_uid}", "(UID FLAGS)", f"(CHANGEDSINCE {state['highestmodseq']})")
+                    flags = self._flags_by_uid(data)
+                    if status.get("messages", 0) < state.get("messages", 0) + len(arrived):
+                        _, data = mail.uid("SEARCH", None, f"UID {low_uid}:{last_uid}")
+                        present = {int(u) for u in (data[0] or b"").split()}
+                    else:
+                        present = known
+                else:
+                    # UID-range diff: FLAGS for every tracked message, missing UIDs were expunged
+                    _, data = mail.uid("FETCH", f"{low_uid}:{last_uid}", "(UID FLAGS)")
+                    flags = self._flags_by_uid(data)
+                    present = {int(u) for u in flags}
+
+                deltas["flags"] = self.store.update_flags(account, mailbox, flags)
+                expunged = sorted(known - present)
+                if expunged:
+                    self.store.remove(account, mailbox, expunged)
+                    for index in self.indexes:
+                        index.remove(account, mailbox, expunged)
+                deltas["expunged"] = [str(u) for u in expunged]
+
+        self.store.trim(account, mailbox, self.window)
+        highest = max([int(r["id"]) for r in deltas["new"]] + [state.get("last_uid", 0) if state else 0])
+        self.store.save_state(account, mailbox, {
+            "uidvalidity": status.get("uidvalidity"),
+            "uidnext": status.get("uidnext"),
+            "messages": status.get("messages"),
+            "highestmodseq": status.get("highestmodseq"),
+            "last_uid": highest,
+            "synced_at": time.time(),
+        })
+
+        self._bump("new", len(deltas["new"]))
+        self._bump("flag_changes", len(deltas["flags"]))
+        self._bump("expunged", len(deltas["expunged"]))
+        return deltas
+
+    def _newest_uids(self, mail, message_count):
+        """UIDs of the newest `window` messages, found by sequence range instead of SEARCH ALL."""
+        if not message_count:
+            return []
+        low = max(1, message_count - self.window + 1)
+        _, data = mail.fetch(f"{low}:{message_count}", "(UID)")
+        entries = parse_fetch_response(data).values()
+        return sorted((e["uid"] for e in entries if e["uid"]), key=int)
+
+    def _listing_rows(self, mail, account, mailbox, uids):
+        rows = []
+        documents = []
+        for summary in fetch_message_summaries(mail, uids):
+            try:
+                rows.append(summary_to_listing(summary))
+                if self.indexes:
+                    documents.append(summary_to_search_document(summary))
+            except Exception as e:
+                print(f"Error processing email {summary['id']}: {e}")
+        if documents:
+            for index in self.indexes:
+                try:
+                    index.index(account, mailbox, documents)
+                except Exception as e:
+                    print(f"Indexing error ({type(index).__name__}): {e}")
+        return rows
+
+    def _flags_by_uid(self, data):
+        return {
+            entry["uid"]: entry["flags"]
+            for entry in parse_fetch_response(data or []).values()
+            if entry["uid"]
+        }
@@ -0,0 +1,69 @@
+import contextlib
+import time
+
+import pytest
+
+from accounts import AccountRegistry
+from sessions import MemorySessionBackend
+
+
+class FakeAccount:
+    def __init__(self, email_address, password):
+        self.email = email_address
+        self.password = password
+        self.last_used = time.monotonic()
+        self.started = self.closed = False
+        self.events = type("Events", (), {"subscriber_count": 0})()
+        self.pool = self
+
+    @contextlib.contextmanager
+    def connection(self, mailbox=None):
+        if self.password == "wrong":
+            raise RuntimeError("LOGIN failed")
+        yield
+
+    def start(self):
+        self.started = True
+
+    def close(self):
+        self.closed = True
+
+
+def test_same_credentials_share_one_account():
+    registry = AccountRegistry(FakeAccount)
+    first = registry.get("a@example.com", "secret", validate=True)
+    assert registry.get("a@example.com", "secret") is first
+    assert first.started and registry.stats()["opened"] == 1
+
+
+def test_wrong_password_keeps_the_running_account():
+    registry = AccountRegistry(FakeAccount)
+    running = registry.get("a@example.com", "secret")
+    with pytest.raises(RuntimeError):
+        registry.get("a@example.com", "wrong")
+    assert registry.find("a@example.com") is running
+    assert not running.closed
+
+
+def test_new_password_replaces_the_account_once_it_works():
+    registry = AccountRegistry(FakeAccount)
+    old = registry.get("a@example.com", "secret")
+    new = registry.get("a@example.com", "rotated")
+    assert registry.find("a@example.com") is new
+    assert old.closed and new.started and not new.closed
+
+
+def test_reaper_closes_idle_accounts():
+    registry = AccountRegistry(FakeAccount, idle_timeout=60)
+    account = registry.get("a@example.com", "secret")
+    account.last_used -= 120
+    registry.reap_idle()
+    assert account.closed and registry.find("a@example.com") is None
+
+
+def test_memory_sessions_slide_on_use():
+    backend = MemorySessionBackend(ttl=60)
+    backend.store("t", {"email": "a@example.com"})
+    backend._entries["t"] = (backend._entries["t"][0], time.time() + 1)
+    assert backend.load("t") == {"email": "a@example.com"}
+    assert backend._entries["t"][1] > time.time() + 30
@@ -0,0 +1,46 @@
+from bodystructure import attachment_parts, body_parts, decoded_size, parse_fetch_items, text_part
+
+# multipart/mixed: (text/plain, text/html) alternative plus a PDF with an RFC 2231 filename
+RESPONSE = [
+    b'1 (UID 7 BODYSTRUCTURE ((("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 12 1 NIL NIL NIL)'
+    b'("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 40 2 NIL NIL NIL) "ALTERNATIVE")'
+    b'("APPLICATION" "PDF" ("NAME" "r.pdf") NIL NIL "BASE64" 7800 NIL '
+    b'("ATTACHMENT" ("FILENAME*" "utf-8\'\'r%C3%A9sum%C3%A9.pdf")) NIL) "MIXED"))'
+]
+
+
+def structure():
+    return parse_fetch_items(RESPONSE)["7"]["BODYSTRUCTURE"]
+
+
+def test_body_parts_numbers_nested_parts():
+    parts = body_parts(structure())
+    assert [(p["part"], p["content_type"]) for p in parts] == [
+        ("1.1", "text/plain"), ("1.2", "text/html"), ("2", "application/pdf"),
+    ]
+    assert parts[0]["charset"] == "utf-8"
+    assert parts[1]["encoding"] == "quoted-printable"
+
+
+def test_attachment_filename_from_rfc2231_parameter():
+    parts = body_parts(structure())
+    assert parts[2]["disposition"] == "attachment"
+    assert attachment_parts(parts) == [
+        {"part": "2", "filename": "résumé.pdf", "content_type": "application/pdf", "size": decoded_size(parts[2])},
+    ]
+
+
+def test_text_part_prefers_plain_text():
+    assert text_part(body_parts(structure()))["part"] == "1.1"
+
+
+def test_single_part_message_is_part_1():
+    data = [b'1 (UID 3 BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "7BIT" 5 1 NIL NIL NIL))']
+    parts = body_parts(parse_fetch_items(data)["3"]["BODYSTRUCTURE"])
+    assert [p["part"] for p in parts] == ["1"]
+    assert attachment_parts(parts) == []
+
+
+def test_base64_size_is_estimated_decoded():
+    assert decoded_size({"encoding": "base64", "size": 78}) == 57
+    assert decoded_size({"encoding": "7bit", "size": 78}) == 78
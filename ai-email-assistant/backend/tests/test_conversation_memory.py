@@ -0,0 +1,36 @@
+import json
+
+from conversation_memory import ConversationMemory, extract_references
+
+
+def test_references_come_from_arguments_and_results():
+    result = json.dumps({"results": [{"id": "9", "sender": "a@x", "subject": "Hi"}]})
+    refs = extract_references("fetch_emails", {"mailbox": "Sent", "email_ids": ["4"]}, result)
+    assert refs == [
+        {"id": "4", "mailbox": "Sent", "tool": "fetch_emails"},
+        {"id": "9", "mailbox": "Sent", "sender": "a@x", "subject": "Hi", "tool": "fetch_emails"},
+    ]
+
+
+def test_cross_folder_results_keep_their_own_folder():
+    result = json.dumps({"results": [{"id": "9", "mailbox": "Archive", "subject": "Hi"}]})
+    refs = extract_references("fetch_emails", {"mailbox": "*"}, result)
+    assert refs[0]["mailbox"] == "Archive"
+
+
+def test_same_uid_in_two_folders_are_two_emails():
+    memory = ConversationMemory()
+    session = {}
+    listing = json.dumps({"results": [
+        {"id": "5", "mailbox": "inbox", "sender": "a@x", "subject": "In"},
+        {"id": "5", "mailbox": "Sent", "sender": "me@x", "subject": "Out"},
+    ]})
+    memory.remember(session, "list", "ok", [("fetch_emails", {"mailbox": "*"}, listing)])
+    memory.remember(session, "read it", "done", [("mark_as_read", {"email_id": "5"}, "ok")])
+
+    refs = session["memory"]["references"]
+    assert [(r["mailbox"], r["id"]) for r in refs] == [("inbox", "5"), ("Sent", "5")]
+    # The newer mention moved to the front and kept the details of the older one
+    assert refs[0]["tool"] == "mark_as_read" and refs[0]["subject"] == "In"
+    assert "- id 5 in Sent: me@x | Out" in memory.context_text(session)
+
@@ -0,0 +1,30 @@
+from imap_fetch import compress_id_set, parse_fetch_response
+
+
+def test_compress_id_set_collapses_runs():
+    assert compress_id_set([1, 2, 3, 7, 9, 10]) == "1:3,7,9:10"
+
+
+def test_compress_id_set_sorts_and_dedupes_strings():
+    assert compress_id_set(["10", "9", "3", "3", b"4"]) == "3:4,9:10"
+
+
+def test_compress_id_set_empty():
+    assert compress_id_set([]) == ""
+
+
+def test_parse_fetch_response_groups_by_message():
+    data = [
+        (b'1 (UID 41 FLAGS (\\Seen) X-GM-THRID 99 BODY[HEADER.FIELDS (FROM SUBJECT)] {27}', b"From: a@x\r\nSubject: hi\r\n\r\n"),
+        b")",
+        (b"2 (UID 42 FLAGS () BODY[TEXT]<0> {5}", b"hello"),
+        b")",
+    ]
+    messages = parse_fetch_response(data)
+    assert messages["1"]["uid"] == "41"
+    assert messages["1"]["flags"] == ["\\Seen"]
+    assert messages["1"]["thread_id"] == "99"
+    assert messages["1"]["sections"]["HEADER.FIELDS"].startswith(b"From: a@x")
+    assert messages["2"]["uid"] == "42"
+    assert messages["2"]["flags"] == []
+    assert messages["2"]["sections"]["TEXT"] == b"hello"
@@ -0,0 +1,72 @@
+import re
+
+import pytest
+
+from mailbox_ops import search_uid_window
+from sync_engine import _uid_cursor, decode_cursor, encode_cursor
+
+
+class FakeMailbox:
+    """Answers "UID lo:hi [SUBJECT x]" searches over a set of UIDs and records them."""
+
+    def __init__(self, uids, subjects=None):
+        self.uids = sorted(uids)
+        self.subjects = subjects or {}
+        self.searches = []
+
+    def uid(self, command, charset, criteria):
+        assert command == "SEARCH"
+        self.searches.append(criteria)
+        match = re.match(r'UID (\d+):(\d+)(?: SUBJECT "(.*)")?$', criteria)
+        lo, hi, subject = int(match.group(1)), int(match.group(2)), match.group(3)
+        found = [u for u in self.uids if lo <= u <= hi and (subject is None or subject in self.subjects.get(u, ""))]
+        return "OK", [" ".join(map(str, found)).encode()]
+
+
+def test_newest_uids_first_from_a_narrow_window():
+    mail = FakeMailbox(range(1, 100001))
+    assert search_uid_window(mail, 1, 100000, 5) == [100000, 99999, 99998, 99997, 99996]
+    assert len(mail.searches) == 1
+
+
+def test_oldest_first_when_not_newest():
+    mail = FakeMailbox(range(1, 1001))
+    assert search_uid_window(mail, 1, 1000, 3, newest=False) == [1, 2, 3]
+
+
+def test_window_grows_over_sparse_ranges():
+    # Two messages left in a mailbox with a long UID history
+    mail = FakeMailbox([3, 50000])
+    assert search_uid_window(mail, 1, 100000, 2) == [50000, 3]
+    # The window doubles each time, so a few searches cover the whole range
+    assert len(mail.searches) <= 9
+
+
+def test_criteria_narrow_each_search():
+    mail = FakeMailbox(range(1, 11), {2: "invoice 2", 9: "invoice 9"})
+    assert search_uid_window(mail, 1, 10, 5, criteria='SUBJECT "invoice"') == [9, 2]
+    assert all(s.endswith('SUBJECT "invoice"') for s in mail.searches)
+
+
+def test_empty_range_searches_nothing():
+    mail = FakeMailbox(range(1, 10))
+    assert search_uid_window(mail, 5, 4, 10) == []
+    assert mail.searches == []
+
+
+def test_folder_cursor_round_trips():
+    positions = {"inbox": 120, "[Gmail]/Sent Mail": 0}
+    assert decode_cursor(encode_cursor(positions)) == positions
+
+
+@pytest.mark.parametrize("cursor", ["zz", encode_cursor({"inbox": "x"})])
+def test_malformed_folder_cursor_is_rejected(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+def test_uid_cursor():
+    assert _uid_cursor("42") == 42
+    assert _uid_cursor(None) is None
+    with pytest.raises(ValueError):
+        _uid_cursor("abc")
@@ -0,0 +1,124 @@
+import contextlib
+import smtplib
+import time
+from email.message import EmailMessage
+
+import pytest
+
+from outbox import Outbox
+
+
+class FakeSMTP:
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.sent = []
+
+    def sendmail(self, sender, recipients, message):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((sender, recipients))
+        return {}
+
+
+class FakePool:
+    def __init__(self, smtp):
+        self.smtp = smtp
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield self.smtp
+
+
+def message(to="bob@example.com"):
+    msg = EmailMessage()
+    msg["To"] = to
+    msg["Subject"] = "Hello"
+    msg.set_content("Hi")
+    return msg
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "outbox.db")
+
+
+def deliver_due(outbox):
+    account, jobs = outbox._claim()
+    if jobs:
+        outbox._deliver(account, jobs)
+    return jobs
+
+
+def test_claim_takes_one_accounts_due_mail(path):
+    outbox = Outbox(path, batch_size=2)
+    outbox.enqueue("a@example.com", message())
+    outbox.enqueue("a@example.com", message())
+    outbox.enqueue("a@example.com", message())
+    outbox.enqueue("b@example.com", message(), send_at=time.time() + 3600)
+
+    account, jobs = outbox._claim()
+    assert account == "a@example.com"
+    assert len(jobs) == 2
+    assert outbox._claim()[0] == "a@example.com"
+    # The last one is scheduled for later
+    assert outbox._claim() == (None, [])
+
+
+def test_delivery_marks_sent(path):
+    smtp = FakeSMTP()
+    outbox = Outbox(path, smtp_for=lambda account: FakePool(smtp))
+    message_id = outbox.enqueue("a@example.com", message())
+    deliver_due(outbox)
+    assert smtp.sent == [("a@example.com", ["bob@example.com"])]
+    assert outbox.get(message_id)["status"] == "sent"
+
+
+def test_transient_failure_is_retried_with_backoff(path):
+    smtp = FakeSMTP([smtplib.SMTPResponseException(421, b"try later")])
+    outbox = Outbox(path, smtp_for=lambda account: FakePool(smtp), base_delay=60)
+    message_id = outbox.enqueue("a@example.com", message())
+    deliver_due(outbox)
+
+    status = outbox.get(message_id)
+    assert status["status"] == "queued"
+    assert status["attempts"] == 1
+    assert status["next_attempt_at"] > time.time() + 30
+    assert outbox._claim() == (None, [])
+
+
+def test_permanent_failure_marks_failed(path):
+    smtp = FakeSMTP([smtplib.SMTPResponseException(550, b"no such user")])
+    outbox = Outbox(path, smtp_for=lambda account: FakePool(smtp))
+    message_id = outbox.enqueue("a@example.com", message())
+    deliver_due(outbox)
+    assert outbox.get(message_id)["status"] == "failed"
+
+
+def test_mail_waits_while_account_is_closed(path):
+    outbox = Outbox(path, smtp_for=lambda account: None)
+    message_id = outbox.enqueue("a@example.com", message())
+    deliver_due(outbox)
+    status = outbox.get(message_id)
+    assert status["status"] == "queued"
+    assert status["attempts"] == 0
+
+
+def test_live_claims_survive_another_process_starting(path):
+    first = Outbox(path, claim_timeout=60)
+    first.enqueue("a@example.com", message())
+    assert len(first._claim()[1]) == 1
+
+    second = Outbox(path, claim_timeout=60)
+    assert second._claim() == (None, [])
+
+
+def test_lapsed_claims_are_taken_back(path):
+    first = Outbox(path, claim_timeout=60)
+    first.enqueue("a@example.com", message())
+    first._claim()
+    # The claiming worker died a while ago
+    first._db.execute("UPDATE outbox SET claimed_at = claimed_at - 120")
+    first._db.commit()
+
+    second = Outbox(path, claim_timeout=60)
+    assert len(second._claim()[1]) == 1
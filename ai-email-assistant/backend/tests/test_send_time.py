@@ -0,0 +1,82 @@
+import datetime
+import time
+
+import pytest
+
+from send_time import parse_send_time
+
+
+def set_zone(monkeypatch, zone):
+    """Makes `zone` the process's local time zone for the test."""
+    monkeypatch.setenv("TZ", zone)
+    time.tzset()
+
+
+@pytest.fixture(autouse=True)
+def local_zone(monkeypatch):
+    set_zone(monkeypatch, "Europe/Berlin")
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def local(*args):
+    return datetime.datetime(*args).astimezone()
+
+
+@pytest.fixture
+def now():
+    # A Wednesday afternoon
+    return local(2025, 12, 10, 15, 30)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("tomorrow 9am", (2025, 12, 11, 9, 0)),
+    ("in 2 hours", (2025, 12, 10, 17, 30)),
+    ("in an hour", (2025, 12, 10, 16, 30)),
+    ("friday evening", (2025, 12, 12, 18, 0)),
+    ("Dec 12 2:15pm", (2025, 12, 12, 14, 15)),
+    ("15 January", (2026, 1, 15, 9, 0)),
+    ("2025-12-24T08:00:00", (2025, 12, 24, 8, 0)),
+])
+def test_parses_common_phrasings(now, text, expected):
+    assert parse_send_time(text, now=now) == local(*expected)
+
+
+def test_explicit_zone_is_kept(now):
+    when = parse_send_time("2025-12-24T08:00:00Z", now=now)
+    assert when == datetime.datetime(2025, 12, 24, 8, 0, tzinfo=datetime.timezone.utc)
+
+
+def test_time_of_day_already_past_means_tomorrow(now):
+    assert parse_send_time("9am", now=now) == local(2025, 12, 11, 9, 0)
+
+
+def test_same_weekday_means_next_week(now):
+    assert parse_send_time("wednesday 10am", now=now).date() == datetime.date(2025, 12, 17)
+
+
+def test_month_in_the_past_rolls_to_next_year(now):
+    assert parse_send_time("Jan 5", now=now).year == 2026
+
+
+def test_times_across_a_dst_change_use_that_dates_offset(monkeypatch):
+    set_zone(monkeypatch, "America/New_York")
+    # EDT (-04:00) now, EST (-05:00) from Nov 2
+    now = local(2025, 10, 31, 12, 0)
+    expected = datetime.datetime(2025, 11, 5, 14, 0, tzinfo=datetime.timezone.utc)
+    assert parse_send_time("Nov 5 9am", now=now) == expected
+    assert parse_send_time("2025-11-05T09:00", now=now) == expected
+    # Sunday Nov 2 is the first day on EST
+    assert parse_send_time("sunday 9am", now=now).utcoffset() == datetime.timedelta(hours=-5)
+
+
+def test_bare_number_is_not_a_time(now):
+    with pytest.raises(ValueError):
+        parse_send_time("5", now=now)
+
+
+@pytest.mark.parametrize("text", ["", "whenever", "2020-01-01T00:00:00+00:00"])
+def test_rejects_unparseable_or_past_times(now, text):
+    with pytest.raises(ValueError):
+        parse_send_time(text, now=now)
@@ -0,0 +1,78 @@
+import pytest
+
+from threads import ThreadIndex, message_ids, reply_references, strip_quoted
+
+ACCOUNT = "me@example.com"
+
+
+@pytest.fixture
+def index(tmp_path):
+    return ThreadIndex(str(tmp_path / "threads.db"))
+
+
+def doc(uid, message_id, references="", in_reply_to="", subject="Plans", thread_id=None):
+    return {
+        "uid": uid, "message_id": message_id, "references": references, "in_reply_to": in_reply_to,
+        "sender": "a@example.com", "subject": subject, "date": f"Mon, {uid} Dec 2025 10:00:00 +0000",
+        **({"thread_id": thread_id} if thread_id else {}),
+    }
+
+
+def thread_of(index, mailbox, uid):
+    return [(m["mailbox"], m["id"]) for m in index.thread(ACCOUNT, index.message(ACCOUNT, mailbox, uid)["thread"])]
+
+
+def test_replies_join_their_parent(index):
+    index.index(ACCOUNT, "inbox", [doc(1, "<a@x>"), doc(2, "<b@x>", references="<a@x>", in_reply_to="<a@x>")])
+    index.index(ACCOUNT, "Sent", [doc(3, "<c@x>", references="<a@x> <b@x>")])
+    assert thread_of(index, "inbox", 1) == [("inbox", "1"), ("inbox", "2"), ("Sent", "3")]
+
+
+def test_reply_arriving_before_parent_merges_threads(index):
+    # Two replies to a message not seen yet start separate threads...
+    index.index(ACCOUNT, "inbox", [doc(5, "<r1@x>", in_reply_to="<p@x>"), doc(6, "<r2@x>", references="<other@x>")])
+    assert len(thread_of(index, "inbox", 6)) == 1
+    # ...until a message linking both turns up
+    index.index(ACCOUNT, "inbox", [doc(7, "<p@x>", references="<other@x>")])
+    assert thread_of(index, "inbox", 5) == [("inbox", "5"), ("inbox", "6"), ("inbox", "7")]
+    assert index.stats()["merges"] >= 1
+
+
+def test_gmail_thread_id_groups_unrelated_headers(index):
+    index.index(ACCOUNT, "inbox", [doc(1, "<a@x>", thread_id="77"), doc(2, "<b@x>", thread_id="77")])
+    assert index.message(ACCOUNT, "inbox", 1)["thread"] == "gm:77"
+    assert len(thread_of(index, "inbox", 2)) == 2
+
+
+def test_documents_without_threading_headers_are_ignored(index):
+    index.index(ACCOUNT, "inbox", [{"uid": 1, "subject": "no headers"}])
+    assert index.message(ACCOUNT, "inbox", 1) is None
+
+
+def test_remove_and_clear(index):
+    index.index(ACCOUNT, "inbox", [doc(1, "<a@x>"), doc(2, "<b@x>", references="<a@x>")])
+    index.remove(ACCOUNT, "inbox", ["2"])
+    assert thread_of(index, "inbox", 1) == [("inbox", "1")]
+    index.clear_mailbox(ACCOUNT, "inbox")
+    assert index.message(ACCOUNT, "inbox", 1) is None
+
+
+def test_reply_references_appends_parent():
+    assert reply_references("<a@x> <b@x>", "<c@x>") == "<a@x> <b@x> <c@x>"
+    assert reply_references("", "<c@x>") == "<c@x>"
+    assert reply_references("<a@x>", "<a@x>") == "<a@x>"
+
+
+def test_reply_references_keeps_root_of_long_chains():
+    chain = " ".join(f"<{i}@x>" for i in range(30))
+    ids = message_ids(reply_references(chain, "<new@x>", limit=5))
+    assert ids == ["<0@x>", "<27@x>", "<28@x>", "<29@x>", "<new@x>"]
+
+
+def test_strip_quoted_drops_quote_and_attribution():
+    body = "Sounds good.\n\nOn Mon, 1 Dec 2025 at 10:00, Alice <a@x> wrote:\n> Lunch?\n> Thanks"
+    assert strip_quoted(body) == "Sounds good."
+
+
+def test_strip_quoted_keeps_leading_attribution_like_text():
+    assert strip_quoted("On Monday she wrote:\nhi") == "On Monday she wrote:\nhi"
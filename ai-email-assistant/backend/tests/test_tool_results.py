@@ -0,0 +1,66 @@
+import json
+
+from sync_engine import decode_cursor, encode_cursor
+from tool_results import _size, compact_date, shape_result
+
+
+def rows(count, **extra):
+    return [
+        {"id": str(100 - i), "sender": f"user{i}@example.com", "subject": "s" * 60, "snippet": "b" * 100, **extra}
+        for i in range(count)
+    ]
+
+
+def test_listing_becomes_a_table_with_shared_senders():
+    data = {"results": [
+        {"id": "2", "sender": "a@x", "subject": "one", "date": "Sat, 20 Dec 2025 15:30:00 +0000", "flags": []},
+        {"id": "1", "sender": "a@x", "subject": "two", "date": ""},
+    ]}
+    shaped = shape_result(json.dumps(data), 1000)
+    table = shaped["results"]
+    assert table["columns"] == ["id", "sender#", "subject", "date"]
+    assert table["senders"] == ["a@x"]
+    assert table["rows"][0] == ["2", 0, "one", "2025-12-20 15:30"]
+
+
+def test_compact_date_leaves_other_values():
+    assert compact_date("Unknown") == "Unknown"
+
+
+def test_long_text_is_shortened_before_rows_are_dropped():
+    shaped = shape_result(json.dumps({"id": "1", "body": "word " * 2000}), 200)
+    assert _size(shaped) <= 200
+    assert shaped["body"].endswith("…")
+
+
+def test_plain_text_results_are_cut_to_budget():
+    shaped = shape_result("x" * 10000, 100)
+    assert _size(shaped) <= 100
+
+
+def test_dropped_rows_move_the_cursor_back():
+    shaped = shape_result(json.dumps({"results": rows(30), "next_before": "71"}), 300)
+    kept = shaped["results"]["rows"]
+    assert _size(shaped) <= 300
+    assert shaped["omitted_rows"] == 30 - len(kept)
+    assert shaped["next_before"] == kept[-1][0]
+    assert shaped["omitted_ids"] == [str(100 - i) for i in range(len(kept), 30)]
+
+
+def test_dropped_search_rows_keep_has_more():
+    shaped = shape_result(json.dumps({"page": 1, "total": 30, "has_more": False, "results": rows(30)}), 300)
+    assert shaped["has_more"] is True
+    assert shaped["omitted_ids"]
+
+
+def test_dropped_rows_move_each_folders_cursor_back():
+    listing = [dict(row, mailbox="inbox" if i % 2 else "Sent") for i, row in enumerate(rows(30))]
+    cursor = encode_cursor({"inbox": 71, "Sent": 72})
+    shaped = shape_result(json.dumps({"results": listing, "next_before": cursor}), 300)
+
+    kept = {(row[-1], row[0]) for row in shaped["results"]["rows"]}
+    positions = decode_cursor(shaped["next_before"])
+    for row in listing:
+        uid = int(row["id"])
+        # Rows kept are behind the cursor, dropped ones ahead of it
+        assert (uid < positions[row["mailbox"]]) == ((row["mailbox"], row["id"]) not in kept)
@@ -0,0 +1,210 @@
+import json
+import re
+import sqlite3
+import threading
+from email.utils import parsedate_to_datetime
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS thread_messages (
+    account TEXT NOT NULL,
+    mailbox TEXT NOT NULL,
+    uid INTEGER NOT NULL,
+    message_id TEXT NOT NULL,
+    thread TEXT NOT NULL,
+    sent_at REAL,
+    sender TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    date TEXT NOT NULL,
+    headers TEXT NOT NULL,
+    PRIMARY KEY (account, mailbox, uid)
+);
+CREATE INDEX IF NOT EXISTS thread_messages_thread ON thread_messages (account, thread);
+CREATE TABLE IF NOT EXISTS thread_links (
+    account TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    thread TEXT NOT NULL,
+    PRIMARY KEY (account, message_id)
+);
+CREATE INDEX IF NOT EXISTS thread_links_thread ON thread_links (account, thread);
+"""
+
+_MESSAGE_ID = re.compile(r"<[^<>\s]+>")
+# "On Mon, 1 Jan 2024 at 10:00, Alice <alice@example.com> wrote:" and friends
+_ATTRIBUTION = re.compile(r"^\s*(On\s.+wrote:|-{2,}\s*Original Message\s*-{2,})\s*$", re.IGNORECASE)
+
+
+def message_ids(value):
+    """The <...> Message-IDs in a References/In-Reply-To/Message-ID header value, in order."""
+    return _MESSAGE_ID.findall(value or "")
+
+
+def reply_references(references, message_id, limit=20):
+    """The References header for a reply: the parent's References plus its Message-ID.
+
+    Very long chains keep the first (thread root) and the most recent ids,
+    as RFC 5322 suggests trimming them.
+    """
+    chain = list(dict.fromkeys(message_ids(references) + message_ids(message_id)))
+    if len(chain) > limit:
+        chain = chain[:1] + chain[-(limit - 1):]
+    return " ".join(chain)
+
+
+def strip_quoted(text):
+    """A reply body without the quoted message below it ("> ..." lines and the "On ... wrote:" line)."""
+    lines = []
+    for line in (text or "").splitlines():
+        if _ATTRIBUTION.match(line) and lines:
+            break
+        if line.lstrip().startswith(">"):
+            continue
+        lines.append(line)
+    return "\n".join(lines).strip()
+
+
+def _sent_at(date_header):
+    try:
+        return parsedate_to_datetime(date_header).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+class ThreadIndex:
+    """Groups locally known mail into conversations, across folders.
+
+    Fed like the search indexes: the sync engine hands it the headers of
+    arriving mail and full reads add the rest. Every Message-ID a message
+    names (its own, In-Reply-To, References) is linked to one thread key;
+    a message linking two threads merges them, so replies that arrive
+    before their parents still end up together. Gmail's X-GM-THRID, when
+    the server reports it, seeds the key. Documents without a "message_id"
+    field (no threading headers were fetched) are ignored.
+    """
+
+    def __init__(self, path="mail_cache.db"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+        self._stats = {"indexed": 0, "removed": 0, "merges": 0, "lookups": 0}
+
+    # --- Updates ---
+
+    def index(self, account, mailbox, documents):
+        """Adds or updates messages from {"uid", "message_id", "in_reply_to", "references", "thread_id", ...}."""
+        documents = [doc for doc in documents or () if "message_id" in doc]
+        if not documents:
+            return
+        with self._lock:
+            for doc in documents:
+                self._index_one(account, mailbox, doc)
+            self._db.commit()
+            self._stats["indexed"] += len(documents)
+
+    def _index_one(self, account, mailbox, doc):
+        uid = int(doc["uid"])
+        own = message_ids(doc.get("message_id"))
+        # Without a Message-ID the message can only be its own thread
+        message_id = own[0] if own else f"<{uid}.{mailbox}@local>"
+        linked = list(dict.fromkeys([message_id] + message_ids(doc.get("references")) + message_ids(doc.get("in_reply_to"))))
+
+        placeholders = ", ".join("?" * len(linked))
+        keys = {
+            row[0] for row in self._db.execute(
+                f"SELECT thread FROM thread_links WHERE account = ? AND message_id IN ({placeholders})",
+                (account, *linked),
+            )
+        }
+        previous = self._db.execute(
+            "SELECT thread FROM thread_messages WHERE account = ? AND mailbox = ? AND uid = ?",
+            (account, mailbox, uid),
+        ).fetchone()
+        if previous:
+            keys.add(previous[0])
+        if doc.get("thread_id"):
+            keys.add(f"gm:{doc['thread_id']}")
+
+        # Gmail's thread ids win, then whichever key sorts first (stable across runs)
+        target = min(keys, key=lambda k: (not k.startswith("gm:"), k)) if keys else message_id
+        for key in keys - {target}:
+            self._db.execute("UPDATE thread_links SET thread = ? WHERE account = ? AND thread = ?", (target, account, key))
+            self._db.execute("UPDATE thread_messages SET thread = ? WHERE account = ? AND thread = ?", (target, account, key))
+            self._stats["merges"] += 1
+        self._db.executemany(
+            "INSERT OR REPLACE INTO thread_links (account, message_id, thread) VALUES (?, ?, ?)",
+            [(account, mid, target) for mid in linked],
+        )
+
+        headers = {
+            "message_id": doc.get("message_id") or "",
+            "from": doc.get("from_header") or doc.get("sender") or "",
+            "subject": doc.get("subject_header") or doc.get("subject") or "",
+            "references": doc.get("references") or "",
+            "in_reply_to": doc.get("in_reply_to") or "",
+        }
+        self._db.execute(
+            "INSERT OR REPLACE INTO thread_messages (account, mailbox, uid, message_id, thread, sent_at, sender, subject, date, headers) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (account, mailbox, uid, message_id, target, _sent_at(doc.get("date")),
+             doc.get("sender") or "", doc.get("subject") or "", doc.get("date") or "", json.dumps(headers)),
+        )
+
+    def remove(self, account, mailbox, uids):
+        """Drops expunged, deleted or moved messages (their Message-IDs stay linked to the thread)."""
+        uids = [int(u) for u in uids]
+        if not uids:
+            return
+        with self._lock:
+            self._db.executemany(
+                "DELETE FROM thread_messages WHERE account = ? AND mailbox = ? AND uid = ?",
+                [(account, mailbox, uid) for uid in uids],
+            )
+            self._db.commit()
+            self._stats["removed"] += len(uids)
+
+    def clear_mailbox(self, account, mailbox):
+        """Drops a mailbox's messages (its UIDVALIDITY changed, UIDs mean something else now)."""
+        with self._lock:
+            self._db.execute("DELETE FROM thread_messages WHERE account = ? AND mailbox = ?", (account, mailbox))
+            self._db.commit()
+
+    # --- Queries ---
+
+    def message(self, account, mailbox, uid):
+        """One indexed message: {"mailbox", "id", "message_id", "thread", "sender", "subject", "date", "headers"}, or None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT mailbox, uid, message_id, thread, sender, subject, date, headers FROM thread_messages "
+                "WHERE account = ? AND mailbox = ? AND uid = ?",
+                (account, mailbox, int(uid)),
+            ).fetchone()
+        return self._row(row) if row else None
+
+    def thread(self, account, thread):
+        """The messages of a thread, oldest first; a message kept in several folders appears once per folder."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT mailbox, uid, message_id, thread, sender, subject, date, headers FROM thread_messages "
+                "WHERE account = ? AND thread = ? ORDER BY sent_at, uid",
+                (account, thread),
+            ).fetchall()
+            self._stats["lookups"] += 1
+        return [self._row(row) for row in rows]
+
+    @staticmethod
+    def _row(row):
+        mailbox, uid, message_id, thread, sender, subject, date, headers = row
+        return {
+            "mailbox": mailbox, "id": str(uid), "message_id": message_id, "thread": thread,
+            "sender": sender, "subject": subject, "date": date, "headers": json.loads(headers),
+        }
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["messages"] = self._db.execute("SELECT COUNT(*) FROM thread_messages").fetchone()[0]
+            snapshot["threads"] = self._db.execute("SELECT COUNT(DISTINCT thread) FROM thread_messages").fetchone()[0]
+        return snapshot
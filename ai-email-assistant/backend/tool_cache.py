@@ -0,0 +1,94 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_args(args):
+    """A stable key for tool arguments: sorted, None/"" dropped, numbers and strings unified.
+
+    So fetch_emails(limit=10), fetch_emails(limit=10.0) and
+    fetch_emails(limit="10", query=None) share one entry.
+    """
+    normalized = {}
+    for key, value in (args or {}).items():
+        if value is None or value == "":
+            continue
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if isinstance(value, (list, tuple)):
+            value = [str(v) for v in value]
+        elif not isinstance(value, bool):
+            value = str(value).strip()
+        normalized[key] = value
+    return json.dumps(normalized, sort_keys=True)
+
+
+class ToolCallCache:
+    """Read-through cache of read-only tool results, per account.
+
+    Entries live for `ttl` seconds and are keyed by (account, tool,
+    normalized arguments). Anything that changes a mailbox calls
+    `invalidate(account)`, which drops the account's entries and bumps its
+    generation, so a read that started before the change can't store its
+    stale result afterwards.
+    """
+
+    def __init__(self, ttl=60, max_entries=512):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "expired": 0, "invalidations": 0}
+
+    def key(self, account, tool, args):
+        return (account, tool, normalize_args(args))
+
+    def generation(self, account):
+        with self._lock:
+            return self._generations.get(account, 0)
+
+    def get(self, key):
+        """Returns the cached result for `key`, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            result, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return result
+
+    def put(self, key, result, generation):
+        """Stores `result` unless the account was invalidated since `generation` was read."""
+        with self._lock:
+            if self._generations.get(key[0], 0) != generation:
+                return
+            self._entries[key] = (result, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            self._stats["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, account):
+        with self._lock:
+            self._generations[account] = self._generations.get(account, 0) + 1
+            for key in [k for k in self._entries if k[0] == account]:
+                del self._entries[key]
+            self._stats["invalidations"] += 1
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["entries"] = len(self._entries)
+        lookups = snapshot["hits"] + snapshot["misses"]
+        snapshot["hit_ratio"] = snapshot["hits"] / lookups if lookups else 0.0
+        snapshot["ttl"] = self.ttl
+        return snapshot
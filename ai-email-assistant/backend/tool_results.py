@@ -0,0 +1,203 @@
+import json
+import threading
+from email.utils import parsedate_to_datetime
+
+from conversation_memory import estimate_tokens
+from sync_engine import decode_cursor, encode_cursor
+
+# Free-text fields that may be shortened to fit the budget
+TEXT_FIELDS = ("body", "content", "body_snippet", "snippet")
+SENDER_FIELDS = ("sender", "from")
+MIN_TEXT_CHARS = 80
+
+
+def compact_date(value):
+    """"Mon, 20 Dec 2025 15:30:00 +0000" -> "2025-12-20 15:30" (other values unchanged)."""
+    try:
+        return parsedate_to_datetime(value).strftime("%Y-%m-%d %H:%M")
+    except (TypeError, ValueError, IndexError):
+        return value
+
+
+def _compact(value, key=None):
+    """Drops empty fields, shortens dates and turns lists of records into tables."""
+    if isinstance(value, dict):
+        out = {}
+        for k, v in value.items():
+            v = _compact(v, k)
+            if v is None or v == "" or v == [] or v == {}:
+                continue
+            out[k] = v
+        return out
+    if isinstance(value, list):
+        items = [_compact(v) for v in value]
+        if len(items) > 1 and all(isinstance(i, dict) for i in items):
+            return _table(items)
+        return items
+    if isinstance(value, str):
+        value = value.strip()
+        if key == "date":
+            return compact_date(value)
+    return value
+
+
+def _table(records):
+    """{"columns": [...], "rows": [[...]]}; repeated senders become indexes into "senders"."""
+    columns = []
+    for record in records:
+        columns.extend(k for k in record if k not in columns)
+    rows = [[record.get(c) for c in columns] for record in records]
+    table = {"columns": columns, "rows": rows}
+
+    for field in SENDER_FIELDS:
+        if field not in columns:
+            continue
+        index = columns.index(field)
+        senders = list(dict.fromkeys(row[index] for row in rows))
+        if len(senders) < len(rows):
+            for row in rows:
+                row[index] = senders.index(row[index])
+            columns[index] = f"{field}#"
+            table["senders"] = senders
+        break
+    return table
+
+
+def _text_slots(value):
+    """(container, key) pairs of the shortenable text fields in a compacted payload."""
+    if isinstance(value, dict):
+        if "columns" in value and "rows" in value:
+            for index, column in enumerate(value["columns"]):
+                if column in TEXT_FIELDS:
+                    for row in value["rows"]:
+                        if isinstance(row[index], str):
+                            yield row, index
+        for k, v in value.items():
+            if k in TEXT_FIELDS and isinstance(v, str):
+                yield value, k
+            elif isinstance(v, (dict, list)):
+                yield from _text_slots(v)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _text_slots(item)
+
+
+def _size(value):
+    return estimate_tokens(json.dumps(value, ensure_ascii=False, separators=(",", ":")))
+
+
+def _repaginate(value, table, cursor, dropped):
+    """Lists the `dropped` rows' ids and moves the paging fields back so the next page starts with them."""
+    columns = table["columns"]
+    if "id" not in columns:
+        return
+    ids = [row[columns.index("id")] for row in dropped]
+    value["omitted_ids"] = ids
+    if "has_more" in value:
+        value["has_more"] = True
+    if "mailbox" in columns:
+        # Several folders: the cursor holds each folder's UID to continue below
+        if cursor:
+            positions = decode_cursor(cursor)
+            for row, uid in zip(dropped, ids):
+                mailbox = row[columns.index("mailbox")]
+                positions[mailbox] = max(positions.get(mailbox, 0), int(uid) + 1)
+            value["next_before"] = encode_cursor(positions)
+    elif "next_before" in value or "next_after" in value:
+        value["next_before"] = table["rows"][-1][columns.index("id")]
+
+
+def _fit(value, max_tokens):
+    """Shortens the longest text fields, then drops trailing rows, until `value` fits.
+
+    Dropped rows are listed in "omitted_ids" and a "next_before" cursor is
+    moved back to the last row kept, so paging resumes with them.
+    """
+    cursor = value.get("next_before") if isinstance(value, dict) else None
+    dropped = []
+    while _size(value) > max_tokens:
+        # Anything longer than the minimum plus its "…" can still be shortened
+        slots = [slot for slot in _text_slots(value) if len(slot[0][slot[1]]) > MIN_TEXT_CHARS + 1]
+        longest = max(slots, key=lambda slot: len(slot[0][slot[1]]), default=None)
+        if longest:
+            container, key = longest
+            text = container[key]
+            container[key] = text[:max(MIN_TEXT_CHARS, len(text) // 2)].rstrip() + "…"
+            continue
+
+        table = value.get("results", value) if isinstance(value, dict) else None
+        if isinstance(table, dict) and len(table.get("rows", [])) > 1:
+            dropped.insert(0, table["rows"].pop())
+            value["omitted_rows"] = len(dropped)
+            _repaginate(value, table, cursor, dropped)
+            continue
+        break
+    return value
+
+
+def shape_result(result, max_tokens):
+    """Turns a tool's raw result (usually a JSON string) into a compact dict for FunctionResponse.
+
+    Structured results are passed as native objects rather than JSON text,
+    lists of emails become tables, and the payload is cut to `max_tokens`.
+    """
+    data = result
+    if isinstance(result, str):
+        try:
+            data = json.loads(result)
+        except ValueError:
+            data = result
+    if isinstance(data, str):
+        return {"result": _fit({"content": data}, max_tokens)["content"]}
+
+    data = _compact(data)
+    if not isinstance(data, dict) or ("columns" in data and "rows" in data):
+        data = {"results": data}
+    return _fit(data, max_tokens)
+
+
+class ResultShaper:
+    """Shapes every tool result of an agent turn under one token budget.
+
+    Each batch of results shares what is left of the turn's budget, but
+    every result gets at least `min_result_tokens`.
+    """
+
+    def __init__(self, turn_tokens=6000, min_result_tokens=300):
+        self.turn_tokens = turn_tokens
+        self.min_result_tokens = min_result_tokens
+        self._lock = threading.Lock()
+        self._stats = {"results": 0, "raw_tokens": 0, "shaped_tokens": 0}
+
+    def shape_batch(self, results, remaining):
+        """Shapes [(name, payload)] and returns (shaped results, budget left), in the original order.
+
+        Small results are shaped first, so what they leave of their share
+        goes to the large ones.
+        """
+        shaped = [None] * len(results)
+        raw_tokens = shaped_tokens = 0
+        order = sorted(range(len(results)), key=lambda i: len(str(results[i][1])))
+        for position, i in enumerate(order):
+            name, payload = results[i]
+            if "result" in payload:
+                raw = payload["result"]
+                share = max(self.min_result_tokens, remaining // (len(order) - position))
+                payload = shape_result(raw, share)
+                raw_tokens += estimate_tokens(raw if isinstance(raw, str) else json.dumps(raw))
+            size = _size(payload)
+            shaped_tokens += size
+            remaining = max(0, remaining - size)
+            shaped[i] = (name, payload)
+        with self._lock:
+            self._stats["results"] += len(results)
+            self._stats["raw_tokens"] += raw_tokens
+            self._stats["shaped_tokens"] += shaped_tokens
+        return shaped, remaining
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+        snapshot["turn_tokens_budget"] = self.turn_tokens
+        snapshot["saved_ratio"] = 1 - snapshot["shaped_tokens"] / snapshot["raw_tokens"] if snapshot["raw_tokens"] else 0.0
+        return snapshot
@@ -0,0 +1,201 @@
+import contextvars
+import itertools
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+_ids = itertools.count(1)
+
+
+def _metric_name(text):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", text)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _flatten(prefix, value):
+    """Yields (name, number) for every numeric leaf of a nested stats dict."""
+    if isinstance(value, dict):
+        for key, child in value.items():
+            yield from _flatten(f"{prefix}_{key}", child)
+    elif isinstance(value, bool):
+        yield prefix, int(value)
+    elif isinstance(value, (int, float)):
+        yield prefix, value
+
+
+class Span:
+    def __init__(self, name, parent, attrs):
+        self.id = next(_ids)
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.ok = True
+        self.started = time.perf_counter()
+        self.duration = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def fail(self, error=None):
+        """Marks the span failed without raising (for calls that report errors as results)."""
+        self.ok = False
+        if error:
+            self.attrs.setdefault("error", error)
+
+
+class Trace:
+    """The spans finished during one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def to_dict(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.started)
+        return {
+            "duration_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "spans": [
+                {
+                    "id": s.id,
+                    "parent": s.parent,
+                    "name": s.name,
+                    "start_ms": round((s.started - self.started) * 1000, 1),
+                    "duration_ms": round(s.duration * 1000, 1),
+                    "ok": s.ok,
+                    **s.attrs,
+                }
+                for s in spans
+            ],
+        }
+
+    def breakdown(self, top=8):
+        """One line with the slowest spans, for the console log."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.duration, reverse=True)[:top]
+        return ", ".join(f"{s.name} {s.duration * 1000:.0f}ms" for s in spans)
+
+
+class Tracer:
+    """Times named spans on the hot paths and keeps Prometheus-style aggregates.
+
+    Every span updates a latency histogram per name; numeric attributes
+    ending in `_bytes` or `_tokens` are summed per name too. Spans nest
+    through contextvars, so they follow the request into tool threads
+    (which run in a copied context) and asyncio tasks. While a Trace is
+    active (see `trace()`), the request's spans are also collected for the
+    client.
+    """
+
+    def __init__(self, prefix="email_assistant", buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._sums = {}
+        self._errors = {}
+
+    @contextmanager
+    def span(self, name, **attrs):
+        parent = _current_span.get()
+        span = Span(name, parent.id if parent else None, attrs)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.ok = False
+            span.attrs.setdefault("error", type(e).__name__)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.duration = time.perf_counter() - span.started
+            self._record(span)
+            trace = _current_trace.get()
+            if trace is not None:
+                trace.add(span)
+
+    def annotate(self, **attrs):
+        """Sets attributes on the innermost open span, if any."""
+        span = _current_span.get()
+        if span is not None:
+            span.set(**attrs)
+
+    @contextmanager
+    def trace(self):
+        """Collects the spans finished in this context (and tasks/threads started from it)."""
+        trace = Trace()
+        token = _current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            _current_trace.reset(token)
+
+    def _record(self, span):
+        with self._lock:
+            histogram = self._histograms.get(span.name)
+            if histogram is None:
+                histogram = self._histograms[span.name] = {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0}
+            for i, bound in enumerate(self.buckets):
+                if span.duration <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["count"] += 1
+            histogram["sum"] += span.duration
+            if not span.ok:
+                self._errors[span.name] = self._errors.get(span.name, 0) + 1
+            for key, value in span.attrs.items():
+                if (key.endswith("_bytes") or key.endswith("_tokens")) and isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self._sums[(span.name, key)] = self._sums.get((span.name, key), 0) + value
+
+    def render(self, gauges=None):
+        """Prometheus text exposition of the span aggregates, plus `gauges` ({group: stats dict}) flattened."""
+        with self._lock:
+            histograms = {name: {**h, "buckets": list(h["buckets"])} for name, h in self._histograms.items()}
+            sums = dict(self._sums)
+            errors = dict(self._errors)
+
+        p = self.prefix
+        lines = [
+            f"# HELP {p}_span_seconds Time spent in traced operations.",
+            f"# TYPE {p}_span_seconds histogram",
+        ]
+        for name in sorted(histograms):
+            h = histograms[name]
+            for bound, count in zip(self.buckets, h["buckets"]):
+                lines.append(f'{p}_span_seconds_bucket{{span="{_label(name)}",le="{bound}"}} {count}')
+            lines.append(f'{p}_span_seconds_bucket{{span="{_label(name)}",le="+Inf"}} {h["count"]}')
+            lines.append(f'{p}_span_seconds_sum{{span="{_label(name)}"}} {h["sum"]:.6f}')
+            lines.append(f'{p}_span_seconds_count{{span="{_label(name)}"}} {h["count"]}')
+
+        lines += [f"# HELP {p}_span_errors_total Traced operations that failed.", f"# TYPE {p}_span_errors_total counter"]
+        for name in sorted(errors):
+            lines.append(f'{p}_span_errors_total{{span="{_label(name)}"}} {errors[name]}')
+
+        for unit in ("bytes", "tokens"):
+            lines += [f"# HELP {p}_span_{unit}_total {unit.capitalize()} recorded on traced operations.", f"# TYPE {p}_span_{unit}_total counter"]
+            for (name, key) in sorted(k for k in sums if k[1].endswith(f"_{unit}")):
+                lines.append(f'{p}_span_{unit}_total{{span="{_label(name)}",field="{_label(key)}"}} {sums[(name, key)]}')
+
+        for group, stats in (gauges or {}).items():
+            for name, value in _flatten(_metric_name(f"{p}_{group}"), stats):
+                metric = _metric_name(name)
+                lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide tracer; the IMAP pool and the agent loop both report into it
+tracer = Tracer()
@@ -0,0 +1,216 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import numpy as np
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS vector_docs (
+    account TEXT NOT NULL,
+    mailbox TEXT NOT NULL,
+    uid INTEGER NOT NULL,
+    embedder TEXT NOT NULL,
+    partial INTEGER NOT NULL,
+    sender TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    date TEXT NOT NULL,
+    vector BLOB NOT NULL,
+    PRIMARY KEY (account, mailbox, uid)
+);
+"""
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+class HashingEmbedder:
+    """Deterministic, offline embedder: signed feature hashing of words and character trigrams.
+
+    No model download and the same vector on every machine, so it works as
+    the default and in tests; it captures lexical overlap (including partial
+    words like "invoic"), not meaning.
+    """
+
+    def __init__(self, dim=384):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def _features(self, text):
+        text = unicodedata.normalize("NFKD", text.lower())
+        text = "".join(c for c in text if not unicodedata.combining(c))
+        for word in _WORD.findall(text):
+            yield word, 1.0
+            padded = f"<{word}>"
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3], 0.5
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, weight in self._features(text):
+                h = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little")
+                vectors[row, h % self.dim] += weight if (h >> 63) else -weight
+        # Dampen repeated terms, then normalise so a dot product is the cosine
+        vectors = np.sign(vectors) * np.log1p(np.abs(vectors))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-9)
+
+
+class SentenceTransformerEmbedder:
+    """Local CPU sentence-embedding model (needs the optional sentence-transformers package)."""
+
+    def __init__(self, model_name="all-MiniLM-L6-v2"):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = f"st-{model_name}"
+
+    def embed(self, texts):
+        return self.model.encode(list(texts), normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+
+def create_embedder(kind="hashing", model_name=None):
+    """Builds the embedder named by `kind` ("hashing" or "sentence-transformers").
+
+    Falls back to the hashing embedder when the model can't be loaded.
+    """
+    if kind == "sentence-transformers":
+        try:
+            return SentenceTransformerEmbedder(model_name or "all-MiniLM-L6-v2")
+        except Exception as e:
+            print(f"Sentence-transformers embedder unavailable, using hashing embedder: {e}")
+    elif kind != "hashing":
+        print(f"Unknown embedder {kind!r}, using hashing embedder")
+    return HashingEmbedder()
+
+
+def document_text(doc, body_chars=2000):
+    return "\n".join([doc.get("subject") or "", doc.get("sender") or "", (doc.get("body") or "")[:body_chars]])
+
+
+class VectorIndex:
+    """Embeddings of locally known mail for semantic lookup.
+
+    Vectors are stored as float16 blobs in SQLite and loaded per
+    (account, mailbox) into one float32 NumPy matrix; a query is a single
+    matrix-vector product plus a partial sort. It takes the same
+    index/remove/clear_mailbox calls as MailSearchIndex, so the sync
+    engine feeds both.
+    """
+
+    def __init__(self, path="mail_cache.db", embedder=None):
+        self.path = path
+        self.embedder = embedder or HashingEmbedder()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        # Vectors from another embedder live in a different space
+        self._db.execute("DELETE FROM vector_docs WHERE embedder != ?", (self.embedder.name,))
+        self._db.commit()
+        self._matrices = {}
+        self._stats = {"embedded": 0, "embed_seconds_total": 0.0, "searches": 0, "search_seconds_total": 0.0}
+
+    # --- Updates ---
+
+    def index(self, account, mailbox, documents):
+        """Embeds and stores documents (same shape as MailSearchIndex.index); partial never replaces full."""
+        if not documents:
+            return
+        with self._lock:
+            full_uids = {
+                row[0] for row in self._db.execute(
+                    "SELECT uid FROM vector_docs WHERE account = ? AND mailbox = ? AND partial = 0", (account, mailbox)
+                )
+            }
+        documents = [d for d in documents if not (d.get("partial") and int(d["uid"]) in full_uids)]
+        if not documents:
+            return
+
+        started = time.perf_counter()
+        vectors = self.embedder.embed([document_text(d) for d in documents])
+        elapsed = time.perf_counter() - started
+
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO vector_docs (account, mailbox, uid, embedder, partial, sender, subject, date, vector) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (account, mailbox, int(d["uid"]), self.embedder.name, 1 if d.get("partial") else 0,
+                     d.get("sender") or "", d.get("subject") or "", d.get("date") or "",
+                     vector.astype(np.float16).tobytes())
+                    for d, vector in zip(documents, vectors)
+                ],
+            )
+            self._db.commit()
+            self._matrices.pop((account, mailbox), None)
+            self._stats["embedded"] += len(documents)
+            self._stats["embed_seconds_total"] += elapsed
+
+    def remove(self, account, mailbox, uids):
+        uids = [int(u) for u in uids]
+        if not uids:
+            return
+        with self._lock:
+            self._db.executemany(
+                "DELETE FROM vector_docs WHERE account = ? AND mailbox = ? AND uid = ?",
+                [(account, mailbox, u) for u in uids],
+            )
+            self._db.commit()
+            self._matrices.pop((account, mailbox), None)
+
+    def clear_mailbox(self, account, mailbox):
+        with self._lock:
+            self._db.execute("DELETE FROM vector_docs WHERE account = ? AND mailbox = ?", (account, mailbox))
+            self._db.commit()
+            self._matrices.pop((account, mailbox), None)
+
+    # --- Queries ---
+
+    def _matrix(self, account, mailbox):
+        """The (uids, vectors, meta) matrix for a mailbox, loaded from SQLite on first use after a change."""
+        key = (account, mailbox)
+        if key not in self._matrices:
+            rows = self._db.execute(
+                "SELECT uid, sender, subject, date, vector FROM vector_docs WHERE account = ? AND mailbox = ?",
+                (account, mailbox),
+            ).fetchall()
+            if rows:
+                vectors = np.frombuffer(b"".join(r[4] for r in rows), dtype=np.float16)
+                vectors = vectors.reshape(len(rows), self.embedder.dim).astype(np.float32)
+            else:
+                vectors = np.zeros((0, self.embedder.dim), dtype=np.float32)
+            self._matrices[key] = (
+                [str(r[0]) for r in rows],
+                vectors,
+                [{"sender": r[1], "subject": r[2], "date": r[3]} for r in rows],
+            )
+        return self._matrices[key]
+
+    def search(self, account, mailbox, query, limit=5):
+        """Returns the `limit` messages closest to `query`: [{"id", "sender", "subject", "date", "score"}]."""
+        query_vector = self.embedder.embed([query])[0]
+        started = time.perf_counter()
+        with self._lock:
+            uids, vectors, meta = self._matrix(account, mailbox)
+            if not uids:
+                return []
+            scores = vectors @ query_vector
+            k = min(int(limit), len(uids))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            self._stats["searches"] += 1
+            self._stats["search_seconds_total"] += time.perf_counter() - started
+            return [{"id": uids[i], **meta[i], "score": round(float(scores[i]), 3)} for i in top]
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["embedder"] = self.embedder.name
+            snapshot["documents"] = self._db.execute("SELECT COUNT(*) FROM vector_docs").fetchone()[0]
+            snapshot["loaded_matrices"] = len(self._matrices)
+        searches = snapshot["searches"]
+        snapshot["search_seconds_avg"] = snapshot["search_seconds_total"] / searches if searches else 0.0
+        return snapshot
@@ -18,9 +18,54 @@ const STORAGE_KEYS = {
     GEMINI_KEY: 'ai_email_gemini_key',
     SELECTED_MODEL: 'ai_email_selected_model',
     CHAT_HISTORY: 'ai_email_chat_history',
-    USER_EMAIL: 'ai_email_user_email'
+    USER_EMAIL: 'ai_email_user_email',
+    SESSION_TOKEN: 'ai_email_session_token'
 };
 
+// Every API call carries the session token issued at login
+const sessionToken = () => localStorage.getItem(STORAGE_KEYS.SESSION_TOKEN);
+axios.interceptors.request.use((config) => {
+    const token = sessionToken();
+    if (token) config.headers.Authorization = `Bearer ${token}`;
+    return config;
+});
+
+// POSTs a command to the streaming agent endpoint and calls onEvent(event, data) per SSE frame
+async function streamAgent(body, onEvent) {
+    const res = await fetch(`${API_URL}/api/agent/stream`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json', Authorization: `Bearer ${sessionToken()}` },
+        body: JSON.stringify(body)
+    });
+    if (!res.ok) throw new Error(`HTTP ${res.status}`);
+    if (!res.headers.get('content-type')?.includes('text/event-stream')) {
+        // Validation errors (e.g. missing key) come back as plain JSON
+        const data = await res.json();
+        throw new Error(data.message || 'Agent error');
+    }
+
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const frame = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            let event = 'message';
+            let data = '';
+            for (const line of frame.split('\n')) {
+                if (line.startsWith('event: ')) event = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            }
+            if (data) onEvent(event, JSON.parse(data));
+        }
+    }
+}
+
 function App() {
     // --- STATE MANAGEMENT ---
     const [isAuthenticated, setIsAuthenticated] = useState(false);
@@ -32,6 +77,7 @@ function App() {
     const [chatInput, setChatInput] = useState('');
     const [chatHistory, setChatHistory] = useState([]);
     const [isProcessing, setIsProcessing] = useState(false);
+    const [agentActivity, setAgentActivity] = useState('');
 
     // UI State
     const [showSettings, setShowSettings] = useState(false);
@@ -120,7 +166,8 @@ function App() {
         e.preventDefault();
         setIsLoggingIn(true);
         try {
-            await axios.post(`${API_URL}/auth/login`, { email: loginEmail, password: loginPassword });
+            const res = await axios.post(`${API_URL}/auth/login`, { email: loginEmail, password: loginPassword });
+            localStorage.setItem(STORAGE_KEYS.SESSION_TOKEN, res.data.token);
             setIsAuthenticated(true);
             setUserEmail(loginEmail);
             fetchEmails();
@@ -139,16 +186,48 @@ function App() {
         } catch (err) { showToast('error', 'Failed to save key'); }
     };
 
-    const fetchEmails = useCallback(async () => {
+    const fetchEmails = useCallback(async (refresh = false) => {
         setEmailsLoading(true);
         try {
-            const res = await axios.get(`${API_URL}/api/emails`);
+            // refresh=true asks the backend to run a sync pass before serving its local copy
+            const res = await axios.get(`${API_URL}/api/emails`, { params: { refresh } });
             setEmails(res.data.emails.slice(0, 20));
             showToast('success', 'Inbox refreshed');
         } catch (err) { showToast('error', 'Failed to fetch emails'); }
         finally { setEmailsLoading(false); }
     }, []);
 
+    // Live inbox updates pushed by the backend (IMAP IDLE -> sync -> SSE)
+    useEffect(() => {
+        if (!isAuthenticated) return;
+        // EventSource can't send headers, so the token goes in the query string
+        const source = new EventSource(`${API_URL}/api/events?token=${encodeURIComponent(sessionToken())}`);
+        const sortNewestFirst = (list) => list.sort((a, b) => Number(b.id) - Number(a.id)).slice(0, 20);
+
+        source.addEventListener('new', (e) => {
+            const { emails: incoming } = JSON.parse(e.data);
+            setEmails(prev => {
+                const known = new Set(prev.map(m => m.id));
+                const fresh = incoming.filter(m => !known.has(m.id));
+                return sortNewestFirst([...fresh, ...prev]);
+            });
+            showToast('success', `${incoming.length} new email${incoming.length === 1 ? '' : 's'}`);
+        });
+        source.addEventListener('flags', (e) => {
+            const { emails: changed } = JSON.parse(e.data);
+            const byId = Object.fromEntries(changed.map(m => [m.id, m]));
+            setEmails(prev => prev.map(m => byId[m.id] ? { ...m, ...byId[m.id] } : m));
+        });
+        source.addEventListener('expunge', (e) => {
+            const { ids } = JSON.parse(e.data);
+            const removed = new Set(ids);
+            setEmails(prev => prev.filter(m => !removed.has(m.id)));
+        });
+        source.addEventListener('resync', () => fetchEmails());
+
+        return () => source.close();
+    }, [isAuthenticated]);
+
     const handleSendMessage = async (e) => {
         e.preventDefault();
         if (!chatInput.trim()) return;
@@ -161,20 +240,34 @@ function App() {
             const apiKey = geminiKeyInput || localStorage.getItem(STORAGE_KEYS.GEMINI_KEY);
             if (!apiKey) throw new Error("No API Key");
 
-            const res = await axios.post(`${API_URL}/api/agent`, {
-                command: userMsg,
-                model: selectedModel,
-                gemini_key: apiKey
+            // Stream the reply: tool progress goes to the activity line, text into the last bubble
+            let replyStarted = false;
+            const setReply = (update) => setChatHistory(prev => {
+                if (!replyStarted) {
+                    replyStarted = true;
+                    return [...prev, { role: 'assistant', content: update('') }];
+                }
+                const next = [...prev];
+                next[next.length - 1] = { ...next[next.length - 1], content: update(next[next.length - 1].content) };
+                return next;
             });
 
-            if (res.data.type === 'error') throw new Error(res.data.message);
+            await streamAgent({ command: userMsg, model: selectedModel, gemini_key: apiKey }, (event, data) => {
+                if (event === 'tool_start') setAgentActivity(`Running ${data.name}...`);
+                else if (event === 'tool_finish') setAgentActivity(`${data.name} ${data.ok ? 'done' : 'failed'} in ${Math.round(data.duration_ms)} ms`);
+                else if (event === 'token') setReply(text => text + data.text);
+                else if (event === 'done') setReply(() => data.message);
+                else if (event === 'error') throw new Error(data.message);
+            });
 
-            setChatHistory(prev => [...prev, { role: 'assistant', content: res.data.message }]);
-            if (userMsg.toLowerCase().includes('refresh')) fetchEmails();
+            if (userMsg.toLowerCase().includes('refresh')) fetchEmails(true);
 
         } catch (err) {
             setChatHistory(prev => [...prev, { role: 'assistant', content: '❌ Error: Check API Key or Backend.' }]);
-        } finally { setIsProcessing(false); }
+        } finally {
+            setIsProcessing(false);
+            setAgentActivity('');
+        }
     };
 
     // Auto summarize logic
@@ -242,7 +335,7 @@ function App() {
                     <Zap size={20} />
                 </div>
                 <div className="flex-1 flex flex-col gap-4 mt-4">
-                    <button onClick={fetchEmails} className={`p-3 rounded-xl transition-all ${!selectedEmail ? 'bg-zinc-800 text-white' : 'text-zinc-500 hover:bg-zinc-800 hover:text-white'}`}>
+                    <button onClick={() => fetchEmails(true)} className={`p-3 rounded-xl transition-all ${!selectedEmail ? 'bg-zinc-800 text-white' : 'text-zinc-500 hover:bg-zinc-800 hover:text-white'}`}>
                         <Inbox size={22} />
                     </button>
                     <button onClick={() => showToast('info', 'AI Chat is always active on the right')} className="p-3 text-zinc-500 hover:text-white hover:bg-zinc-800 rounded-xl transition-all">
@@ -338,7 +431,7 @@ function App() {
                             </div>
                         </div>
                     ))}
-                    {isProcessing && <div className="text-xs text-zinc-500 ml-4 animate-pulse">Agent is thinking...</div>}
+                    {isProcessing && <div className="text-xs text-zinc-500 ml-4 animate-pulse">{agentActivity || 'Agent is thinking...'}</div>}
                     <div ref={chatEndRef} />
                 </div>
 
@@ -464,7 +557,7 @@ function App() {
                         <button onClick={handleSaveKey} className="w-full bg-blue-600 text-white py-2.5 rounded-xl mb-3 font-medium hover:bg-blue-500 transition-colors">
                             Save Configuration
                         </button>
-                        <button onClick={async () => { await axios.post(`${API_URL}/auth/logout`); window.location.reload(); }} className="w-full text-red-400 py-2 hover:bg-red-900/20 rounded-xl transition-colors text-sm">
+                        <button onClick={async () => { await axios.post(`${API_URL}/auth/logout`); localStorage.removeItem(STORAGE_KEYS.SESSION_TOKEN); window.location.reload(); }} className="w-full text-red-400 py-2 hover:bg-red-900/20 rounded-xl transition-colors text-sm">
                             Log Out
                         </button>
                     </div>